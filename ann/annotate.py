@@ -10,11 +10,26 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import sys
+import asyncio
+import collections
+import threading
+import numpy as np
+import dbsnpstore as ds
 import file_utils as fu
+import intervals as iv
+import transcripts as tx
 import utils as u
+import vcfreader as vr
+
+from concurrent.futures import ThreadPoolExecutor
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Connection of each lookup thread of runAsyncPipeline
+lookupThread = threading.local()
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -33,13 +48,27 @@ def collapseGeneNames(row, indices, region, cnt):
 """"Collapces bigRefSegTable
 """
 def collapseRefSeq(line):
+    return collapseRefSeqFields(line.strip().split('\t'))
+
+
+"""Collapses a bigRefSeq row (without its leading id column) directly,
+   without joining it into a tab separated line and splitting it again
+"""
+def collapseRefSeqRow(row):
+    fields = [str(x) for x in row]
+    if (len(fields) > 0):
+        fields[0] = fields[0].lstrip()
+        fields[-1] = fields[-1].rstrip()
+    return collapseRefSeqFields(fields)
+
+
+def collapseRefSeqFields(fields):
     names = ['chr', 'start', 'end', 'haplotypeReference', 
         'haplotypeAlternate', 'name', 'name2', 'transcriptStrand', 
         'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
         'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
         'changesAA', 'functionalClass','codingCoordStr','proteinCoordStr',
         'inCodingRegion', 'spliceInfo','uorfChange']
-    fields = line.strip().split('\t')
     fcount = 0
     collapsed = []
 
@@ -107,84 +136,667 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
+"""Header and meta lines are passed through by every pass unchanged
+"""
+def isHeaderLine(line):
+    return (line.startswith('#') or line.startswith('CHROM'))
 
+
+"""Yields the split fields of every data line of the input
+"""
+def readDataFields(vcf, sep='\t'):
     fh = open(vcf)
+    for line in fh:
+        line = line.strip()
+        if (len(line) > 0 and not isHeaderLine(line)):
+            yield line.split(sep)
+    fh.close()
+
+
+"""Yields a Variant for every data line of the input
+"""
+def readVariants(vcf, format='vcf', sep='\t'):
+    inds = getFormatSpecificIndices(format=format)
+    for fields in readDataFields(vcf, sep=sep):
+        yield Variant(fields, inds)
+
+
+# Column of the INFO field
+INFO = 7
+
+
+"""A data line of the input, parsed once for all the passes
+
+   chrom (without any 'chr' prefix), ref and alt are interned and pos is an
+   int, so passes read the variant without splitting or stripping the line
+   again. fields holds the columns as they are written out, except INFO: the
+   passes add fragments to info, which are only joined when the line is
+   written. Fragments are never empty, so an INFO of '.' is info == ['.']
+"""
+class Variant(object):
+    __slots__ = ('fields', 'chrom', 'pos', 'ref', 'alt', 'info')
+
+    def __init__(self, fields, inds):
+        chrom = fields[inds[0]].strip()
+        if chrom.startswith('chr'):
+            chrom = chrom[3:]
+        self.fields = fields
+        self.chrom = sys.intern(chrom)
+        self.pos = int(fields[inds[1]])
+        self.ref = sys.intern(clean_mysql_chars(fields[inds[2]]).strip())
+        self.alt = sys.intern(clean_mysql_chars(fields[inds[3]]).strip())
+        self.info = []
+        self.addInfo(fields[INFO])
+
+    def addInfo(self, fragment):
+        if (len(fragment) > 0):
+            self.info.append(fragment)
+
+    # Joins the fragments; passes that parse INFO pay for one join
+    def getInfo(self):
+        info = ''.join(self.info)
+        self.info = []
+        self.addInfo(info)
+        return info
+
+    def setInfo(self, info):
+        self.info = []
+        self.addInfo(info)
+
+    def infoStartsWith(self, prefix):
+        head = ''
+        for fragment in self.info:
+            if (len(head) >= len(prefix)):
+                break
+            head = head + fragment
+        return head.startswith(prefix)
+
+    def infoEndsWith(self, suffix):
+        tail = ''
+        for fragment in reversed(self.info):
+            if (len(tail) >= len(suffix)):
+                break
+            tail = fragment + tail
+        return tail.endswith(suffix)
+
+    # Removes the first n characters of INFO
+    def dropInfoHead(self, n):
+        while (n > 0 and len(self.info) > 0):
+            fragment = self.info.pop(0)
+            if (len(fragment) > n):
+                self.info.insert(0, fragment[n:])
+            n = n - len(fragment)
+
+    # Same as the stripping of each line between chained passes
+    def strip(self):
+        self.fields[0] = self.fields[0].lstrip()
+        if (len(self.fields) > INFO + 1):
+            self.fields[-1] = self.fields[-1].rstrip()
+            return
+
+        while (len(self.info) > 0):
+            fragment = self.info.pop().rstrip()
+            if (len(fragment) > 0):
+                self.info.append(fragment)
+                break
+
+    def getLine(self):
+        self.fields[INFO] = ''.join(self.info)
+        return '\t'.join(self.fields)
+
+
+"""Collects the positions of all variants in the input grouped by chromosome,
+   so an overlap pass can resolve them in one batched join per chromosome.
+   Chromosomes are normalised the way the pass queries them: prefixed with
+   'chr', or stripped of it when prefix is empty
+"""
+def getPositionsByChrom(vcf, format='vcf', prefix='chr', sep='\t'):
+    positions = {}
+    for batch in vr.readBatches(vcf, format=format, sep=sep):
+        for (chrom, chromPositions) in batch.getPositionsByChrom():
+            positions.setdefault(prefix + chrom, []).extend(
+                chromPositions.tolist())
+    return positions
+
+
+"""Order of the records of the input, as (grouped, sorted): grouped if every
+   chromosome is contiguous, as the lazy joins require, and sorted if its
+   positions never decrease too, as the sort-merge join requires
+"""
+def getInputOrder(vcf, format='vcf', sep='\t'):
+    seen = set()
+    chrom = None
+    lastPos = 0
+    ordered = True
+
+    for batch in vr.readBatches(vcf, format=format, sep=sep):
+        codes = batch.chromCodes
+        same = (codes[1:] == codes[:-1])
+        if ordered and (np.diff(batch.pos)[same] < 0).any():
+            ordered = False
+
+        # First record of each run of the same chromosome
+        for i in [0] + (np.flatnonzero(~same) + 1).tolist():
+            chr = int(codes[i])
+            if (chr != chrom):
+                if (chr in seen):
+                    return (False, False)
+                seen.add(chr)
+                chrom = chr
+            elif (ordered and batch.pos[i] < lastPos):
+                ordered = False
+        lastPos = batch.pos[-1]
+
+    return (True, ordered)
+
+
+"""True if table has the given column, e.g. the bin column of the UCSC
+   standard binning scheme
+"""
+def hasColumn(cursor, table, column):
+    cursor.execute('select * from ' + table + ' limit 0;')
+    cursor.fetchall()
+    return column in [str(d[0]) for d in cursor.description]
+
+
+"""Returns the join resolving the overlaps of a pass, or None when the pass
+   should query the reference table once per variant
+   engine='vectorized' loads the table once per chromosome and joins all
+   variants in a batch; engine='sweep' streams the table in position order
+   alongside a sorted input, and falls back to per variant (indexed)
+   queries when the input is not sorted; engine='lazy' loads one chromosome
+   of the table at a time, for input grouped by chromosome, and falls back
+   the same way
+   On a stream (vcf=None), which cannot be scanned ahead, engine='vectorized'
+   returns a join the pass prepares for each block of the stream, and
+   engine='sweep' or 'lazy' a lazy join, which resolves the records in any
+   order but loads each chromosome once only if they are grouped by it
+   order is the getInputOrder() of vcf, which is scanned for it if None
+"""
+def getOverlapJoin(cursor, vcf, table, engine='sql', format='vcf',
+    prefix='chr', chromCol='chrom', startCol='chromStart', endCol='chromEnd',
+    sep='\t', order=None):
+
+    if (vcf is None):
+        if (engine == 'vectorized'):
+            return iv.OverlapJoin(cursor, table, chromCol=chromCol,
+                startCol=startCol, endCol=endCol)
+        if (engine in ('sweep', 'lazy')):
+            return iv.LazyJoin(cursor, table, chromCol=chromCol,
+                startCol=startCol, endCol=endCol)
+        return None
+
+    if (engine == 'vectorized'):
+        join = iv.OverlapJoin(cursor, table, chromCol=chromCol,
+            startCol=startCol, endCol=endCol)
+        join.prepare(getPositionsByChrom(vcf, format=format, prefix=prefix,
+            sep=sep))
+        return join
+
+    if (engine in ('sweep', 'lazy') and order is None):
+        order = getInputOrder(vcf, format=format, sep=sep)
+
+    if (engine == 'sweep'):
+        if not order[1]:
+            print(f"{table}: input is not coordinate sorted, using indexed " + \
+                "lookups")
+        else:
+            join = iv.SweepJoin(u.db_connect(), table, chromCol=chromCol,
+                startCol=startCol, endCol=endCol)
+            if (join.idCol is not None):
+                return join
+            join.close()
+            print(f"{table}: no row id to keep table order by, using " + \
+                "indexed lookups")
+
+    if (engine == 'lazy'):
+        if order[0]:
+            return iv.LazyJoin(cursor, table, chromCol=chromCol,
+                startCol=startCol, endCol=endCol)
+        print(f"{table}: input is not grouped by chromosome, using indexed " + \
+            "lookups")
+
+    return None
+
+
+"""Base class of the annotation passes
+
+   A pass is applied to one record at a time: the Variant parsed from a data
+   line, which apply() updates in place. open() is called once with a cursor on the
+   reference database and the input file (passes that resolve their lookups
+   in batches scan it there), annotate() once per record, close() once the
+   whole input has been annotated and writeLog() to append the pass
+   statistics to the count log.
+
+   annotate() is split in lookup(), which resolves the reference data of a
+   variant and depends only on its (chrom, pos, ref, alt) key, and apply(),
+   which adds the result to the record and updates the pass statistics.
+   Lookup results are JSON serializable so that, when a VariantCache is
+   attached to the pass, they can be reused across jobs. counters names the
+   statistics writeLog() reports, so runs split in shards can merge them.
+   When a snapshot.Snapshot is attached, passes read the reference tables it
+   has from it instead of the database. options names the run options
+   (engine, batchsize, dbsnpstore) the constructor takes.
+
+   order is the getInputOrder() of the input, which the run sets before
+   opening the passes so that they do not each scan the input for it; a
+   pass that needs it scans the input itself when it is None.
+
+   open() is given vcf=None when the input is a stream that cannot be read
+   ahead of the records. openBlock() is then called with each block of the
+   stream, spooled to a local file, before its records are annotated, so
+   that passes resolving their lookups in batches resolve them one block at
+   a time.
+"""
+class AnnotationStage(object):
+    label = ''
+    counters = ()
+    options = ()
+
+    def __init__(self, format='vcf'):
+        self.format = format
+        self.inds = getFormatSpecificIndices(format=format)
+        self.cursor = None
+        self.cache = None
+        self.snapshot = None
+        self.order = None
+
+    # Lookups running on a lookup thread of runAsyncPipeline use the cursor
+    # of that thread's own connection
+    @property
+    def cursor(self):
+        cursor = getattr(lookupThread, 'cursor', None)
+        return self.mainCursor if (cursor is None) else cursor
+
+    @cursor.setter
+    def cursor(self, cursor):
+        self.mainCursor = cursor
+
+    def open(self, cursor, vcf, sep='\t'):
+        self.cursor = cursor
+
+    def openBlock(self, block, sep='\t'):
+        pass
+
+    # (grouped, sorted) order of the input vcf, unless the run set it
+    def getInputOrder(self, vcf, sep='\t'):
+        if (self.order is None):
+            return getInputOrder(vcf, format=self.format, sep=sep)
+        return self.order
+
+    def annotate(self, variant):
+        return self.apply(variant, self.resolve(variant))
+
+    # The lookup result of a record, from the cache when it has it
+    def resolve(self, variant):
+        if (self.cache is None):
+            return self.lookup(variant)
+
+        name = self.getCacheName()
+        key = self.getKey(variant)
+        (found, value) = self.cache.get(name, key)
+        if not found:
+            value = self.lookup(variant)
+            self.cache.put(name, key, value)
+        return value
+
+    def lookup(self, variant):
+        return None
+
+    def apply(self, variant, value):
+        return variant
+
+    # Passes configured differently must not share cached results
+    def getCacheName(self):
+        return self.label
+
+    def getKey(self, variant):
+        return (variant.chrom, str(variant.pos), variant.ref, variant.alt)
+
+    # False if lookups must be made one at a time in input order
+    def isConcurrent(self):
+        return True
+
+    # The snapshot copy of a reference table, or None to query the database
+    def getSnapshotTable(self, table):
+        if (self.snapshot is None):
+            return None
+        return self.snapshot.table(table)
+
+    # True if the lookup of this record will be answered by the cache, so
+    # passes resolving their lookups in batches can leave it out
+    def isCached(self, variant):
+        return (self.cache is not None and
+            self.cache.contains(self.getCacheName(), self.getKey(variant)))
+
+    def close(self):
+        pass
+
+    def getCounts(self):
+        return dict([(name, getattr(self, name)) for name in self.counters])
+
+    # Adds up the statistics of the same pass run over each shard of the input
+    def mergeCounts(self, shardCounts):
+        initial = self.getCounts()
+        for counts in shardCounts:
+            for name in self.counters:
+                setattr(self, name,
+                    getattr(self, name) + counts[name] - initial[name])
+
+    def writeLog(self, fh_log):
+        pass
+
+
+"""Runs a single pass over infile and writes the annotated copy to outfile
+"""
+def runStage(stage, infile, outfile, logcountfile, logmode='a', sep='\t',
+    cache=None, snapshot=None):
+    fh = open(infile)
+    fh_out = open(outfile, "w")
+    runStageLines(stage, fh, fh_out, infile, sep=sep, cache=cache,
+        snapshot=snapshot)
+
+    fh_log = open(logcountfile, logmode)
+    stage.writeLog(fh_log)
+    fh_log.close()
+
+    fh.close()
+    fh_out.close()
+
+
+"""Runs a single pass over the lines of fh and writes them to fh_out; vcf is
+   the input file the pass scans when it is opened, which need not be fh
+   itself as long as it has the same variants
+"""
+def runStageLines(stage, fh, fh_out, vcf, sep='\t', cache=None,
+    snapshot=None):
     conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    stage.cache = cache
+    stage.snapshot = snapshot
+    stage.open(conn.cursor(), vcf, sep=sep)
 
     for line in fh:
         line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+        if isHeaderLine(line):
+            fh_out.write(line + '\n')
+        else:
+            variant = stage.annotate(Variant(line.split(sep), stage.inds))
+            fh_out.write(variant.getLine() + '\n')
+    stage.close()
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+    conn.close()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+"""Writes a block of lines of a stream to blockfile and hands it to the
+   openBlock() of every pass
+"""
+def spoolBlock(stages, lines, blockfile, sep='\t'):
+    fh_block = open(blockfile, 'w')
+    fh_block.writelines(lines)
+    fh_block.close()
+    for stage in stages:
+        stage.openBlock(blockfile, sep=sep)
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+"""Yields the lines of the stream fh in blocks of about blocksize bytes,
+   each spooled with spoolBlock() before it is yielded
+"""
+def readStreamBlocks(fh, stages, blockfile, sep='\t',
+    blocksize=vr.BLOCK_SIZE):
+    lines = []
+    size = 0
+    for line in fh:
+        lines.append(line)
+        size = size + len(line)
+        if (size >= blocksize):
+            spoolBlock(stages, lines, blockfile, sep=sep)
+            yield lines
+            lines = []
+            size = 0
+
+    if (len(lines) > 0):
+        spoolBlock(stages, lines, blockfile, sep=sep)
+        yield lines
+    if os.path.exists(blockfile):
+        os.remove(blockfile)
+
+
+"""Runs all passes over infile in a single sweep: each record is parsed once,
+   handed to every pass in turn and written once to outfile
+   fh, if given, is an open stream of the input lines read instead of
+   infile; infile may then be None, if the input cannot be scanned ahead,
+   and the stream is read in blocks the passes resolve their lookups for
+   before the records of the block are annotated
+"""
+def runPipeline(stages, infile, outfile, logcountfile, sep='\t', cache=None,
+    snapshot=None, fh=None):
+    if (fh is None):
+        fh = open(infile)
+    fh_out = open(outfile, "w")
+    conn = u.db_connect()
+    for stage in stages:
+        stage.cache = cache
+        stage.snapshot = snapshot
+        stage.open(conn.cursor(), infile, sep=sep)
+
+    blocks = [fh]
+    if (infile is None):
+        blocks = readStreamBlocks(fh, stages, outfile + '.block', sep=sep)
+
+    for lines in blocks:
+        for line in lines:
+            line = line.strip()
+            if isHeaderLine(line):
+                fh_out.write(line + '\n')
+                continue
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+            variant = Variant(line.split(sep), stages[0].inds)
+            for stage in stages:
+                variant = stage.annotate(variant)
+                variant.strip()
+            fh_out.write(variant.getLine() + '\n')
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    fh_log = open(logcountfile, 'w')
+    for stage in stages:
+        stage.close()
+        stage.writeLog(fh_log)
+    fh_log.close()
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    conn.close()
+    fh.close()
+    fh_out.close()
 
-            linenum = linenum + 1
 
-        else:
+"""Resolves the lookups of one pass for every record on its own connection,
+   once the passes it depends on are done
+"""
+def resolvePass(stage, records, infile, waitFor, sep='\t'):
+    for future in waitFor:
+        future.result()
+
+    conn = u.db_connect()
+    stage.open(conn.cursor(), infile, sep=sep)
+    try:
+        return [stage.resolve(variant) for variant in records]
+    finally:
+        conn.close()
+
+
+"""Runs all passes over infile with the passes that do not depend on each
+   other resolving their lookups at the same time, each on its own thread
+   and connection. dependencies lists, for every pass, the positions of the
+   passes it depends on, which must come before it. The input is parsed
+   once; the results are then applied to each record in pass order, so
+   the output and count log are the same as those of runPipeline
+"""
+def runDagPipeline(stages, dependencies, infile, outfile, logcountfile,
+    sep='\t', cache=None, snapshot=None, workers=4):
+
+    lines = [line.strip() for line in open(infile)]
+    records = [Variant(line.split(sep), stages[0].inds) for line in lines
+        if not isHeaderLine(line)]
+
+    for stage in stages:
+        stage.cache = cache
+        stage.snapshot = snapshot
+
+    # Passes are submitted in pass order, so a pass only ever waits for
+    # passes already running or done and the pool cannot deadlock
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (stage, deps) in zip(stages, dependencies):
+            futures.append(executor.submit(resolvePass, stage, records, infile,
+                [futures[d] for d in deps], sep=sep))
+        results = [future.result() for future in futures]
+
+    fh_out = open(outfile, "w")
+    i = 0
+    for line in lines:
+        if isHeaderLine(line):
             fh_out.write(line + '\n')
+            continue
+
+        variant = records[i]
+        for (stage, values) in zip(stages, results):
+            variant = stage.apply(variant, values[i])
+            variant.strip()
+        fh_out.write(variant.getLine() + '\n')
+        i = i + 1
+    fh_out.close()
+
+    fh_log = open(logcountfile, 'w')
+    for stage in stages:
+        stage.close()
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+
+"""Resolves the lookups of the records of vcf that the cache does not have in
+   batches of stage.batchsize variants, with stage.prefetch()
+"""
+def prefetchInput(stage, vcf, sep='\t'):
+    pending = []
+    for variant in readVariants(vcf, format=stage.format, sep=sep):
+        if stage.isCached(variant):
+            continue
+        pending.append(stage.getVariant(variant))
+        if (len(pending) >= stage.batchsize):
+            stage.prefetch(pending)
+            pending = []
+    if (len(pending) > 0):
+        stage.prefetch(pending)
+
+
+"""Collects the rsIDs and GMAF flags of the dbSNP rows of a variant
+"""
+def getDbSnpRecord(rows):
+    rsids = []
+    mafs = []
+    for row in rows:
+        rsids.append(str(row[3]))
+        if (str(row[7]) != '.'):
+            mafs.append('GMAF=' + str(row[7]))
+    return [rsids, mafs]
+
+
+"""Opens a connection for the lookup thread running this
+"""
+def openLookupThread(conns):
+    conn = u.db_connect()
+    conns.append(conn)
+    lookupThread.cursor = conn.cursor()
+
+
+"""Runs all passes over infile like runPipeline, but resolves the lookups of
+   up to inflight records at a time concurrently, on a pool of lookup
+   threads that each hold their own database connection. The event loop
+   keeps the records in input order and applies the results to each of them
+   in pass order, so the output and count log are the same as those of
+   runPipeline. Passes whose lookups depend on the order of the input
+   (sweep joins) are resolved as the records are read
+"""
+def runAsyncPipeline(stages, infile, outfile, logcountfile, sep='\t',
+    cache=None, snapshot=None, connections=4, inflight=64):
+
+    conns = []
+    executor = ThreadPoolExecutor(max_workers=connections,
+        initializer=openLookupThread, initargs=(conns,))
+    try:
+        asyncio.run(annotateAsync(stages, infile, outfile, logcountfile,
+            executor, sep=sep, cache=cache, snapshot=snapshot,
+            inflight=inflight))
+    finally:
+        executor.shutdown()
+        for conn in conns:
+            conn.close()
+
+
+async def annotateAsync(stages, infile, outfile, logcountfile, executor,
+    sep='\t', cache=None, snapshot=None, inflight=64):
+
+    loop = asyncio.get_running_loop()
+    fh = open(infile)
+    fh_out = open(outfile, "w")
+    conn = u.db_connect()
+    for stage in stages:
+        stage.cache = cache
+        stage.snapshot = snapshot
+        stage.open(conn.cursor(), infile, sep=sep)
+
+    # Records read and not yet written: (line, None) for header lines,
+    # (variant, [(found, value or future, key)] per pass) for data lines
+    pending = collections.deque()
+
+    async def writeNext():
+        (variant, lookups) = pending.popleft()
+        if lookups is None:
+            fh_out.write(variant + '\n')
+            return
+
+        for (stage, (found, value, key)) in zip(stages, lookups):
+            if not found:
+                value = await value
+                if (cache is not None):
+                    cache.put(stage.getCacheName(), key, value)
+            variant = stage.apply(variant, value)
+            variant.strip()
+        fh_out.write(variant.getLine() + '\n')
+
+    for line in fh:
+        line = line.strip()
+        if isHeaderLine(line):
+            pending.append((line, None))
+            continue
+
+        variant = Variant(line.split(sep), stages[0].inds)
+        lookups = []
+        for stage in stages:
+            key = stage.getKey(variant)
+            (found, value) = (False, None)
+            if (cache is not None):
+                (found, value) = cache.get(stage.getCacheName(), key)
+            if found:
+                lookups.append((True, value, key))
+            elif stage.isConcurrent():
+                lookups.append((False, loop.run_in_executor(executor,
+                    stage.lookup, variant), key))
+            else:
+                lookups.append((True, stage.lookup(variant), key))
+                if (cache is not None):
+                    cache.put(stage.getCacheName(), key, lookups[-1][1])
+        pending.append((variant, lookups))
+
+        while (len(pending) >= inflight):
+            await writeNext()
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+    while (len(pending) > 0):
+        await writeNext()
+
+    fh_log = open(logcountfile, 'w')
+    for stage in stages:
+        stage.close()
+        stage.writeLog(fh_log)
     fh_log.close()
 
     conn.close()
@@ -192,121 +804,597 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     fh_out.close()
 
 
+"""Sets the rsIDs and the DB/GMAF INFO flags of a variant from its dbSNP
+   record. Returns True if the variant is in dbSNP
+"""
+def addDbSnpRecord(variant, record, varclass='SNV'):
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    variant.fields[2] = '.'
+    (rsids, mafs) = record
+    if (len(rsids) == 0):
+        return False
+
+    maf_str=''
+    if (len(mafs) > 0):
+        maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+    if (variant.info == ['.']):
+        variant.setInfo('DB' + maf_str)
+    else:
+        variant.addInfo(';DB;VC=' + varclass + maf_str)
+
+    variant.fields[2] = str(';'.join(rsids))
+    return True
+
+
+"""Resolves a chunk of variants against dbSNP with a single query
+   variants is a list of (chr, pos, ref, compRef) tuples; returns the
+   matching rows of each variant, in the same order as the variants
+"""
+def getDbSnpRowsBatch(cursor, variants, varclass='SNV'):
+    keys = set()
+    for (chr, pos, ref, compRef) in variants:
+        keys.add('("' + str(chr) + '",' + str(int(pos)) + ',"' + str(ref) + '")')
+        keys.add('("' + str(chr) + '",' + str(int(pos)) + ',"' + str(compRef) + '")')
+
+    sql = 'select * from dbSNP where (CHR, POS, REF) IN (' + \
+        ','.join(sorted(keys)) + ') AND INFO = "' + varclass + '";'
+    cursor.execute(sql)
+    rows = cursor.fetchall()
+
+    # Fan rows back out by key; keep the result set order so a variant
+    # matching both REF and its complement sees rows in server order
+    names = [str(d[0]).upper() for d in cursor.description]
+    ci = names.index('CHR')
+    pi = names.index('POS')
+    ri = names.index('REF')
+    found = {}
+    for (seq, row) in enumerate(rows):
+        key = (str(row[ci]).upper(), int(row[pi]), str(row[ri]).upper())
+        found.setdefault(key, []).append((seq, row))
+
+    results = []
+    for (chr, pos, ref, compRef) in variants:
+        matches = found.get((str(chr).upper(), int(pos), str(ref).upper()), [])
+        if (str(compRef).upper() != str(ref).upper()):
+            matches = matches + found.get(
+                (str(chr).upper(), int(pos), str(compRef).upper()), [])
+        results.append([row for (seq, row) in sorted(matches, key=lambda m: m[0])])
+
+    return results
+
+
+"""Rows of a variant in the snapshot copy of dbSNP, matched like the per
+   variant query (REF and INFO compare case-insensitively)
+"""
+def getDbSnpRowsSnapshot(table, variant, varclass='SNV'):
+    (chr, pos, ref, compRef) = variant
+    ri = table.columns.index('REF')
+    ii = table.columns.index('INFO')
+    refs = [str(ref).upper(), str(compRef).upper()]
+    return [row for row in table.fetchall(chr, int(pos))
+        if (str(row[ri]).upper() in refs and
+            str(row[ii]).upper() == varclass.upper())]
+
+
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    batchsize > 0 resolves that many variants per dbSNP query instead of
+    querying once per variant
+    dbsnpstore is the path of a local dbsnpstore.DbSnpStore to look the
+    variants up in; dbSNP is queried when it is empty or cannot be opened
+"""
+class DbSnpStage(AnnotationStage):
+    label = 'dbSNP'
+    counters = ('var_count', 'linenum')
+    options = ('batchsize', 'dbsnpstore')
+
+    def __init__(self, format='vcf', varclass='SNV', batchsize=0,
+        dbsnpstore=''):
+        AnnotationStage.__init__(self, format=format)
+        self.varclass = varclass
+        self.batchsize = batchsize
+        self.dbsnpstore = dbsnpstore
+        self.store = None
+        self.batch = None
+        self.table = None
+        self.var_count = 0
+        self.linenum = 1
+
+    def getVariant(self, variant):
+        return (variant.chrom, variant.pos, variant.ref,
+            getComplementary(variant.ref))
+
+    def open(self, cursor, vcf, sep='\t'):
+        AnnotationStage.open(self, cursor, vcf, sep=sep)
+        if (self.dbsnpstore and self.store is None):
+            try:
+                self.store = ds.DbSnpStore(self.dbsnpstore)
+            except Exception as e:
+                print(f"dbSNP store unavailable, querying dbSNP: {e}")
+        if (self.store is not None):
+            return
+
+        self.table = self.getSnapshotTable('dbSNP')
+        if (self.batchsize <= 0 or self.table is not None or vcf is None):
+            return
+
+        self.batch = {}
+        prefetchInput(self, vcf, sep=sep)
+
+    def openBlock(self, block, sep='\t'):
+        if (self.batchsize > 0 and self.store is None and self.table is None):
+            self.batch = {}
+            prefetchInput(self, block, sep=sep)
+
+    def prefetch(self, variants):
+        batch = getDbSnpRowsBatch(self.cursor, variants, varclass=self.varclass)
+        for (variant, rows) in zip(variants, batch):
+            self.batch[variant] = rows
+
+    def getCacheName(self):
+        return self.label + ':' + self.varclass
+
+    def lookup(self, variant):
+        key = self.getVariant(variant)
+        if (self.store is not None):
+            return self.store.getRecord(*key, varclass=self.varclass)
+
+        if (self.table is not None):
+            rows = getDbSnpRowsSnapshot(self.table, key, self.varclass)
+        elif (self.batch is not None):
+            rows = self.batch.get(key, [])
+        else:
+            (chr, pos, ref, compRef) = key
+            sql = 'select * from dbSNP where CHR="' + str(chr) + \
+                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+                self.varclass + '" ;'
+            self.cursor.execute(sql)
+            rows = self.cursor.fetchall()
+
+        return getDbSnpRecord(rows)
+
+    def apply(self, variant, record):
+        if addDbSnpRecord(variant, record, varclass=self.varclass):
+            self.var_count = self.var_count + 1
+        self.linenum = self.linenum + 1
+        return variant
+
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batchsize=0):
+
+    runStage(DbSnpStage(format=format, varclass=varclass, batchsize=batchsize),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', logmode='w',
+        sep=sep)
+
+
+"""Index of bigRefSeq rows by key, in the order the server returned them
+"""
+def indexRows(rows, keyOf):
+    found = {}
+    for (seq, row) in enumerate(rows):
+        found.setdefault(keyOf(row), []).append((seq, row))
+    return found
+
+
+"""Rows found under any of keys, in the order the server returned them
+"""
+def lookupRows(found, keys):
+    matches = []
+    for key in u.dedup(keys):
+        matches = matches + found.get(key, [])
+    return [row for (seq, row) in sorted(matches, key=lambda m: m[0])]
+
+
+"""Resolves a chunk of variants against the three bigRefSeq tables with one
+   query per table, keeping the cascade of the per variant lookups: a variant
+   only falls through to the next table if the previous one had no rows.
+   variants is a list of (chr, pos, ref, alt, compRef, compAlt) tuples;
+   returns the matching rows of each variant, in the same order
+"""
+def getBigRefGeneRowsBatch(cursor, variants):
+    results = [[] for v in variants]
+
+    # 1. chrom_pos_equal_base, keyed by (chr, pos, ref, alt)
+    keys = set()
+    for (chr, pos, ref, alt, compRef, compAlt) in variants:
+        keys.add('("' + str(chr) + '",' + str(int(pos)) + ',"' + str(ref) + \
+            '","' + str(alt) + '")')
+        keys.add('("' + str(chr) + '",' + str(int(pos)) + ',"' + \
+            str(compRef) + '","' + str(compAlt) + '")')
+    cursor.execute('select * from chrom_pos_equal_base where ' + \
+        '(CHR, start, haplotypeReference, haplotypeAlternate) IN (' + \
+        ','.join(sorted(keys)) + ');')
+    names = [str(d[0]) for d in cursor.description]
+    ci = names.index('CHR')
+    si = names.index('start')
+    ri = names.index('haplotypeReference')
+    ai = names.index('haplotypeAlternate')
+    found = indexRows(cursor.fetchall(), lambda row: (str(row[ci]).upper(),
+        int(row[si]), str(row[ri]).upper(), str(row[ai]).upper()))
+
+    for (i, (chr, pos, ref, alt, compRef, compAlt)) in enumerate(variants):
+        results[i] = lookupRows(found, [
+            (str(chr).upper(), int(pos), str(ref).upper(), str(alt).upper()),
+            (str(chr).upper(), int(pos), str(compRef).upper(), str(compAlt).upper())])
+
+    # 2. chrom_pos_equal_nobase, keyed by (chr, pos)
+    pending = [i for i in range(len(variants)) if (len(results[i]) == 0)]
+    if (len(pending) == 0):
+        return results
+
+    keys = set(['("' + str(variants[i][0]) + '",' + str(int(variants[i][1])) + \
+        ')' for i in pending])
+    cursor.execute('select * from chrom_pos_equal_nobase where ' + \
+        '(CHR, start) IN (' + ','.join(sorted(keys)) + ');')
+    names = [str(d[0]) for d in cursor.description]
+    ci = names.index('CHR')
+    si = names.index('start')
+    found = indexRows(cursor.fetchall(),
+        lambda row: (str(row[ci]).upper(), int(row[si])))
+
+    for i in pending:
+        results[i] = lookupRows(found,
+            [(str(variants[i][0]).upper(), int(variants[i][1]))])
+
+    # 3. chrom_pos_unequal, one range per chromosome joined in an interval index
+    pending = [i for i in pending if (len(results[i]) == 0)]
+    if (len(pending) == 0):
+        return results
+
+    ranges = {}
+    for i in pending:
+        (chr, pos) = (str(variants[i][0]), int(variants[i][1]))
+        (lo, hi) = ranges.get(chr, (pos, pos))
+        ranges[chr] = (min(lo, pos), max(hi, pos))
+    where = ['(CHR="' + chr + '" AND start <= ' + str(hi) + ' AND end >= ' + \
+        str(lo) + ')' for (chr, (lo, hi)) in sorted(ranges.items())]
+    cursor.execute('select * from chrom_pos_unequal where ' + \
+        ' OR '.join(where) + ';')
+    names = [str(d[0]) for d in cursor.description]
+    ci = names.index('CHR')
+    si = names.index('start')
+    ei = names.index('end')
+    rowsByChrom = {}
+    for row in cursor.fetchall():
+        rowsByChrom.setdefault(str(row[ci]).upper(), []).append(row)
+
+    for chr in set([str(variants[i][0]).upper() for i in pending]):
+        rows = rowsByChrom.get(chr, [])
+        index = iv.IntervalIndex(starts=[int(row[si]) for row in rows],
+            ends=[int(row[ei]) for row in rows], payload=rows)
+        chrPending = [i for i in pending if (str(variants[i][0]).upper() == chr)]
+        matches = index.query([int(variants[i][1]) for i in chrPending])
+        for (i, rows) in zip(chrPending, matches):
+            results[i] = rows
+
+    return results
+
+
+"""Resolves a variant against the snapshot copies of the three bigRefSeq
+   tables, with the same cascade as the per variant queries
+   variant is a (chr, pos, ref, alt, compRef, compAlt) tuple
+"""
+def getBigRefGeneRowsSnapshot(tables, variant):
+    (base, nobase, unequal) = tables
+    (chr, pos, ref, alt, compRef, compAlt) = variant
+
+    ri = base.columns.index('haplotypeReference')
+    ai = base.columns.index('haplotypeAlternate')
+    alleles = [(str(ref).upper(), str(alt).upper()),
+        (str(compRef).upper(), str(compAlt).upper())]
+    rows = [row for row in base.fetchall(chr, int(pos))
+        if ((str(row[ri]).upper(), str(row[ai]).upper()) in alleles)]
+
+    if (len(rows) == 0):
+        rows = nobase.fetchall(chr, int(pos))
+    if (len(rows) == 0):
+        rows = unequal.fetchall(chr, int(pos))
+    return rows
+
+
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+    batchsize > 0 resolves that many variants with three queries in total
+    instead of up to three queries per variant
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+class BigRefGeneStage(AnnotationStage):
+    label = 'BigRefGene'
+    options = ('batchsize',)
+
+    def __init__(self, format='vcf', batchsize=0):
+        AnnotationStage.__init__(self, format=format)
+        self.batchsize = batchsize
+        self.batch = None
+        self.tables = None
+        self.binned = False
+
+    def getVariant(self, variant):
+        return (variant.chrom, variant.pos, variant.ref, variant.alt,
+            getComplementary(variant.ref), getComplementary(variant.alt))
+
+    def open(self, cursor, vcf, sep='\t'):
+        AnnotationStage.open(self, cursor, vcf, sep=sep)
+        tables = [self.getSnapshotTable(table) for table in
+            ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+            'chrom_pos_unequal']]
+        if (None not in tables):
+            self.tables = tables
+            return
+        self.binned = hasColumn(cursor, 'chrom_pos_unequal', 'bin')
+        if (self.batchsize <= 0 or vcf is None):
+            return
+
+        self.batch = {}
+        prefetchInput(self, vcf, sep=sep)
+
+    def openBlock(self, block, sep='\t'):
+        if (self.batchsize > 0 and self.tables is None):
+            self.batch = {}
+            prefetchInput(self, block, sep=sep)
+
+    def prefetch(self, variants):
+        batch = getBigRefGeneRowsBatch(self.cursor, variants)
+        for (variant, rows) in zip(variants, batch):
+            self.batch[variant] = rows
+
+    def lookup(self, variant):
+        key = self.getVariant(variant)
+        if (self.tables is not None):
+            return self.getRecords(getBigRefGeneRowsSnapshot(self.tables,
+                key))
+        if (self.batch is not None):
+            return self.getRecords(self.batch.get(key, []))
+
+        cursor = self.cursor
+        (chr, pos, ref, alt, compRef, compAlt) = key
+
+        sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + \
+            ' AND ((haplotypeReference="' + str(ref) + \
+            '" AND haplotypeAlternate ="' + str(alt) + \
+            '") OR (haplotypeReference="' + str(compRef) + \
+            '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+        sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + ';'
+
+        sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+            str(chr) + '" AND ' + \
+            (u.binClause(pos) if self.binned else '') + 'start <= ' + \
+            str(pos) + ' AND end >= ' + str(pos) + ';'
+
+        for sql in [sql1, sql2, sql3]:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
+            if (len(rows) > 0):
+                return self.getRecords(rows)
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+        return []
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+    # Collapsed isoform records, in the order they are written out
+    def getRecords(self, rows):
+        m = set([])
+        for row in rows:
+            m.add(collapseRefSeqRow(row[1:len(row)]))
+        return list(m)
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+    def apply(self, variant, records):
+        if (len(records) > 0):
+            variant.addInfo(';' + ';'.join(records))
+            if variant.infoStartsWith('.;'):
+                variant.dropInfoHead(2)
+        return variant
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    batchsize=0):
+    runStage(BigRefGeneStage(format=format, batchsize=batchsize),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
 
-            keep_going = True
-            cursor.execute(sql1)
+"""Get information about location in gene structures
+"""
+class GenesStage(AnnotationStage):
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count')
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        AnnotationStage.__init__(self, format=format)
+        self.table = table
+        self.label = table
+        self.promoter_offset = promoter_offset
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+        self.cpgIndexes = {}
+        self.binned = False
+
+    def open(self, cursor, vcf, sep='\t'):
+        AnnotationStage.open(self, cursor, vcf, sep=sep)
+        if (self.getSnapshotTable(self.table) is None):
+            self.binned = hasColumn(cursor, self.table, 'bin')
+
+    # First cpgIslandExt island containing pos, looked up in a per-chromosome
+    # interval index loaded the first time a promoter hit needs it
+    def getCpgIsland(self, chr, pos):
+        snapshotTable = self.getSnapshotTable('cpgIslandExt')
+        if (snapshotTable is not None):
+            rows = snapshotTable.fetchall(chr, pos,
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+            return rows[0] if (len(rows) > 0) else None
+
+        if chr not in self.cpgIndexes:
+            self.cpgIndexes[chr] = iv.loadChromIndex(self.cursor,
+                'cpgIslandExt', chr, columns='chrom, chromStart, chromEnd, name')
+        rows = self.cpgIndexes[chr].query([pos])[0]
+        return rows[0] if (len(rows) > 0) else None
+
+    def close(self):
+        self.cpgIndexes = {}
+
+    def getCacheName(self):
+        return self.label + ':' + str(self.promoter_offset)
+
+    # Returns [transcripts found, exons hit, promoters hit, region records]
+    def lookup(self, variant):
+        cursor = self.cursor
+        table = self.table
+        promoter_offset = self.promoter_offset
+
+        chr = 'chr' + variant.chrom
+        pos = variant.pos
+
+        # Bounds on the bare columns so the (chrom, bin, txStart) index
+        # can be used
+        lo = int(pos) - int(promoter_offset)
+        hi = int(pos) + int(promoter_offset)
+        sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
+            '" AND ' + (u.binClause(lo, hi) if self.binned else '') + \
+            'txStart <= ' + str(hi) + ' AND txEnd >= ' + str(lo) + ';'
+
+        snapshotTable = self.getSnapshotTable(table)
+        if (snapshotTable is not None):
+            rows = snapshotTable.fetchall(chr, lo, hi)
+        else:
+            cursor.execute(sql)
             rows = cursor.fetchall()
+        info = []
+        exonic_count = 0
+        promoter_count = 0
+
+        cnt = 1
+        for row in rows:
+            model = tx.getTranscriptModel(row)
+            pos = int(pos)
+            (location, exnums) = model.locate(pos, int(promoter_offset))
+            region = ""
+
+            if (location == 'non_coding'):
+                exons = ["non_coding_exon=" + "ex" + str(exnum) + '/' + \
+                    str(model.exonCount) for exnum in exnums]
+                region = ";".join(exons)
+
+            elif (location == 'cds'):
+                exons = ["exon=" + "ex" + str(exnum) + '/' + \
+                    str(model.exonCount) for exnum in exnums]
+                exonic_count = exonic_count + len(exons)
+                region = ";".join(exons)
+
+            elif (location == 'promoter'):
+                cpg = self.getCpgIsland(chr, pos)
+
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + \
+                        "".join(str(cpg[3]).split())
+                    promoter_count = promoter_count + 1
+
+            if (region != ''):
+                info.append(collapseGeneNames(row=row,
+                    indices=indicesKnownGenes, region=region, cnt=cnt))
+
+            cnt = cnt + 1
+
+        return [len(rows), exonic_count, promoter_count, info]
+
+    def apply(self, variant, located):
+        (rowcount, exonic_count, promoter_count, info) = located
+
+        if (rowcount > 0):
+            #count location, once per transcript
+            info_field = clean_mysql_chars(variant.getInfo()).strip()
+            positionType = str(u.parse_field(info_field,
+                'positionType', ';', '='))
+
+            if (positionType == 'intron'):
+                self.intronic_count = self.intronic_count + rowcount
+            elif (positionType == 'non_coding_intron'):
+                self.non_coding_intronic_count = self.non_coding_intronic_count + rowcount
+            elif (positionType == 'CDS'):
+                self.cds_count = self.cds_count + rowcount
+            elif (positionType == 'non_coding_exon'):
+                self.non_coding_exonic_count = self.non_coding_exonic_count + rowcount
+            elif (positionType == 'utr5'):
+                self.utr5_count = self.utr5_count + rowcount
+            elif (positionType == 'utr3'):
+                self.utr3_count = self.utr3_count + rowcount
+
+            self.exonic_count = self.exonic_count + exonic_count
+            self.promoter_count = self.promoter_count + promoter_count
+
+            str_info = ";".join(info)
+            variant.addInfo(';' + str_info)
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+        else:
+            variant.addInfo(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+        return variant
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-            vcf_linenum = vcf_linenum + 1
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
+    runStage(GenesStage(format=format, table=table,
+        promoter_offset=promoter_offset), vcf + tmpextin, vcf + tmpextout,
+        vcf + '.count.log', sep=sep)
 
-"""Get information about location in gene structures
+
+"""Method used in INDELS, where bigRefGeneTable is not applicable
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
-    
+
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
@@ -329,6 +1417,8 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
+    binned = hasColumn(cursor, table, 'bin')
+    cpgBinned = hasColumn(cursor, 'cpgIslandExt', 'bin')
     linenum = 1
 
     for line in fh:
@@ -336,52 +1426,34 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
         if not line.startswith("#"):
             fields = line.split(sep)
             chr = fields[inds[0]].strip()
-
+            
             if not chr.startswith("chr"):
                 chr = "chr" + chr
-
+            
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
             info_field = clean_mysql_chars(fields[7]).strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
+            lo = int(pos) - int(promoter_offset)
+            hi = int(pos) + int(promoter_offset)
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
+                '" AND ' + (u.binClause(lo, hi) if binned else '') + \
+                'txStart <= ' + str(hi) + ' AND txEnd >= ' + str(lo) + ';'
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
-
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
+                    exonStarts =str(row[9].decode('utf-8'))
+                    exonEnds = str(row[10].decode('utf-8'))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -398,29 +1470,60 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
+                                    exnum =  exonCount - e
                                 exons.append("non_coding_exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
+                                non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                            region='positionType=non_coding_exon;' + ";".join(exons)
+                        else:
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                            region = 'positionType=non_coding_intron'
+
+                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                        cds_count = cds_count + 1
                         for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
+                                    exnum =  exonCount - e
+                                exons.append("exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                                exonic_count=exonic_count+1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
+                            region = 'positionType=CDS;' + ";".join(exons)
+                        else:
+                            intronic_count = intronic_count + 1
+                            region = 'positionType=CDS;' + 'intron'
+
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "+")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                        (cdsStart < cdsEnd) (strand == "+")):
+                        utr3_count = utr3_count + 1
+                        region = 'positionType=utr3'
+
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+                        (cdsStart < cdsEnd) (strand == "-")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
+
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "-")):
+                        utr3_count = utr3_count + 1
+                        region = 'positionType=utr3'
+
+                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
+                        sql = 'select chrom, chromStart, chromEnd, name ' + \
+                            'from cpgIslandExt where chrom="' + str(chr) +  \
+                            '" AND ' + \
+                            (u.binClause(pos) if cpgBinned else '') + \
+                            'chromStart <= ' + str(pos) + \
+                            ' AND chromEnd >= ' + str(pos) + ';'
                         cursor.execute(sql)
                         rows = cursor.fetchone()
 
@@ -429,25 +1532,29 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                                 "".join(str(rows[3]).split())
                             promoter_count = promoter_count + 1
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
+                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                        (strand == "-")):
+                        sql = 'select chrom, chromStart, chromEnd, name ' + \
+                            'from cpgIslandExt where chrom="' + str(chr) + \
+                            '" AND ' + \
+                            (u.binClause(pos) if cpgBinned else '') + \
+                            'chromStart <= ' + str(pos) + \
+                            ' AND chromEnd >= ' + str(pos) + ';'
                         cursor.execute(sql)
-
                         rows = cursor.fetchone()
+
                         if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
+                            region = 'putativePromoterRegion=' + \
+                            "".join(str(rows[3]).split())
                             promoter_count = promoter_count + 1
 
                     else:
                         region = ''
 
                     if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+                        info.append(collapseGeneNames(
+                            row=row, indices=indicesKnownGenes, 
+                            region=region, cnt=cnt))
 
                     cnt = cnt + 1
 
@@ -481,7 +1588,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
     print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
 
     print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
     fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
@@ -501,611 +1608,342 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+"""Appends records to the INFO field, adding a separator unless it already
+   ends with one
+"""
+def appendInfo(variant, records):
+    if variant.infoEndsWith(';'):
+        variant.addInfo(';'.join(records))
+    else:
+        variant.addInfo(';' + ';'.join(records))
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesStage(AnnotationStage):
+    counters = ('var_count', 'line_count')
+    options = ('engine',)
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
+    columns = 'chrom, chromStart, chromEnd, name'
+
+    def __init__(self, format='vcf', table='tfbsConsSites', engine='sql'):
+        AnnotationStage.__init__(self, format=format)
+        self.table = table
+        self.label = table
+        self.engine = engine
+        self.sites = None
+        self.var_count = 0
+        self.line_count = 0
+        self.binned = {}
+
+    # Unless engine='sql', an input grouped by chromosome has the sites of
+    # each chromosome loaded from its table when it is first needed and
+    # evicted when the input moves on to the next chromosome; a stream is
+    # assumed to be grouped, as it cannot be checked ahead
+    def open(self, cursor, vcf, sep='\t'):
+        AnnotationStage.open(self, cursor, vcf, sep=sep)
+        if (self.engine == 'sql'):
+            return
+        if (vcf is None or self.getInputOrder(vcf, sep=sep)[0]):
+            self.sites = iv.ChromCache(self.loadSites)
         else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
+            print(f"{self.table}: input is not grouped by chromosome, " + \
+                "using indexed lookups")
+
+    def loadSites(self, chrIndex):
+        return iv.loadChromIndex(self.cursor, self.table + chrIndex, None,
+            chromCol=None, columns=self.columns)
+
+    def isConcurrent(self):
+        return (self.sites is None)
+
+    def close(self):
+        self.sites = None
+
+    def lookup(self, variant):
+        chr = 'chr' + variant.chrom
+        pos = variant.pos
+        chrIndex = variant.chrom
+        records = []
+
+        if (chrIndex in self.allowed_chrom):
+            snapshotTable = self.getSnapshotTable('tfbsConsSites' + chrIndex)
+            if (snapshotTable is not None):
+                rows = snapshotTable.fetchall(chr, pos,
+                    columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+            elif (self.sites is not None):
+                rows = self.sites.get(chrIndex).query([pos])[0]
+            else:
+                table = 'tfbsConsSites' + chrIndex
+                if table not in self.binned:
+                    self.binned[table] = hasColumn(self.cursor, table, 'bin')
                 sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
+                    'from ' + table + ' where ' + \
+                    (u.binClause(pos) if self.binned[table] else '') + \
+                    'chromStart <= ' + str(pos) + ' AND chromEnd >= ' + \
+                    str(pos) + ';'
+                self.cursor.execute(sql)
+                rows = self.cursor.fetchall()
 
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+            for row in rows:
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
 
-                    fh_out.write('\t'.join(fields) + '\n')
+        return records
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+    def apply(self, variant, records):
+        if (len(records) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(records)
+            appendInfo(variant, records)
+        return variant
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t', engine='sql'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(TfbsConsSitesStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
-"""Overlap with GadAll table
+"""Base class of the passes that look up the reference rows overlapping each
+   variant position, either one query per variant or through the batched
+   per-chromosome join selected with engine='vectorized'
+   lookup() returns [overlapping rows, INFO records]
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class OverlapStage(AnnotationStage):
+    counters = ('var_count', 'line_count')
+    options = ('engine',)
+    prefix = 'chr'
+    chromCol = 'chrom'
+    startCol = 'chromStart'
+    endCol = 'chromEnd'
+
+    def __init__(self, format='vcf', table='', engine='sql'):
+        AnnotationStage.__init__(self, format=format)
+        self.table = table
+        self.label = table
+        self.engine = engine
+        self.join = None
+        self.binned = False
+        self.var_count = 0
+        self.line_count = 0
+
+    def open(self, cursor, vcf, sep='\t'):
+        AnnotationStage.open(self, cursor, vcf, sep=sep)
+        snapshotTable = self.getSnapshotTable(self.table)
+        if (snapshotTable is not None and
+            (snapshotTable.chromCol, snapshotTable.startCol,
+            snapshotTable.endCol) == (self.chromCol, self.startCol, self.endCol)):
+            self.join = snapshotTable
+            return
+
+        self.join = getOverlapJoin(cursor, vcf, self.table, engine=self.engine,
+            format=self.format, prefix=self.prefix, chromCol=self.chromCol,
+            startCol=self.startCol, endCol=self.endCol, sep=sep,
+            order=self.order)
+        if (self.join is None):
+            self.binned = hasColumn(cursor, self.table, 'bin')
+
+    def openBlock(self, block, sep='\t'):
+        if isinstance(self.join, iv.OverlapJoin):
+            self.join.clear()
+            self.join.prepare(getPositionsByChrom(block, format=self.format,
+                prefix=self.prefix, sep=sep))
+
+    # Restricts the lookup to the UCSC bins that can hold pos when the table
+    # has a bin column
+    def getBinClause(self, pos):
+        return u.binClause(pos) if self.binned else ''
+
+    def getChrom(self, variant):
+        return 'chr' + variant.chrom
+
+    def getSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where ' + self.chromCol + \
+            '="' + str(chr) + '" AND ' + self.getBinClause(pos) + \
+            self.startCol + ' <= ' + str(pos) + ' AND ' + self.endCol + \
+            ' >= ' + str(pos) + ';'
+
+    def fetchall(self, chr, pos):
+        if (self.join is not None):
+            return self.join.fetchall(chr, pos)
+        self.cursor.execute(self.getSql(chr, pos))
+        return self.cursor.fetchall()
+
+    def fetchone(self, chr, pos):
+        if (self.join is not None):
+            return self.join.fetchone(chr, pos)
+        self.cursor.execute(self.getSql(chr, pos))
+        return self.cursor.fetchone()
+
+    def apply(self, variant, found):
+        (count, records) = found
+        if (count > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + count
+            appendInfo(variant, records)
+        return variant
+
+    # Sweep and lazy joins must see the variants in input order
+    def isConcurrent(self):
+        return not isinstance(self.join, (iv.SweepJoin, iv.LazyJoin))
+
+    def close(self):
+        if isinstance(self.join, (iv.SweepJoin, iv.LazyJoin, iv.OverlapJoin)):
+            self.join.close()
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+"""Overlap with GadAll table
+"""
+class GadAllStage(OverlapStage):
+    prefix = ''
+    chromCol = 'chromosome'
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    # For some reason this table has no "chr" preceeding number
+    def getChrom(self, variant):
+        return variant.chrom
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        rows = self.fetchall(chr, pos)
+        records = []
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        r_tmp = []
+        for row in rows:
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(self.table) + '=' + str(row[3]))
 
+        return [len(rows), records]
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    def apply(self, variant, found):
+        OverlapStage.apply(self, variant, found)
+        if (found[0] > 0):
+            # Annotated lines have always been written joined by '\t '
+            variant.fields[1:] = [' ' + f for f in variant.fields[1:]]
+            variant.info.insert(0, ' ')
+        return variant
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t', engine='sql'):
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    runStage(GadAllStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
+    startCol = 'chromEnd'
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    def getSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND ' + self.getBinClause(pos) + 'chromEnd = ' + \
+            str(pos) + ';'
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        rows = self.fetchall(chr, pos)
+        records = []
 
-                    records_str = ','.join(records).replace(';', ',')
+        for row in rows:
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        return [len(rows), records]
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(GwasCatalogStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
-"""Overlap with segdup regions genomicSuperDups
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HugoStage(OverlapStage):
+    def __init__(self, format='vcf', table='hugo', engine='sql'):
+        OverlapStage.__init__(self, format=format, table=table, engine=engine)
+        self.label = 'HUGO Gene Nomenclature Committee'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        rows = self.fetchall(chr, pos)
+        records = []
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        if (len(rows) > 0):
+            r_tmp = []
+            for row in rows:
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+            records = [','.join(records).replace(';', ',')]
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+        return [len(rows), records]
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
 
-                fh_out.write('\t'.join(fields) + '\n')
+    runStage(HugoStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+"""Overlap with segdup regions genomicSuperDups
+"""
+class GenomicSuperDupsStage(OverlapStage):
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        rows = self.fetchone(chr, pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if rows is None:
+            return [0, []]
+
+        isOverlap = True
+        otherChrom = rows[7]
+        otherStart = rows[8]
+        otherEnd = rows[9]
+        return [1, [str(self.table) + '=' + str(isOverlap) + ';' + \
+            'otherChrom=' + str(otherChrom) + ';otherStart=' + \
+            str(otherStart) + ';otherEnd=' + str(otherEnd)]]
+
+    # Always adds a separator, even after a trailing ';'
+    def apply(self, variant, found):
+        (count, records) = found
+        if (count > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + count
+            variant.addInfo(';' + ';'.join(records))
+        return variant
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    engine='sql'):
+
+    runStage(GenomicSuperDupsStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1134,6 +1972,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    binned = hasColumn(cursor, table, 'bin')
     linenum = 1
 
     for line in fh:
@@ -1153,8 +1992,10 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
                 isOverlap = False
                 
                 sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
+                    str(chr) + '" AND ' + \
+                    (u.binClause(pos) if binned else '') + startName + \
+                    ' <= ' + str(pos) + ' AND ' + endName + ' >= ' + \
+                    str(pos) + ';'
                 overlapsWith = []
                 cursor.execute(sql)
                 rows = cursor.fetchall()
@@ -1187,217 +2028,95 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     fh_out.close()
 
 
-"""Method to find overlap with Cytoband table
-"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+"""Method to find overlap with Cytoband table
+"""
+class CytobandStage(OverlapStage):
+    def __init__(self, format='vcf', table='cytoBand', engine='sql'):
+        OverlapStage.__init__(self, format=format, table=table, engine=engine)
+        self.colindex = 12
+        self.startCol = 'txStart'
+        self.endCol = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startCol = 'chromStart'
+            self.endCol = 'chromEnd'
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        overlapsWith = []
+        rows = self.fetchall(chr, pos)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+        if (len(rows) == 0):
+            return [0, []]
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
+        for row in rows:
+            overlapsWith.append(str(row[self.colindex]))
+        overlapsWith = u.dedup(overlapsWith)
+        cytoband = ';'.join([str(x) for x in overlapsWith])
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+        return [len(rows), [str(self.table) + '=' + str(cytoband)]]
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(CytobandStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+class CnvStage(OverlapStage):
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        rows = self.fetchone(chr, pos)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+        if rows is None:
+            return [0, []]
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+        isOverlap = True
+        return [1, [str(self.table) + '=' + str(isOverlap)]]
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStage(CnvStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class MiRNAStage(OverlapStage):
+    def __init__(self, format='vcf', table='targetScanS', engine='sql'):
+        OverlapStage.__init__(self, format=format, table=table, engine=engine)
+        self.label = 'miRNA'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    def lookup(self, variant):
+        chr = self.getChrom(variant)
+        pos = variant.pos
+        rows = self.fetchone(chr, pos)
 
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+        if rows is None:
+            return [0, []]
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+        t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+            str(rows[2]) + '_' + str(rows[3])
+        t = 'miRNAsites=' + t.strip()
+        return [1, [t]]
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
 
-### EOF
\ No newline at end of file
+    runStage(MiRNAStage(format=format, table=table, engine=engine),
+        vcf + tmpextin, vcf + tmpextout, vcf + '.count.log', sep=sep)
@@ -1,7 +1,10 @@
 import boto3
 import json
 import os
-import subprocess
+import threading
+import time
+import run
+import workers
 from decimal import Decimal
 from configparser import SafeConfigParser
 
@@ -10,13 +13,215 @@ from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read('ann_config.ini')
 
-# Initialize SQS client
-# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html
-sqs_client = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+# SQS client, job slots, worker pool and job queues, set up when the
+# annotator starts
+sqs_client = None
+max_jobs = 0
+pool = None
+queues = []
 
 # Set download directory
 download_dir = os.getcwd() + '/downloads'
 
+# Maximum number of annotation jobs run at the same time: MaxConcurrentJobs,
+# or if that is 0 one per AnnotationShards cores (a job runs a process per
+# shard), as long as each shard can have JobMemoryMB of the memory available
+# when the annotator starts
+def get_max_jobs():
+    max_jobs = int(config['ann']['MaxConcurrentJobs'])
+    if max_jobs > 0:
+        return max_jobs
+
+    shards = max(1, int(config['ann']['AnnotationShards']))
+    max_jobs = (os.cpu_count() or 1) // shards
+    try:
+        job_memory = int(config['ann']['JobMemoryMB']) * 1024 * 1024 * shards
+        max_jobs = min(max_jobs, get_available_memory() // job_memory)
+    except (ValueError, OSError) as e:
+        print(f"Available memory unknown, limiting jobs by cores only: {e}")
+    return max(1, max_jobs)
+
+# Memory available for new processes, in bytes: MemAvailable, which unlike
+# the free pages counts the page cache the kernel can reclaim
+# Reference: https://www.kernel.org/doc/html/latest/filesystems/proc.html#meminfo
+def get_available_memory(path='/proc/meminfo'):
+    with open(path) as meminfo:
+        for line in meminfo:
+            fields = line.split()
+            if len(fields) > 1 and fields[0] == 'MemAvailable:':
+                return int(fields[1]) * 1024
+    raise ValueError("no MemAvailable in /proc/meminfo")
+
+# Set up a worker process once: its AWS clients, variant cache and reference
+# snapshot stay open for all the jobs it runs
+def init_worker():
+    run.init_clients()
+    snapshot = run.open_reference_snapshot()
+    return [run.open_variant_cache(snapshot), snapshot]
+
+# Close the variant cache of a worker process that is ending
+def exit_worker(state):
+    (cache, snapshot) = state
+    if cache is not None:
+        cache.close()
+
+# A snapshot published while the worker runs is picked up by its next job
+def run_job(state, download_path, job_id, s3_key_input_file,
+    s3_inputs_bucket=None):
+    (cache, snapshot) = state
+    snapshot = run.refresh_reference_snapshot(snapshot, cache=cache)
+    state[1] = snapshot
+    run.process_job(download_path, job_id, s3_key_input_file, cache=cache,
+        snapshot=snapshot, s3_inputs_bucket=s3_inputs_bucket)
+
+# SQS messages of the jobs running, by job ID: [receipt handle, time its
+# visibility was last extended, queue URL]. A message is held while its job
+# runs and deleted only once the job has completed
+held_messages = {}
+
+# (queue URL, receipt handle) of the messages of completed jobs, not
+# deleted yet
+completed_messages = []
+
+# Messages are received invisible for VisibilityTimeoutSeconds and their
+# visibility is extended every HeartbeatSeconds. The main loop can go
+# without a heartbeat for HeartbeatSeconds plus a long poll, so that must
+# leave a good margin before the messages would become visible again
+def check_heartbeat_config():
+    heartbeat = float(config['ann']['HeartbeatSeconds'])
+    longest_gap = heartbeat + float(config['ann']['PollWaitSeconds'])
+    timeout = int(config['ann']['VisibilityTimeoutSeconds'])
+    if heartbeat <= 0 or longest_gap > timeout / 2:
+        raise ValueError(f"HeartbeatSeconds ({heartbeat}) plus " + \
+            f"PollWaitSeconds must be under half of " + \
+            f"VisibilityTimeoutSeconds ({timeout})")
+
+# Only one thread sends heartbeats at a time; the transfer threads of a
+# download send them too
+heartbeat_lock = threading.Lock()
+
+# Keep the messages of the jobs held here invisible to other annotators by
+# extending their visibility timeout every HeartbeatSeconds
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+def extend_visibility(*args):
+    if not heartbeat_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        for (job_id, held) in list(held_messages.items()):
+            if now - held[1] < float(config['ann']['HeartbeatSeconds']):
+                continue
+            try:
+                sqs_client.change_message_visibility(
+                    QueueUrl=held[2],
+                    ReceiptHandle=held[0],
+                    VisibilityTimeout=int(config['ann']['VisibilityTimeoutSeconds'])
+                )
+                held[1] = now
+            except Exception as e:
+                print(f"Failed to extend the visibility of job {job_id}: {e}")
+    finally:
+        heartbeat_lock.release()
+
+# Delete the messages of the completed jobs, up to 10 per request
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message_batch.html
+def delete_completed_messages():
+    while len(completed_messages) > 0:
+        queue_url = completed_messages[0][0]
+        batch = [receipt_handle for (url, receipt_handle)
+            in completed_messages if url == queue_url][:10]
+        for receipt_handle in batch:
+            completed_messages.remove((queue_url, receipt_handle))
+        try:
+            response = sqs_client.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': receipt_handle}
+                    for (i, receipt_handle) in enumerate(batch)]
+            )
+            for failed in response.get('Failed', []):
+                print(f"Failed to delete message: {failed['Message']}")
+            print(f"Deleted {len(response.get('Successful', []))} messages.")
+        except Exception as e:
+            print(f"Failed to delete messages: {e}")
+
+# Log the jobs that have finished and return the number still running. The
+# message of a completed job is queued for deletion; that of a failed job is
+# released and becomes visible again once its visibility timeout lapses, so
+# the job is retried (and, with a redrive policy, eventually dead-lettered)
+def reap_jobs():
+    for (job_id, succeeded) in pool.reap():
+        print(f"Job {job_id} " + ("completed" if succeeded else "failed"))
+        held = held_messages.pop(job_id, None)
+        if succeeded and held is not None:
+            completed_messages.append((held[2], held[0]))
+    return pool.busy()
+
+# Job queues, polled by weighted fair (stride) scheduling: while both have
+# jobs waiting, premium jobs get PremiumWeight job slots for every
+# FreeWeight that free jobs get, so free jobs keep a share however many
+# premium jobs are waiting. Free jobs never take the last
+# ReservedPremiumSlots slots, so that a premium job can start at once
+# under any free tier load; the reservation is clamped to leave free jobs
+# one slot, and the free queue is not polled if it has none. Without
+# PremiumSqsQueueURL, all jobs come from SqsQueueURL in order
+def get_queues():
+    if not config['aws']['PremiumSqsQueueURL']:
+        return [{'name': 'jobs', 'url': config['aws']['SqsQueueURL'],
+            'weight': 1.0, 'max_jobs': max_jobs, 'pass': 0.0,
+            'waiting': False}]
+    reserved = int(config['ann']['ReservedPremiumSlots'])
+    free_max_jobs = max_jobs - min(reserved, max_jobs - 1)
+    queues = [{'name': 'premium', 'url': config['aws']['PremiumSqsQueueURL'],
+        'weight': float(config['ann']['PremiumWeight']),
+        'max_jobs': max_jobs, 'pass': 0.0, 'waiting': False}]
+    if free_max_jobs > 0:
+        queues.append({'name': 'free', 'url': config['aws']['SqsQueueURL'],
+            'weight': float(config['ann']['FreeWeight']),
+            'max_jobs': free_max_jobs, 'pass': 0.0, 'waiting': False})
+    return queues
+
+# Number of job slots a queue can take now
+def get_queue_slots(queue, free_slots):
+    running = len([held for held in held_messages.values()
+        if held[2] == queue['url']])
+    return min(free_slots, queue['max_jobs'] - running, 10)
+
+# Receive up to free_slots messages from the queue whose turn it is, long
+# polling it for up to PollWaitSeconds unless another queue had jobs
+# waiting when it was last polled, which are then not held up behind the
+# long poll. A queue that has nothing waiting gives up its turn: it is
+# charged as if it had just run a job after the last of the other queues,
+# so it does not bank turns to use in a burst later and, while no jobs are
+# waiting anywhere, the queues are long polled in turn. Returns
+# (queue, messages)
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
+def receive_messages(free_slots):
+    ready = [queue for queue in queues
+        if get_queue_slots(queue, free_slots) > 0]
+    if len(ready) == 0:
+        time.sleep(float(config['ann']['PollWaitSeconds']))
+        return (queues[0], [])
+
+    queue = min(ready, key=lambda queue: queue['pass'])
+    others_waiting = any([other['waiting'] for other in ready
+        if other is not queue])
+    response = sqs_client.receive_message(
+        QueueUrl=queue['url'],
+        AttributeNames=['All'],
+        VisibilityTimeout=int(config['ann']['VisibilityTimeoutSeconds']),
+        MaxNumberOfMessages=get_queue_slots(queue, free_slots),
+        WaitTimeSeconds=0 if others_waiting else \
+            int(config['ann']['PollWaitSeconds'])
+    )
+    messages = response.get('Messages', [])
+    queue['waiting'] = len(messages) > 0
+    if len(messages) > 0:
+        queue['pass'] = queue['pass'] + len(messages) / queue['weight']
+    else:
+        queue['pass'] = max([other['pass'] for other in queues]) + \
+            1.0 / queue['weight']
+    return (queue, messages)
+
 def update_item(job_id):
     # Update job status to 'RUNNING' in DynamoDB if currently 'PENDING'
     dynamodb = boto3.resource('dynamodb')
@@ -38,58 +243,89 @@ def update_item(job_id):
         )
         print(response)
 
-while True:
-    # Receive messages from SQS queue
-    # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
-    response = sqs_client.receive_message(
-        QueueUrl=config['aws']['SqsQueueURL'],
-        AttributeNames=['All'],
-        MaxNumberOfMessages=10,
-        WaitTimeSeconds=20
-    )
+# Hold the messages received from queue at received_time, and return the
+# jobs they start. A job already running here whose message was delivered
+# again is not started twice: only the latest receipt handle can extend or
+# delete its message
+def hold_messages(queue, messages, received_time):
+    jobs = []
+    for message in messages:
+        print("Received Message.")
+        data = json.loads(json.loads(message['Body'])['Message'])
+        if data['job_id'] in held_messages:
+            held_messages[data['job_id']][0] = message['ReceiptHandle']
+            continue
+        held_messages[data['job_id']] = [message['ReceiptHandle'],
+            received_time, queue['url']]
+        jobs.append(data)
+    return jobs
 
-    # Check if messages are received
-    if 'Messages' in response:
-        for message in response['Messages']:
-            print("Received Message.")
-            data = json.loads(json.loads(message['Body'])['Message'])
-
-            # Create download directory if it does not exist
-            # Reference: https://docs.python.org/3/library/os.html
-            if not os.path.exists(download_dir):
-                os.makedirs(download_dir)
-            download_path = download_dir + '/' + data['input_file_name']
-            s3_client = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
-
-            # Download file from S3
-            # Reference: https://boto3.amazonaws.com/v1/documentation/api/1.26.94/reference/services/s3/client/download_file.html
-            try:
-                s3_client.download_file(
-                    data['s3_inputs_bucket'],
-                    data['s3_key_input_file'],
-                    download_path
-                )
-            except Exception as e:
-                print("error: Failed to download file from S3")
-                print("details: " + str(e))
-            
-            # Update job status and process the file
-            try:
-                update_item(data['job_id'])
-                subprocess.Popen([
-                    "python",
-                    os.getcwd() + "/run.py",
-                    download_path,
-                    data['job_id'],
-                    data['s3_key_input_file']
-                ])
-            except Exception as e:
-                print("Processing file failed")
-                print("details: " + str(e))
-            
-            # Delete the processed message from SQS queue
-            sqs_client.delete_message(
-                QueueUrl=config['aws']['SqsQueueURL'],
-                ReceiptHandle=message['ReceiptHandle']
+# Download the input of a held job and submit it to the worker pool. If
+# either fails the message is released, so the job is retried
+def start_job(data):
+    # Create download directory if it does not exist
+    # Reference: https://docs.python.org/3/library/os.html
+    if not os.path.exists(download_dir):
+        os.makedirs(download_dir)
+    download_path = download_dir + '/' + data['input_file_name']
+    s3_client = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+
+    try:
+        # Download file from S3, unless the job streams it from there
+        # Reference: https://boto3.amazonaws.com/v1/documentation/api/1.26.94/reference/services/s3/client/download_file.html
+        stream_bucket = None
+        if config.getboolean('ann', 'StreamInput'):
+            stream_bucket = data['s3_inputs_bucket']
+        else:
+            s3_client.download_file(
+                data['s3_inputs_bucket'],
+                data['s3_key_input_file'],
+                download_path,
+                Callback=extend_visibility
             )
-            print("Deleted Message.")
\ No newline at end of file
+
+        # Update job status and process the file
+        update_item(data['job_id'])
+        pool.submit(data['job_id'], download_path, data['job_id'],
+            data['s3_key_input_file'], stream_bucket)
+    except Exception as e:
+        held_messages.pop(data['job_id'], None)
+        print("Processing file failed")
+        print("details: " + str(e))
+
+if __name__ == '__main__':
+    # Initialize SQS client
+    # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html
+    sqs_client = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+
+    check_heartbeat_config()
+
+    max_jobs = get_max_jobs()
+    print(f"Running at most {max_jobs} annotation jobs at a time")
+
+    # Workers are forked with run.py and its dependencies already imported and
+    # replaced after WorkerMaxJobs jobs or once they reach WorkerMaxMemoryMB
+    pool = workers.WorkerPool(max_jobs, run_job, init=init_worker,
+        exit=exit_worker,
+        max_jobs=int(config['ann']['WorkerMaxJobs']),
+        max_rss_mb=int(config['ann']['WorkerMaxMemoryMB']))
+
+    queues = get_queues()
+
+    while True:
+        # While every job slot is taken, leave the messages in SQS for other
+        # annotator instances instead of receiving them
+        free_slots = max_jobs - reap_jobs()
+        delete_completed_messages()
+        extend_visibility()
+        if free_slots <= 0:
+            pool.wait(timeout=float(config['ann']['HeartbeatSeconds']))
+            continue
+
+        # Receive messages from SQS, no more than there are free slots
+        (queue, messages) = receive_messages(free_slots)
+
+        # Hold every message received before downloading any input, so that
+        # all of them keep getting heartbeats while the others download
+        for data in hold_messages(queue, messages, time.time()):
+            start_job(data)
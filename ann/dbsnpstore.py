@@ -0,0 +1,256 @@
+# dbsnpstore.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Local memory-mapped dbSNP store with a Bloom filter in front of it
+#
+# Usage:
+#   python dbsnpstore.py build <store dir> [version] [false positive rate]
+#   python dbsnpstore.py verify <store dir> [version]
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import sys
+import os
+import hashlib
+import json
+import math
+import shutil
+import time
+import numpy as np
+
+import snapshot as snap
+import utils as u
+
+# False positive rate the Bloom filter is sized for by default
+BLOOM_FP_RATE = 0.01
+
+MASK64 = (1 << 64) - 1
+
+# Columns kept per dbSNP row: the key, the variant class the passes filter
+# on and the two values they report, as the strings they write out
+COLUMNS = ['REF', 'INFO', 'rsid', 'gmaf']
+
+
+"""The two 64 bit hashes of a (chrom, pos, REF) key the Bloom filter
+   probes are derived from
+"""
+def hashKey(chrom, pos, ref):
+    digest = hashlib.blake2b((str(chrom) + ':' + str(int(pos)) + ':' + \
+        str(ref).upper()).encode('utf-8'), digest_size=16).digest()
+    return (int.from_bytes(digest[:8], 'little'),
+        int.from_bytes(digest[8:], 'little') | 1)
+
+
+"""Bloom filter over the (chrom, pos, REF) keys of dbSNP, held as a
+   memory-mapped bit array of nbits bits probed nhashes times per key
+"""
+class BloomFilter(object):
+    def __init__(self, bits, nbits, nhashes):
+        self.bits = bits
+        self.nbits = nbits
+        self.nhashes = nhashes
+
+    # Bits and probes per key for n keys at false positive rate fpRate
+    @staticmethod
+    def size(n, fpRate):
+        n = max(1, n)
+        nbits = int(math.ceil(-n * math.log(fpRate) / (math.log(2) ** 2)))
+        nhashes = max(1, int(round(nbits / float(n) * math.log(2))))
+        return (max(8, nbits), nhashes)
+
+    def add(self, keys):
+        if (len(keys) == 0):
+            return
+        hashes = np.array([hashKey(chrom, pos, ref) for (chrom, pos, ref)
+            in keys], dtype=np.uint64)
+        (h1, h2) = (hashes[:, 0], hashes[:, 1])
+        for i in range(self.nhashes):
+            # uint64 arithmetic wraps like the & MASK64 of mayContain()
+            bit = (h1 + np.uint64(i) * h2) % np.uint64(self.nbits)
+            np.bitwise_or.at(self.bits, (bit >> np.uint64(3)).astype(np.int64),
+                np.left_shift(1, (bit & np.uint64(7)).astype(np.uint8)).astype(
+                np.uint8))
+
+    def mayContain(self, chrom, pos, ref):
+        (h1, h2) = hashKey(chrom, pos, ref)
+        for i in range(self.nhashes):
+            bit = ((h1 + i * h2) & MASK64) % self.nbits
+            if not (self.bits[bit >> 3] & (1 << (bit & 7))):
+                return False
+        return True
+
+
+"""Exports the dbSNP table into <path>/<version>, one directory per
+   chromosome with the rows sorted by POS (table order within a position),
+   and makes it the current store
+"""
+def build(path, version=None, fpRate=BLOOM_FP_RATE):
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S')
+
+    tmpdir = os.path.join(path, version + '.tmp')
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from dbSNP;')
+    total = int(cursor.fetchone()[0])
+    (nbits, nhashes) = BloomFilter.size(total, fpRate)
+    bloom = BloomFilter(np.zeros((nbits + 7) // 8, dtype=np.uint8), nbits,
+        nhashes)
+
+    cursor.execute('select distinct CHR from dbSNP;')
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()
+        if row[0] is not None])
+
+    manifest = {'version': version, 'created': int(time.time()),
+        'rows': total, 'fpRate': fpRate, 'nbits': nbits, 'nhashes': nhashes,
+        'chroms': {}, 'checksums': {}}
+    files = []
+    for chrom in chroms:
+        cursor.execute('select * from dbSNP where CHR="' + chrom + '";')
+        rows = cursor.fetchall()
+        names = [str(d[0]).upper() for d in cursor.description]
+        pi = names.index('POS')
+        ri = names.index('REF')
+        ii = names.index('INFO')
+
+        positions = np.array([int(row[pi]) for row in rows], dtype=np.int64)
+        order = np.argsort(positions, kind='stable').tolist()
+        rows = [rows[i] for i in order]
+        bloom.add([(chrom, row[pi], row[ri]) for row in rows])
+
+        partdir = os.path.join(tmpdir, chrom)
+        os.makedirs(partdir)
+        np.save(os.path.join(partdir, 'pos.npy'), positions[order])
+        files.append(os.path.join(partdir, 'pos.npy'))
+        values = [[str(row[ri]).upper() for row in rows],
+            [str(row[ii]).upper() for row in rows],
+            [str(row[3]) for row in rows], [str(row[7]) for row in rows]]
+        for (name, column) in zip(COLUMNS, values):
+            files = files + snap.writeColumn(os.path.join(partdir, name),
+                'str', column)
+        manifest['chroms'][chrom] = len(rows)
+
+    conn.close()
+
+    np.save(os.path.join(tmpdir, 'bloom.npy'), bloom.bits)
+    files.append(os.path.join(tmpdir, 'bloom.npy'))
+    for f in files:
+        manifest['checksums'][os.path.relpath(f, tmpdir)] = snap.checksum(f)
+    with open(os.path.join(tmpdir, snap.MANIFEST), 'w') as fh:
+        json.dump(manifest, fh)
+    os.rename(tmpdir, os.path.join(path, version))
+
+    with open(os.path.join(path, snap.CURRENT + '.tmp'), 'w') as fh:
+        fh.write(version + '\n')
+    os.replace(os.path.join(path, snap.CURRENT + '.tmp'),
+        os.path.join(path, snap.CURRENT))
+    print(f"dbSNP: {total} rows in {len(chroms)} chromosomes, " + \
+        f"{nbits} bit Bloom filter with {nhashes} hashes")
+    return version
+
+
+"""Checks every file of a store against the manifest checksums
+   Returns the list of missing or corrupted files
+"""
+def verify(path, version=None):
+    store = DbSnpStore(path, version=version)
+    bad = []
+    for (f, sha) in sorted(store.manifest['checksums'].items()):
+        full = os.path.join(store.root, f)
+        if not (os.path.isfile(full) and snap.checksum(full) == sha):
+            bad.append(f)
+    return bad
+
+
+"""The rows of one chromosome, sorted by POS
+"""
+class Partition(object):
+    def __init__(self, partdir):
+        self.pos = snap.loadArray(os.path.join(partdir, 'pos.npy'))
+        self.columns = [snap.Column(os.path.join(partdir, name), 'str')
+            for name in COLUMNS]
+
+    # Row numbers, in table order, of the rows at pos
+    def at(self, pos):
+        lo = int(np.searchsorted(self.pos, pos, side='left'))
+        hi = int(np.searchsorted(self.pos, pos, side='right'))
+        return range(lo, hi)
+
+
+"""A read-only dbSNP store; version defaults to the current one
+
+   getRecord() answers the dbSNP pass lookup of a variant. A variant neither
+   of whose alleles is in the Bloom filter is answered without reading the
+   store; a false positive costs one binary search of the chromosome
+"""
+class DbSnpStore(object):
+    def __init__(self, path, version=None):
+        if version is None:
+            with open(os.path.join(path, snap.CURRENT)) as fh:
+                version = fh.read().strip()
+
+        self.path = path
+        self.version = version
+        self.root = os.path.join(path, version)
+        with open(os.path.join(self.root, snap.MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        self.bloom = BloomFilter(
+            snap.loadArray(os.path.join(self.root, 'bloom.npy')),
+            self.manifest['nbits'], self.manifest['nhashes'])
+        self.partitions = {}
+
+    def partition(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.partitions:
+            self.partitions[chrom] = None
+            if chrom in self.manifest['chroms']:
+                self.partitions[chrom] = Partition(os.path.join(self.root,
+                    chrom))
+        return self.partitions[chrom]
+
+    # [rsIDs, GMAF flags] of the rows of the variant, like getDbSnpRecord()
+    # of the rows the per variant dbSNP query returns
+    def getRecord(self, chrom, pos, ref, compRef, varclass='SNV'):
+        refs = [r for r in set([str(ref).upper(), str(compRef).upper()])
+            if self.bloom.mayContain(chrom, pos, r)]
+        part = self.partition(chrom) if (len(refs) > 0) else None
+        if part is None:
+            return [[], []]
+
+        (refCol, infoCol, rsidCol, gmafCol) = part.columns
+        rsids = []
+        mafs = []
+        for i in part.at(int(pos)):
+            if (refCol.get(i) in refs and
+                infoCol.get(i) == varclass.upper()):
+                rsids.append(rsidCol.get(i))
+                if (gmafCol.get(i) != '.'):
+                    mafs.append('GMAF=' + gmafCol.get(i))
+        return [rsids, mafs]
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'build'):
+        version = build(sys.argv[2],
+            version=sys.argv[3] if (len(sys.argv) > 3) else None,
+            fpRate=float(sys.argv[4]) if (len(sys.argv) > 4) else BLOOM_FP_RATE)
+        print(f"dbSNP store {version} built in {sys.argv[2]}")
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'verify'):
+        bad = verify(sys.argv[2],
+            version=sys.argv[3] if (len(sys.argv) > 3) else None)
+        for f in bad:
+            print(f"Checksum mismatch: {f}")
+        print("dbSNP store OK" if (len(bad) == 0) else f"{len(bad)} bad files")
+        sys.exit(1 if (len(bad) > 0) else 0)
+    else:
+        print("Usage: dbsnpstore.py build|verify <store dir> [version] " + \
+            "[false positive rate]")
+
+### EOF
@@ -12,110 +12,406 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import bisect
+import heapq
+import math
+import multiprocessing as mp
 import file_utils as fu
 import annotate as ann
+import passes as ps
+import snapshot as snap
+import varcache as vc
+import vcfreader as vr
 
-def run(infile, format):
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import wait
 
-    print("Running . . .")
+"""Annotation passes, in the order they are applied to the input
+"""
+def getStages(engine='sql', batchsize=0, dbsnpstore=''):
+    return ps.getStages(format='vcf', engine=engine, batchsize=batchsize,
+        dbsnpstore=dbsnpstore)
+
+
+"""Scans infile once for the order the sweep and lazy joins of the passes
+   need (see annotate.getInputOrder) and hands it to every pass, rather
+   than have each of them scan the input for it
+"""
+def setInputOrder(stages, infile, format='vcf'):
+    if any([getattr(stage, 'engine', 'sql') in ('sweep', 'lazy')
+        for stage in stages]):
+        order = ann.getInputOrder(infile, format=format)
+        for stage in stages:
+            stage.order = order
+
+
+"""Runs every pass over infile and writes the annotated copy to outfile,
+   with the pass statistics in infile + '.count.log'
+"""
+def runStages(stages, infile, outfile, mode='chain', cache=None,
+    snapshot=None, connections=4, inflight=64, workers=4):
+    setInputOrder(stages, infile)
+    if (mode == 'fused'):
+        ann.runPipeline(stages, infile, outfile, infile + '.count.log',
+            cache=cache, snapshot=snapshot)
+        print("All passes - done.")
+        return
+
+    if (mode == 'dag'):
+        ann.runDagPipeline(stages, ps.getDependencies(), infile, outfile,
+            infile + '.count.log', cache=cache, snapshot=snapshot,
+            workers=workers)
+        print(f"All passes - done ({max(ps.getLevels())} levels).")
+        return
+
+    if (mode == 'pipe'):
+        runPipedStages(stages, infile, outfile, infile + '.count.log',
+            cache=cache, snapshot=snapshot)
+        print("All passes - done.")
+        return
+
+    if (mode == 'async'):
+        ann.runAsyncPipeline(stages, infile, outfile, infile + '.count.log',
+            cache=cache, snapshot=snapshot, connections=connections,
+            inflight=inflight)
+        print("All passes - done.")
+        return
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    tmpextin = 0
+    for stage in stages:
+        src = infile if (tmpextin == 0) else (infile + '.' + str(tmpextin))
+        ann.runStage(stage, src, infile + '.' + str(tmpextin + 1),
+            infile + '.count.log', logmode='w' if (tmpextin == 0) else 'a',
+            cache=cache, snapshot=snapshot)
+        print(f"{stage.label} - done.")
+        tmpextin = tmpextin + 1
 
     ## Cleanup
     for i in range(1, tmpextin):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    os.rename(infile + '.' + str(tmpextin), outfile)
+
+
+"""Runs one pass of a piped run in its own process: reads the lines the
+   previous pass writes to the pipe fdin (the input itself for the first
+   pass), writes its own to the pipe fdout (outfile for the last pass) and
+   sends the pass statistics back on counts. fds are all the pipe ends of
+   the run; the ones the pass does not use are closed, so each pass sees
+   the end of its input when the previous one is done
+"""
+def runPipedStage(stage, infile, fdin, fdout, outfile, counts, fds,
+    cacheArgs, snapshotArgs):
+    for fd in fds:
+        if fd not in (fdin, fdout):
+            os.close(fd)
+
+    cache = openCache(cacheArgs)
+    snapshot = None
+    if (snapshotArgs is not None):
+        snapshot = snap.Snapshot(*snapshotArgs)
+
+    fh = open(infile) if (fdin is None) else os.fdopen(fdin)
+    fh_out = open(outfile, 'w') if (fdout is None) else os.fdopen(fdout, 'w')
+    # Every pass scans the input itself when it is opened: the passes only
+    # add to the records, so it has the same variants as the pipe
+    ann.runStageLines(stage, fh, fh_out, infile, cache=cache,
+        snapshot=snapshot)
+    fh_out.close()
+    fh.close()
+
+    if (cache is not None):
+        cache.close()
+    counts.send(stage.getCounts())
+    counts.close()
+
+
+"""Runs every pass in its own process, each reading the output of the
+   previous one from a pipe, so that all passes work at the same time and
+   no intermediate files are written. A pass that gets ahead of the next
+   one blocks on the full pipe. If any pass fails the others are stopped,
+   the partial output is removed and RuntimeError is raised
+"""
+def runPipedStages(stages, infile, outfile, logcountfile, cache=None,
+    snapshot=None):
+    cacheArgs = None
+    if (cache is not None):
+        cacheArgs = (cache.path, cache.version, cache.max_entries)
+    snapshotArgs = None
+    if (snapshot is not None):
+        snapshotArgs = (snapshot.path, snapshot.version)
+
+    tmpout = outfile + '.tmp'
+    pipes = [os.pipe() for i in range(len(stages) - 1)]
+    fds = [fd for pipe in pipes for fd in pipe]
+    fdins = [None] + [fdin for (fdin, fdout) in pipes]
+    fdouts = [fdout for (fdin, fdout) in pipes] + [None]
+
+    context = mp.get_context('fork')
+    procs = []
+    receivers = []
+    failed = None
+    try:
+        for (i, stage) in enumerate(stages):
+            (receiver, sender) = context.Pipe(duplex=False)
+            proc = context.Process(target=runPipedStage, args=(stage, infile,
+                fdins[i], fdouts[i], tmpout, sender, fds, cacheArgs,
+                snapshotArgs))
+            proc.start()
+            sender.close()
+            procs.append(proc)
+            receivers.append(receiver)
+        for fd in fds:
+            os.close(fd)
+        fds = []
+
+        running = list(procs)
+        while (len(running) > 0 and failed is None):
+            ready = wait([proc.sentinel for proc in running])
+            for proc in [proc for proc in running if proc.sentinel in ready]:
+                proc.join()
+                running.remove(proc)
+                if (proc.exitcode != 0 and failed is None):
+                    failed = procs.index(proc)
+    finally:
+        for fd in fds:
+            os.close(fd)
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        if (failed is not None or
+            len([proc for proc in procs if proc.exitcode != 0]) > 0):
+            fu.delete(tmpout)
+
+    if (failed is not None):
+        raise RuntimeError(f"{stages[failed].label} failed with exit " + \
+            f"code {procs[failed].exitcode}")
+
+    fh_log = open(logcountfile, 'w')
+    for (stage, receiver) in zip(stages, receivers):
+        stage.mergeCounts([receiver.recv()])
+        receiver.close()
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+    os.replace(tmpout, outfile)
+
+
+"""Splits the data lines of infile in at most shards parts of similar size
+
+   Whole chromosomes are packed into the least loaded shard, largest first;
+   a chromosome with more variants than a shard should hold is cut into
+   ranges of consecutive positions first. Returns the shard number of each
+   data line, in file order
+"""
+def planShards(infile, shards, format='vcf', sep='\t'):
+    lines = []
+    for batch in vr.readBatches(infile, format=format, sep=sep):
+        lines.extend(zip(batch.getChroms(), batch.pos.tolist()))
+    if (len(lines) == 0):
+        return []
+    target = int(math.ceil(len(lines) / float(shards)))
+
+    positions = {}
+    for (chrom, pos) in lines:
+        positions.setdefault(chrom, []).append(pos)
+
+    # Each piece is (size, chrom, first position past the piece)
+    pieces = []
+    cuts = {}
+    for (chrom, chromPositions) in positions.items():
+        chromPositions.sort()
+        bounds = []
+        for i in range(target, len(chromPositions), target):
+            if (len(bounds) == 0 or chromPositions[i] > bounds[-1]):
+                bounds.append(chromPositions[i])
+        cuts[chrom] = bounds
+        lo = 0
+        for bound in bounds + [None]:
+            hi = len(chromPositions) if (bound is None) else \
+                bisect.bisect_left(chromPositions, bound)
+            pieces.append((hi - lo, chrom, bound))
+            lo = hi
+
+    loads = [(0, shard) for shard in range(0, shards)]
+    owner = {}
+    for (size, chrom, bound) in sorted(pieces, key=lambda p: -p[0]):
+        (load, shard) = heapq.heappop(loads)
+        owner[(chrom, bound)] = shard
+        heapq.heappush(loads, (load + size, shard))
+
+    plan = []
+    for (chrom, pos) in lines:
+        bounds = cuts[chrom]
+        i = bisect.bisect_right(bounds, pos)
+        plan.append(owner[(chrom, bounds[i] if (i < len(bounds)) else None)])
+    return plan
+
+
+"""Opens the variant cache of a worker process from the (path, version,
+   max_entries) of the cache of the run, or None to annotate without it if
+   it cannot be opened, e.g. while another process has the file locked
+"""
+def openCache(cacheArgs):
+    if (cacheArgs is None):
+        return None
+    try:
+        return vc.VariantCache(*cacheArgs)
+    except Exception as e:
+        print(f"Variant cache unavailable, annotating without it: {e}")
+        return None
+
+
+"""Annotates one shard in a worker process and returns the statistics of
+   each pass
+"""
+def annotateShard(shardfile, engine, batchsize, mode, cacheArgs,
+    snapshotArgs, connections, inflight, workers, dbsnpstore):
+    cache = openCache(cacheArgs)
+    snapshot = None
+    if (snapshotArgs is not None):
+        snapshot = snap.Snapshot(*snapshotArgs)
+
+    stages = getStages(engine=engine, batchsize=batchsize,
+        dbsnpstore=dbsnpstore)
+    runStages(stages, shardfile, shardfile + '.annot', mode=mode, cache=cache,
+        snapshot=snapshot, connections=connections, inflight=inflight,
+        workers=workers)
+
+    if (cache is not None):
+        cache.close()
+    return [stage.getCounts() for stage in stages]
+
+
+"""Annotates infile in shards on a pool of worker processes, then puts the
+   annotated lines back in input order and merges the pass statistics, so
+   the output and the count log are the same as those of a serial run
+"""
+def runSharded(infile, outfile, shards, format='vcf', engine='sql',
+    batchsize=0, mode='chain', cache=None, snapshot=None, connections=4,
+    inflight=64, workers=4, dbsnpstore='', sep='\t'):
+
+    plan = planShards(infile, shards, format=format, sep=sep)
+    used = sorted(set(plan))
+    shardfiles = dict([(shard, infile + '.shard' + str(shard))
+        for shard in used])
+
+    fh_shards = dict([(shard, open(shardfiles[shard], 'w')) for shard in used])
+    lineno = 0
+    for line in open(infile):
+        if not ann.isHeaderLine(line.strip()):
+            fh_shards[plan[lineno]].write(line)
+            lineno = lineno + 1
+    for fh in fh_shards.values():
+        fh.close()
+
+    cacheArgs = None
+    if (cache is not None):
+        cacheArgs = (cache.path, cache.version, cache.max_entries)
+    snapshotArgs = None
+    if (snapshot is not None):
+        snapshotArgs = (snapshot.path, snapshot.version)
+
+    with ProcessPoolExecutor(max_workers=max(1, min(len(used), os.cpu_count()))) as pool:
+        futures = dict([(shard, pool.submit(annotateShard, shardfiles[shard],
+            engine, batchsize, mode, cacheArgs, snapshotArgs, connections,
+            inflight, workers, dbsnpstore))
+            for shard in used])
+        shardCounts = dict([(shard, futures[shard].result())
+            for shard in used])
+
+    fh_out = open(outfile, 'w')
+    fh_annotated = dict([(shard, open(shardfiles[shard] + '.annot'))
+        for shard in used])
+    lineno = 0
+    for line in open(infile):
+        line = line.strip()
+        if ann.isHeaderLine(line):
+            fh_out.write(line + '\n')
+        else:
+            fh_out.write(fh_annotated[plan[lineno]].readline())
+            lineno = lineno + 1
+    fh_out.close()
+
+    stages = getStages(engine=engine, batchsize=batchsize,
+        dbsnpstore=dbsnpstore)
+    fh_log = open(infile + '.count.log', 'w')
+    for (i, stage) in enumerate(stages):
+        stage.mergeCounts([shardCounts[shard][i] for shard in used])
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+    ## Cleanup
+    for shard in used:
+        fh_annotated[shard].close()
+        fu.delete(shardfiles[shard])
+        fu.delete(shardfiles[shard] + '.annot')
+        fu.delete(shardfiles[shard] + '.count.log')
+
+
+"""Annotates the input lines read from the open stream fh as they arrive,
+   e.g. an S3 object opened with s3stream.open_s3(), with all passes fused
+   in a single sweep. infile is the local path the input would have: the
+   result and the count log are written next to it as by run(), but the
+   input itself is never stored; only the block of it being annotated is
+   spooled to disk, for the passes to resolve its lookups in batches (see
+   annotate.runPipeline). The sweep engine needs the whole input sorted, so
+   it joins a stream lazily, one chromosome at a time
+"""
+def runStream(fh, infile, engine='sql', batchsize=0, cache=None,
+    snapshot=None, dbsnpstore=''):
+
+    print("Running . . .")
+
+    finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    stages = getStages(engine=engine, batchsize=batchsize,
+        dbsnpstore=dbsnpstore)
+    ann.runPipeline(stages, None, finalout, infile + '.count.log',
+        cache=cache, snapshot=snapshot, fh=fh)
+    print("All passes - done.")
+
+
+"""Annotates infile and writes the result next to it as .annot.vcf
+
+   mode='chain' runs each pass over the whole file in turn, passing the
+   results on through numbered temp files; mode='fused' parses the input
+   once, applies every pass to each record in memory and writes the
+   output once; mode='async' works like 'fused' but resolves the lookups
+   of up to inflight records concurrently over connections database
+   connections; mode='dag' resolves the lookups of passes that do not
+   depend on each other (see passes.py) at the same time on workers threads;
+   mode='pipe' runs each pass in its own process, connected to the next
+   one by a pipe
+   cache is an optional varcache.VariantCache the passes consult before
+   querying the reference database, and snapshot an optional
+   snapshot.Snapshot they read the reference tables it has from
+   dbsnpstore is the path of a local dbSNP store (see dbsnpstore.py) the
+   dbSNP pass looks variants up in instead of querying dbSNP
+   shards > 1 splits the input by chromosome (and position range, for
+   chromosomes too large for one shard) and annotates the shards in
+   parallel worker processes
+"""
+def run(infile, format, engine='sql', batchsize=0, mode='chain', cache=None,
+    shards=1, snapshot=None, connections=4, inflight=64, workers=4,
+    dbsnpstore=''):
+
+    print("Running . . .")
+
+    finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+
+    if (shards > 1):
+        runSharded(infile, finalout, shards, format=format, engine=engine,
+            batchsize=batchsize, mode=mode, cache=cache, snapshot=snapshot,
+            connections=connections, inflight=inflight, workers=workers,
+            dbsnpstore=dbsnpstore)
+        print("All shards - done.")
+        return
+
+    stages = getStages(engine=engine, batchsize=batchsize,
+        dbsnpstore=dbsnpstore)
+    runStages(stages, infile, finalout, mode=mode, cache=cache,
+        snapshot=snapshot, connections=connections, inflight=inflight,
+        workers=workers)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,349 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Interval overlap joins used by the annotate.py overlap passes
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import collections
+import heapq
+import numpy as np
+import pymysql
+
+
+# Ratio between the longest intervals of consecutive levels of an
+# IntervalIndex
+LEVEL_FACTOR = 4
+
+# Candidate (position, interval) pairs an IntervalIndex query expands at a
+# time, bounding its memory use whatever the number of positions
+MAX_CANDIDATES = 1 << 22
+
+
+"""Groups intervals in levels by length, as IntervalIndex does
+   Returns one (starts, ends, rowids, maxLength) tuple per non-empty level,
+   sorted by start, rowids being the positions of the intervals in the input
+"""
+def getLevels(starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lengths = np.maximum(ends - starts, 0)
+    levels = np.ceil(np.log(np.maximum(lengths, 1)) /
+        np.log(LEVEL_FACTOR)).astype(np.int64)
+
+    result = []
+    for level in np.unique(levels):
+        rowids = np.flatnonzero(levels == level)
+        rowids = rowids[np.argsort(starts[rowids], kind='stable')]
+        result.append((starts[rowids], ends[rowids], rowids,
+            int(lengths[rowids].max())))
+    return result
+
+
+"""Sorted start/end arrays for the intervals of one chromosome
+
+   Intervals are grouped in levels by length, level k holding those no
+   longer than LEVEL_FACTOR ** k, and kept sorted by start within each
+   level. An interval of a level whose longest interval has length L can
+   only contain pos if it starts in [pos - L, pos], so the candidates for
+   a position are one contiguous slice per level, and a long interval does
+   not widen the slices of the short ones. Candidates that do not contain
+   pos are at most about LEVEL_FACTOR times the intervals that do, as with
+   UCSC bins. Rows are returned in the order they were loaded (i.e. table
+   order), which is the order the equivalent per-variant SELECT returns
+   them in.
+"""
+class IntervalIndex(object):
+    def __init__(self, starts, ends, payload):
+        self.payload = payload
+        self.levels = getLevels(starts, ends)
+
+    def __len__(self):
+        return len(self.payload)
+
+    # [lo, hi) slice of the candidates of every position in each level
+    def getCandidates(self, positions):
+        return [(np.searchsorted(starts, positions - maxLength, side='left'),
+            np.searchsorted(starts, positions, side='right'))
+            for (starts, ends, rowids, maxLength) in self.levels]
+
+    # Returns, for every position, the list of payload rows whose
+    # closed interval [start, end] contains it
+    def query(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        npos = len(positions)
+        if (len(self.payload) == 0 or npos == 0):
+            return [[] for i in range(npos)]
+
+        qidxs = []
+        hits = []
+        for ((starts, ends, rowids, maxLength), (lo, hi)) in zip(self.levels,
+            self.getCandidates(positions)):
+            counts = hi - lo
+            # Positions are expanded in chunks of at most MAX_CANDIDATES
+            # pairs (or a single position, if it has more)
+            total = np.cumsum(counts)
+            first = 0
+            while (first < npos):
+                base = total[first - 1] if (first > 0) else 0
+                last = max(first + 1, int(np.searchsorted(total,
+                    base + MAX_CANDIDATES, side='right')))
+                (qidx, rows) = self.expand(positions, ends, rowids,
+                    lo[first:last], counts[first:last], first)
+                qidxs.append(qidx)
+                hits.append(rows)
+                first = last
+
+        qidx = np.concatenate(qidxs)
+        rowids = np.concatenate(hits)
+        order = np.lexsort((rowids, qidx))
+        qidx = qidx[order]
+        rowids = rowids[order]
+        bounds = np.searchsorted(qidx, np.arange(npos + 1), side='left')
+
+        payload = self.payload
+        return [[payload[r] for r in rowids[bounds[i]:bounds[i + 1]]]
+            for i in range(npos)]
+
+    # Expands the [lo, lo + count) candidate slices of the positions from
+    # first on into (query, interval) pairs and keeps those that overlap
+    def expand(self, positions, ends, rowids, lo, counts, first):
+        qidx = np.repeat(np.arange(first, first + len(lo)), counts)
+        offsets = np.arange(len(qidx)) - np.repeat(np.cumsum(counts) - counts,
+            counts)
+        cand = np.repeat(lo, counts) + offsets
+
+        hit = ends[cand] >= positions[qidx]
+        return (qidx[hit], rowids[cand[hit]])
+
+
+"""Loads the rows of one chromosome of a reference table into an IntervalIndex
+   startCol and endCol name the columns holding the closed interval bounds;
+   chromCol=None loads the whole table, for tables holding one chromosome
+"""
+def loadChromIndex(cursor, table, chrom, chromCol='chrom',
+    startCol='chromStart', endCol='chromEnd', columns='*'):
+
+    sql = 'select ' + columns + ' from ' + table + ';'
+    if chromCol is not None:
+        sql = 'select ' + columns + ' from ' + table + ' where ' + \
+            chromCol + '="' + str(chrom) + '";'
+    cursor.execute(sql)
+    rows = cursor.fetchall()
+
+    names = [str(d[0]) for d in cursor.description]
+    si = names.index(startCol)
+    ei = names.index(endCol)
+
+    return IntervalIndex(
+        starts=[int(row[si]) for row in rows],
+        ends=[int(row[ei]) for row in rows],
+        payload=list(rows))
+
+
+"""Interval indexes of a reference table loaded one chromosome at a time
+
+   A chromosome is loaded with load(chrom) the first time it is looked up,
+   and the least recently used one is evicted once more than keep are
+   loaded. For input grouped by chromosome, keep=1 bounds memory by the
+   largest chromosome of the table and loads each chromosome once. Lookups
+   are expected on one thread, in input order
+"""
+class ChromCache(object):
+    def __init__(self, load, keep=1):
+        self.load = load
+        self.keep = keep
+        self.indexes = collections.OrderedDict()
+        self.loads = 0
+
+    def get(self, chrom):
+        if chrom in self.indexes:
+            self.indexes.move_to_end(chrom)
+            return self.indexes[chrom]
+
+        while (len(self.indexes) >= self.keep):
+            self.indexes.popitem(last=False)
+        self.indexes[chrom] = self.load(chrom)
+        self.loads = self.loads + 1
+        return self.indexes[chrom]
+
+    def clear(self):
+        self.indexes = collections.OrderedDict()
+
+
+"""Overlap join loading a reference table one chromosome at a time through a
+   ChromCache, for inputs grouped by chromosome
+"""
+class LazyJoin(object):
+    def __init__(self, cursor, table, chromCol='chrom', startCol='chromStart',
+        endCol='chromEnd', columns='*', keep=1):
+        self.cache = ChromCache(lambda chrom: loadChromIndex(cursor, table,
+            chrom, chromCol=chromCol, startCol=startCol, endCol=endCol,
+            columns=columns), keep=keep)
+
+    def fetchall(self, chrom, pos):
+        return self.cache.get(str(chrom)).query([int(pos)])[0]
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        return rows[0] if (len(rows) > 0) else None
+
+    def close(self):
+        self.cache.clear()
+
+
+"""Resolves the overlapping reference rows for every variant of an input file
+   in one batched join per chromosome, instead of one SELECT per variant
+   prepare() may be called again for each block of a stream, after clear();
+   the last chromosome loaded is kept for the next block
+"""
+class OverlapJoin(object):
+    def __init__(self, cursor, table, chromCol='chrom', startCol='chromStart',
+        endCol='chromEnd', columns='*'):
+        self.cursor = cursor
+        self.table = table
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.columns = columns
+        self.indexes = ChromCache(self.loadIndex)
+        self.results = {}
+
+    def loadIndex(self, chrom):
+        return loadChromIndex(self.cursor, self.table, chrom,
+            chromCol=self.chromCol, startCol=self.startCol,
+            endCol=self.endCol, columns=self.columns)
+
+    # positionsByChrom maps a chromosome name, as stored in the table,
+    # to the positions to resolve on it
+    def prepare(self, positionsByChrom):
+        for chrom, positions in positionsByChrom.items():
+            positions = sorted(set(positions))
+            index = self.indexes.get(chrom)
+            for pos, rows in zip(positions, index.query(positions)):
+                self.results[(chrom, pos)] = rows
+
+    # Drops the rows resolved so far
+    def clear(self):
+        self.results = {}
+
+    def fetchall(self, chrom, pos):
+        return self.results.get((chrom, int(pos)), [])
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        return rows[0] if (len(rows) > 0) else None
+
+    def close(self):
+        self.clear()
+        self.indexes.clear()
+
+
+"""Column giving the table order of the rows of table: the rowid of an
+   SQLite table, or the primary key of a MySQL table (InnoDB clusters rows
+   by it) if it is a single column. None if there is no such column
+"""
+def getRowIdColumn(conn, table):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('select rowid from ' + table + ' limit 0;')
+        cursor.fetchall()
+        return 'rowid'
+    except Exception:
+        pass
+
+    try:
+        cursor.execute('SHOW KEYS FROM ' + table + \
+            ' WHERE Key_name = "PRIMARY";')
+        names = [str(d[0]) for d in cursor.description]
+        keys = [str(row[names.index('Column_name')])
+            for row in cursor.fetchall()]
+    except Exception:
+        return None
+    return keys[0] if (len(keys) == 1) else None
+
+
+"""Sort-merge join of coordinate sorted variants against a reference table
+
+   Rows are streamed from the server one chromosome at a time with an
+   unbuffered cursor, ordered by start, and kept in a heap keyed by end while
+   they can still overlap an upcoming position. Lookups must come in
+   non-decreasing position order within each chromosome, with every
+   chromosome visited once, so memory is bounded by the widest set of
+   simultaneously active intervals rather than by the size of the table.
+   Overlapping rows are returned in table order, the order of the row id
+   (see getRowIdColumn) they are streamed with, like those of the other
+   joins; idCol is None, and the join unusable, for tables without one.
+"""
+class SweepJoin(object):
+    def __init__(self, conn, table, chromCol='chrom', startCol='chromStart',
+        endCol='chromEnd', columns='*'):
+        self.conn = conn
+        self.table = table
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.columns = columns
+        self.cursor = None
+        self.chrom = None
+        self.active = []
+        self.next = None
+        self.idCol = getRowIdColumn(conn, table)
+
+    def startChrom(self, chrom):
+        if (self.cursor is not None):
+            self.cursor.close()
+
+        self.chrom = chrom
+        self.active = []
+        self.cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        columns = (self.table + '.*') if (self.columns == '*') else \
+            self.columns
+        sql = 'select ' + self.table + '.' + self.idCol + ', ' + columns + \
+            ' from ' + self.table + ' where ' + self.chromCol + '="' + \
+            str(chrom) + '" order by ' + self.startCol + ';'
+        self.cursor.execute(sql)
+
+        names = [str(d[0]) for d in self.cursor.description[1:]]
+        self.si = names.index(self.startCol)
+        self.ei = names.index(self.endCol)
+        self.next = self.nextRow()
+
+    # (start, end, row id, row) of the next row of the chromosome
+    def nextRow(self):
+        row = self.cursor.fetchone()
+        if (row is None):
+            return None
+        return (int(row[self.si + 1]), int(row[self.ei + 1]), row[0],
+            tuple(row[1:]))
+
+    def fetchall(self, chrom, pos):
+        pos = int(pos)
+        if (chrom != self.chrom):
+            self.startChrom(chrom)
+
+        while (self.next is not None and self.next[0] <= pos):
+            (start, end, rowid, row) = self.next
+            heapq.heappush(self.active, (end, rowid, row))
+            self.next = self.nextRow()
+
+        while (len(self.active) > 0 and self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        return [row for (end, rowid, row) in
+            sorted(self.active, key=lambda a: a[1])]
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        return rows[0] if (len(rows) > 0) else None
+
+    def close(self):
+        if (self.cursor is not None):
+            self.cursor.close()
+            self.cursor = None
+        self.conn.close()
+
+### EOF
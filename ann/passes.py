@@ -0,0 +1,77 @@
+# passes.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Registry of the annotation passes and of the passes each one depends on
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import annotate as ann
+
+# Annotation passes in canonical order, the order their records are added to
+# INFO: (name, stage class, constructor arguments, passes whose output it
+# reads). Run options named in the stage class options (engine, batchsize,
+# dbsnpstore) are added to the constructor arguments by getStages()
+PASSES = [
+    ('dbSNP', ann.DbSnpStage, {}, []),
+    ('BigRefGene', ann.BigRefGeneStage, {}, []),
+    # Counts transcripts by the positionType the bigRefGene pass wrote
+    ('refGene', ann.GenesStage, {'table': 'refGene', 'promoter_offset': 500},
+        ['BigRefGene']),
+    ('cytoBand', ann.CytobandStage, {'table': 'cytoBand'}, []),
+    ('gadAll', ann.GadAllStage, {'table': 'gadAll'}, []),
+    ('gwasCatalog', ann.GwasCatalogStage, {'table': 'gwasCatalog'}, []),
+    ('targetScanS', ann.MiRNAStage, {'table': 'targetScanS'}, []),
+    ('hugo', ann.HugoStage, {'table': 'hugo'}, []),
+    ('dgv_Cnv', ann.CnvStage, {'table': 'dgv_Cnv'}, []),
+    ('abParts_IG_T_CelReceptors', ann.CnvStage,
+        {'table': 'abParts_IG_T_CelReceptors'}, []),
+    ('mcCarroll_Cnv', ann.CnvStage, {'table': 'mcCarroll_Cnv'}, []),
+    ('conrad_Cnv', ann.CnvStage, {'table': 'conrad_Cnv'}, []),
+    ('genomicSuperDups', ann.GenomicSuperDupsStage,
+        {'table': 'genomicSuperDups'}, []),
+    ('tfbsConsSites', ann.TfbsConsSitesStage, {'table': 'tfbsConsSites'}, []),
+]
+
+
+"""Annotation passes, in canonical order
+"""
+def getStages(format='vcf', engine='sql', batchsize=0, dbsnpstore=''):
+    options = {'engine': engine, 'batchsize': batchsize,
+        'dbsnpstore': dbsnpstore}
+    stages = []
+    for (name, stageClass, args, after) in PASSES:
+        args = dict(args)
+        for option in stageClass.options:
+            args[option] = options[option]
+        stages.append(stageClass(format=format, **args))
+    return stages
+
+
+"""Positions of the passes each pass depends on, in canonical order
+   A pass may only depend on passes declared before it
+"""
+def getDependencies():
+    names = [name for (name, stageClass, args, after) in PASSES]
+    dependencies = []
+    for (i, (name, stageClass, args, after)) in enumerate(PASSES):
+        for dep in after:
+            if dep not in names[:i]:
+                raise ValueError(f"Pass {name} depends on {dep}, which is " + \
+                    "not declared before it")
+        dependencies.append([names.index(dep) for dep in after])
+    return dependencies
+
+
+"""Length of the longest dependency chain ending at each pass; passes of the
+   same level can run at the same time
+"""
+def getLevels():
+    levels = []
+    for deps in getDependencies():
+        levels.append(1 + max([levels[d] for d in deps] + [0]))
+    return levels
+
+### EOF
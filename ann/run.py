@@ -2,12 +2,26 @@ import sys
 import time
 import driver
 import os
+import snapshot
+import s3stream
+import varcache
 import boto3
 import json
 import jsonify
 
 from configparser import SafeConfigParser
 
+# Load configuration from environment variables and config file
+# Reference: https://docs.python.org/3/library/configparser.html
+config = SafeConfigParser(os.environ)
+config.read('ann_config.ini')
+
+# AWS clients, created by init_clients() once per process and reused by
+# every job it runs
+s3_client = None
+sns_client = None
+table = None
+
 """A rudimentary timer for coarse-grained profiling
 """
 class Timer(object):
@@ -25,13 +39,25 @@ class Timer(object):
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-# Upload a file to the specified S3 bucket
+# Create the AWS clients the jobs use
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html
+def init_clients():
+  global s3_client, sns_client, table
+  region = config['aws']['AwsRegionName']
+  s3_client = boto3.client('s3', region_name=region)
+  sns_client = boto3.client('sns', region_name=region)
+  table = boto3.resource('dynamodb', region_name=region).Table(
+    config['aws']['AwsDynamoDBTable'])
+
+# Upload a file to the specified S3 bucket. Errors are raised, so that the
+# job fails and its message is released for a retry
 # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
 def upload_file(bucket_name, file_path, key):
   try:
     s3_client.upload_file(file_path, bucket_name, key)
   except Exception as e:
     print(f"Error uploading file to s3: {e}")
+    raise
 
 # Delete a local file
 # Reference: https://docs.python.org/3/library/os.html#os.remove
@@ -40,9 +66,10 @@ def delete_local_file(file_path):
     os.remove(file_path)
     print(f"Deleted local file {file_path}")
   except Exception as e:
-    print("Error deleting local file: {e}")
+    print(f"Error deleting local file: {e}")
 
-# Update an item in DynamoDB with job details
+# Update an item in DynamoDB with job details. Errors are raised, as for
+# upload_file
 # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html
 def update_item(job_id, results_bucket, result_file, log_file):
   try:
@@ -70,8 +97,10 @@ def update_item(job_id, results_bucket, result_file, log_file):
     print(response)
   except Exception as e:
     print(f"Error updating item in DynamoDB: {e}")
+    raise
 
-# Publish messages to SNS topics
+# Publish messages to SNS topics. Errors are raised, as for upload_file:
+# the job is only done once its results are archived
 # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html
 def publish_messages(job_id):
   try:
@@ -106,34 +135,127 @@ def publish_messages(job_id):
       print(f"Job ID: {job_id} item not found")
   except Exception as e:
     print(f"Failed to publish SNS messages: {e}")
+    raise
 
-if __name__ == '__main__':
-  if len(sys.argv) > 1:
-    input_file_name = sys.argv[1]
-    job_id = sys.argv[2]
-    with Timer():
-      driver.run(input_file_name, 'vcf')
-      results_file = input_file_name[:-4] + '.annot.vcf'
-      log_file = input_file_name + '.count.log'
-      input_file = input_file_name
-      results_bucket = config['aws']['AwsResultsBucket']
-      results_key = sys.argv[3].split('~')[0] + '~' + results_file.split('/')[-1]
-      log_key = sys.argv[3].split('~')[0] + '~' + log_file.split('/')[-1]
-      
+# Version of the reference data the passes read: ReferenceVersion, the
+# version of the database, and that of the snapshot, if one is used
+def get_reference_version(snapshot=None):
+  version = config['ann']['ReferenceVersion']
+  if snapshot is not None:
+    version = version + ':' + snapshot.version
+  return version
+
+# Open the node-local variant annotation cache, if one is configured, keyed
+# on the version of the reference data read with snapshot
+def open_variant_cache(snapshot=None):
+  path = config['ann']['VariantCachePath']
+  if not path:
+    return None
+  try:
+    return varcache.VariantCache(path, get_reference_version(snapshot),
+      max_entries=int(config['ann']['VariantCacheMaxEntries']))
+  except Exception as e:
+    print(f"Variant cache unavailable, annotating without it: {e}")
+    return None
+
+# Open the current reference snapshot, if one is configured
+def open_reference_snapshot():
+  path = config['ann']['ReferenceSnapshotPath']
+  if not path:
+    return None
+  try:
+    return snapshot.Snapshot(path)
+  except Exception as e:
+    print(f"Reference snapshot unavailable, querying the database: {e}")
+    return None
+
+# Switch a long-lived process over to the current reference snapshot if
+# another one has been published since opened was, and key cache on its
+# version. Returns the snapshot to use
+def refresh_reference_snapshot(opened, cache=None):
+  path = config['ann']['ReferenceSnapshotPath']
+  if path:
+    try:
+      current = snapshot.getCurrentVersion(path)
+    except Exception as e:
+      print(f"Reference snapshot unavailable, querying the database: {e}")
+      current = None
+    if current is None:
+      opened = None
+    elif opened is None or opened.version != current:
+      opened = open_reference_snapshot()
+  if cache is not None:
+    cache.setVersion(get_reference_version(opened))
+  return opened
+
+# Annotate an input file, upload the results and the log and record the
+# job as completed. cache and snapshot are the variant cache and reference
+# snapshot the passes use, if any. With s3_inputs_bucket the input is read
+# from S3 as a stream instead and input_file_name, which is never written,
+# only names the result files. Any failure is raised, so that the worker
+# reports the job failed and its message is released for a retry
+def process_job(input_file_name, job_id, s3_key_input_file, cache=None,
+  snapshot=None, s3_inputs_bucket=None):
+  with Timer():
+    if s3_inputs_bucket:
+      fh = s3stream.open_s3(s3_client, s3_inputs_bucket, s3_key_input_file,
+        rangesize=int(config['ann']['StreamRangeSizeMB']) * 1024 * 1024,
+        readahead=int(config['ann']['StreamReadAhead']))
+      driver.runStream(fh, input_file_name,
+        engine=config['ann']['OverlapEngine'],
+        batchsize=int(config['ann']['LookupBatchSize']),
+        cache=cache,
+        snapshot=snapshot,
+        dbsnpstore=config['ann']['DbSnpStorePath'])
+    else:
+      driver.run(input_file_name, 'vcf',
+        engine=config['ann']['OverlapEngine'],
+        batchsize=int(config['ann']['LookupBatchSize']),
+        mode=config['ann']['PipelineMode'],
+        cache=cache,
+        shards=int(config['ann']['AnnotationShards']),
+        snapshot=snapshot,
+        connections=int(config['ann']['AsyncConnections']),
+        inflight=int(config['ann']['AsyncInFlight']),
+        workers=int(config['ann']['PassWorkers']),
+        dbsnpstore=config['ann']['DbSnpStorePath'])
+    # A worker keeps its cache open across jobs; write this job's entries,
+    # keep the file bounded and report the job's hits and misses
+    if cache is not None:
+      cache.endJob()
+    results_file = input_file_name[:-4] + '.annot.vcf'
+    log_file = input_file_name + '.count.log'
+    input_file = input_file_name
+    results_bucket = config['aws']['AwsResultsBucket']
+    results_key = s3_key_input_file.split('~')[0] + '~' + results_file.split('/')[-1]
+    log_key = s3_key_input_file.split('~')[0] + '~' + log_file.split('/')[-1]
+    
+    try:
       # Upload results and log files to S3
       upload_file(results_bucket, results_file, results_key)
       upload_file(results_bucket, log_file, log_key)
       
       # Update DynamoDB with job details
       update_item(job_id, results_bucket, results_key, log_key)
-      
-      # Delete local files
+    finally:
+      # Delete local files, whether or not the job is retried
       delete_local_file(results_file)
       delete_local_file(log_file)
-      delete_local_file(input_file)
-      
-      # Publish messages to SNS topics
-      publish_messages(job_id)
+      if not s3_inputs_bucket:
+        delete_local_file(input_file)
+    
+    # Publish messages to SNS topics
+    publish_messages(job_id)
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    init_clients()
+    snapshot = open_reference_snapshot()
+    cache = open_variant_cache(snapshot)
+    process_job(sys.argv[1], sys.argv[2], sys.argv[3], cache=cache,
+      snapshot=snapshot)
+    if cache is not None:
+      cache.close()
   else:
     print("A valid .vcf file must be provided.")
 
@@ -0,0 +1,97 @@
+# s3stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reads an S3 object as a stream with parallel, read-ahead ranged GETs
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import io
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes fetched per ranged GET
+RANGE_SIZE = 8 << 20
+
+# Ranged GETs in flight ahead of the reader
+READ_AHEAD = 4
+
+
+"""Raw binary stream over an S3 object, fetched in ranges of rangesize
+   bytes. Up to readahead ranges are fetched in parallel ahead of the one
+   being read, so the reader only waits when it gets ahead of the network;
+   memory use is bounded by readahead * rangesize
+   Reference: https://docs.aws.amazon.com/AmazonS3/latest/userguide/optimizing-performance-guidelines.html
+"""
+class S3RangeReader(io.RawIOBase):
+    def __init__(self, s3_client, bucket, key, rangesize=RANGE_SIZE,
+        readahead=READ_AHEAD):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.rangesize = rangesize
+        self.readahead = readahead
+
+        # Pin the version read so that all ranges come from the same object
+        # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+
+        self.pool = ThreadPoolExecutor(max_workers=readahead)
+        self.pending = collections.deque()
+        self.offset = 0
+        self.chunk = b''
+        self.chunkpos = 0
+
+    def readable(self):
+        return True
+
+    # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+    def getRange(self, start, end):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={start}-{end}", IfMatch=self.etag)
+        return response['Body'].read()
+
+    def fill(self):
+        while (len(self.pending) < self.readahead and self.offset < self.size):
+            end = min(self.size, self.offset + self.rangesize) - 1
+            self.pending.append(self.pool.submit(self.getRange, self.offset,
+                end))
+            self.offset = end + 1
+
+    def readinto(self, b):
+        if (self.chunkpos >= len(self.chunk)):
+            self.fill()
+            if (len(self.pending) == 0):
+                return 0
+            self.chunk = self.pending.popleft().result()
+            self.chunkpos = 0
+            self.fill()
+
+        n = min(len(b), len(self.chunk) - self.chunkpos)
+        b[:n] = self.chunk[self.chunkpos:self.chunkpos + n]
+        self.chunkpos = self.chunkpos + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.pool.shutdown(wait=False)
+        io.RawIOBase.close(self)
+
+
+"""Opens an S3 object as a text stream of lines, like open() does a local
+   file
+"""
+def open_s3(s3_client, bucket, key, rangesize=RANGE_SIZE,
+    readahead=READ_AHEAD):
+    return io.TextIOWrapper(io.BufferedReader(S3RangeReader(s3_client, bucket,
+        key, rangesize=rangesize, readahead=readahead)))
+
+### EOF
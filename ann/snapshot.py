@@ -0,0 +1,387 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-mapped snapshot of the reference tables used by the annotate passes
+#
+# Usage:
+#   python snapshot.py build <snapshot dir> [version]
+#   python snapshot.py verify <snapshot dir> [version]
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import sys
+import os
+import decimal
+import hashlib
+import json
+import shutil
+import time
+import numpy as np
+
+import utils as u
+import intervals as iv
+
+# Reference tables exported to the snapshot, with the columns holding the
+# chromosome and the closed [start, end] interval each row is indexed by
+TABLES = [
+    ('dbSNP', 'CHR', 'POS', 'POS'),
+    ('chrom_pos_equal_base', 'CHR', 'start', 'start'),
+    ('chrom_pos_equal_nobase', 'CHR', 'start', 'start'),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end'),
+    ('refGene', 'chrom', 'txStart', 'txEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd'),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd'),
+] + [('tfbsConsSites' + chrom, 'chrom', 'chromStart', 'chromEnd')
+    for chrom in [str(i) for i in range(1, 23)] + ['X', 'Y']]
+
+MANIFEST = 'manifest.json'
+CURRENT = 'CURRENT'
+
+# Layout of the snapshot files; snapshots of another format must be rebuilt
+FORMAT = 2
+
+
+"""Loads a .npy file memory-mapped; numpy cannot map an empty array
+"""
+def loadArray(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+
+def checksum(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+"""Picks how a column is stored from the Python types the driver returned
+"""
+def columnKind(values):
+    types = set([type(v) for v in values if v is not None])
+    if (len(types) == 0 or types == set([int])):
+        return 'int'
+    if types <= set([int, float]):
+        return 'float'
+    if (types == set([bytes])):
+        return 'bytes'
+    if (types == set([decimal.Decimal])):
+        return 'decimal'
+    return 'str'
+
+
+"""Writes one column of a partition as <base>.npy (numbers, or the
+   concatenated encoded values of text columns, delimited by <base>.off.npy)
+   and <base>.null.npy when it has NULLs. Returns the files written
+"""
+def writeColumn(base, kind, values):
+    files = [base + '.npy']
+    nulls = np.array([v is None for v in values], dtype=np.bool_)
+    if nulls.any():
+        np.save(base + '.null.npy', nulls)
+        files.append(base + '.null.npy')
+
+    if (kind in ('int', 'float')):
+        dtype = np.int64 if (kind == 'int') else np.float64
+        np.save(base + '.npy', np.array([0 if v is None else v
+            for v in values], dtype=dtype))
+        return files
+
+    encoded = [b'' if v is None else (v if (kind == 'bytes')
+        else str(v).encode('utf-8')) for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    np.save(base + '.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(base + '.off.npy', offsets)
+    return files + [base + '.off.npy']
+
+
+"""Exports one table, one directory per chromosome, into tabledir
+"""
+def buildTable(cursor, tabledir, table, chromCol, startCol, endCol):
+    cursor.execute('select distinct ' + chromCol + ' from ' + table + ';')
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()
+        if row[0] is not None])
+
+    entry = {'chromCol': chromCol, 'startCol': startCol, 'endCol': endCol,
+        'columns': None, 'partitions': {}}
+    files = []
+
+    for chrom in chroms:
+        cursor.execute('select * from ' + table + ' where ' + chromCol + \
+            '="' + chrom + '";')
+        rows = cursor.fetchall()
+        names = [str(d[0]) for d in cursor.description]
+        entry['columns'] = names
+        si = names.index(startCol)
+        ei = names.index(endCol)
+
+        partdir = os.path.join(tabledir, chrom)
+        os.makedirs(partdir)
+        kinds = []
+        for (j, name) in enumerate(names):
+            values = [row[j] for row in rows]
+            kind = columnKind(values)
+            kinds.append(kind)
+            files = files + writeColumn(os.path.join(partdir, 'c' + str(j)),
+                kind, values)
+
+        # Interval index: the levels of an IntervalIndex stored one after
+        # the other, with the offset, size and longest interval of each
+        levels = iv.getLevels([int(row[si]) for row in rows],
+            [int(row[ei]) for row in rows])
+        bounds = []
+        offset = 0
+        for (starts, ends, rowids, maxLength) in levels:
+            bounds.append([offset, len(rowids), maxLength])
+            offset += len(rowids)
+        for (name, k) in [('starts', 0), ('ends', 1), ('rowids', 2)]:
+            values = np.concatenate([level[k] for level in levels]) \
+                if (len(levels) > 0) else np.zeros(0, dtype=np.int64)
+            np.save(os.path.join(partdir, name + '.npy'), values)
+            files.append(os.path.join(partdir, name + '.npy'))
+
+        entry['partitions'][chrom] = {'rows': len(rows), 'kinds': kinds,
+            'levels': bounds}
+
+    return (entry, files)
+
+
+"""Exports every reference table into <path>/<version> and makes it the
+   current snapshot. Tables missing from the database are skipped
+"""
+def build(path, version=None):
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S')
+
+    tmpdir = os.path.join(path, version + '.tmp')
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    manifest = {'version': version, 'format': FORMAT,
+        'created': int(time.time()), 'tables': {}, 'checksums': {}}
+
+    for (table, chromCol, startCol, endCol) in TABLES:
+        try:
+            (entry, files) = buildTable(cursor, os.path.join(tmpdir, table),
+                table, chromCol, startCol, endCol)
+        except Exception as e:
+            print(f"{table}: skipped ({e})")
+            shutil.rmtree(os.path.join(tmpdir, table), ignore_errors=True)
+            continue
+
+        manifest['tables'][table] = entry
+        for f in files:
+            manifest['checksums'][os.path.relpath(f, tmpdir)] = checksum(f)
+        print(f"{table}: {sum([p['rows'] for p in entry['partitions'].values()])}" + \
+            f" rows in {len(entry['partitions'])} chromosomes")
+
+    conn.close()
+
+    with open(os.path.join(tmpdir, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh)
+    os.rename(tmpdir, os.path.join(path, version))
+
+    with open(os.path.join(path, CURRENT + '.tmp'), 'w') as fh:
+        fh.write(version + '\n')
+    os.replace(os.path.join(path, CURRENT + '.tmp'),
+        os.path.join(path, CURRENT))
+    return version
+
+
+"""Checks every file of a snapshot against the manifest checksums
+   Returns the list of missing or corrupted files
+"""
+def verify(path, version=None):
+    snap = Snapshot(path, version=version)
+    bad = []
+    for (f, sha) in sorted(snap.manifest['checksums'].items()):
+        full = os.path.join(snap.root, f)
+        if not (os.path.isfile(full) and checksum(full) == sha):
+            bad.append(f)
+    return bad
+
+
+"""A memory-mapped column of a partition
+"""
+class Column(object):
+    def __init__(self, base, kind):
+        self.kind = kind
+        self.values = loadArray(base + '.npy')
+        self.offsets = None
+        self.nulls = None
+        if (kind not in ('int', 'float')):
+            self.offsets = loadArray(base + '.off.npy')
+        if os.path.exists(base + '.null.npy'):
+            self.nulls = loadArray(base + '.null.npy')
+
+    def get(self, i):
+        if (self.nulls is not None and self.nulls[i]):
+            return None
+        if (self.kind == 'int'):
+            return int(self.values[i])
+        if (self.kind == 'float'):
+            return float(self.values[i])
+
+        value = self.values[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes()
+        if (self.kind == 'bytes'):
+            return value
+        if (self.kind == 'decimal'):
+            return decimal.Decimal(value.decode('utf-8'))
+        return value.decode('utf-8')
+
+
+"""The rows of one chromosome of a table, with their interval index
+"""
+class Partition(object):
+    def __init__(self, partdir, rows, kinds, levels):
+        self.rows = rows
+        self.columns = [Column(os.path.join(partdir, 'c' + str(j)), kind)
+            for (j, kind) in enumerate(kinds)]
+        self.starts = loadArray(os.path.join(partdir, 'starts.npy'))
+        self.ends = loadArray(os.path.join(partdir, 'ends.npy'))
+        self.rowids = loadArray(os.path.join(partdir, 'rowids.npy'))
+        self.levels = levels
+
+    # [l, h) slice of the candidates for [lo, hi] in each level: an interval
+    # no longer than maxLength ending at or after lo starts at or after
+    # lo - maxLength
+    def getCandidates(self, lo, hi):
+        slices = []
+        for (offset, count, maxLength) in self.levels:
+            starts = self.starts[offset:offset + count]
+            slices.append((offset + int(np.searchsorted(starts,
+                lo - maxLength, side='left')), offset + int(np.searchsorted(
+                starts, hi, side='right'))))
+        return slices
+
+    # Row numbers, in table order, of the intervals overlapping [lo, hi]
+    def overlapping(self, lo, hi):
+        rowids = []
+        for (l, h) in self.getCandidates(lo, hi):
+            if (l < h):
+                hit = np.asarray(self.ends[l:h]) >= lo
+                rowids.extend(np.asarray(self.rowids[l:h])[hit].tolist())
+        return sorted(rowids)
+
+    def row(self, i, columns=None):
+        if columns is None:
+            return tuple([c.get(i) for c in self.columns])
+        return tuple([self.columns[j].get(i) for j in columns])
+
+
+"""A table of the snapshot; partitions are mapped the first time a lookup
+   needs them. fetchall() and fetchone() match the overlap joins in
+   intervals.py, so a table can stand in for them in the overlap passes
+"""
+class Table(object):
+    def __init__(self, tabledir, name, entry):
+        self.tabledir = tabledir
+        self.name = name
+        self.entry = entry
+        self.chromCol = entry['chromCol']
+        self.startCol = entry['startCol']
+        self.endCol = entry['endCol']
+        self.columns = entry['columns'] or []
+        self.partitions = {}
+
+    def partition(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.partitions:
+            part = self.entry['partitions'].get(chrom)
+            if part is None:
+                self.partitions[chrom] = None
+            else:
+                self.partitions[chrom] = Partition(
+                    os.path.join(self.tabledir, chrom), part['rows'],
+                    part['kinds'], part['levels'])
+        return self.partitions[chrom]
+
+    # Rows of chrom whose interval overlaps [lo, hi] (hi defaults to lo), in
+    # table order; columns optionally selects the columns returned, by name
+    def fetchall(self, chrom, lo, hi=None, columns=None):
+        part = self.partition(chrom)
+        if part is None:
+            return []
+        lo = int(lo)
+        hi = lo if (hi is None) else int(hi)
+        if columns is not None:
+            columns = [self.columns.index(name) for name in columns]
+        return [part.row(i, columns) for i in part.overlapping(lo, hi)]
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        return rows[0] if (len(rows) > 0) else None
+
+
+"""The version of the current snapshot of path
+"""
+def getCurrentVersion(path):
+    with open(os.path.join(path, CURRENT)) as fh:
+        return fh.read().strip()
+
+
+"""A read-only reference snapshot; version defaults to the current one
+"""
+class Snapshot(object):
+    def __init__(self, path, version=None):
+        if version is None:
+            version = getCurrentVersion(path)
+
+        self.path = path
+        self.version = version
+        self.root = os.path.join(path, version)
+        with open(os.path.join(self.root, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        if (self.manifest.get('format') != FORMAT):
+            raise ValueError(f"snapshot {version} has format " + \
+                f"{self.manifest.get('format')}, expected {FORMAT}; rebuild it")
+        self.tables = {}
+
+    def has(self, table):
+        return table in self.manifest['tables']
+
+    # Returns the table, or None if the snapshot does not have it
+    def table(self, table):
+        if not self.has(table):
+            return None
+        if table not in self.tables:
+            self.tables[table] = Table(os.path.join(self.root, table), table,
+                self.manifest['tables'][table])
+        return self.tables[table]
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'build'):
+        version = build(sys.argv[2],
+            version=sys.argv[3] if (len(sys.argv) > 3) else None)
+        print(f"Snapshot {version} built in {sys.argv[2]}")
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'verify'):
+        bad = verify(sys.argv[2],
+            version=sys.argv[3] if (len(sys.argv) > 3) else None)
+        for f in bad:
+            print(f"Checksum mismatch: {f}")
+        print("Snapshot OK" if (len(bad) == 0) else f"{len(bad)} bad files")
+        sys.exit(1 if (len(bad) > 0) else 0)
+    else:
+        print("Usage: snapshot.py build|verify <snapshot dir> [version]")
+
+### EOF
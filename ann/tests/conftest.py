@@ -0,0 +1,17 @@
+# conftest.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# The annotator modules import each other by module name, as run.py does
+# from the ann directory
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### EOF
@@ -0,0 +1,171 @@
+# test_annotator.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the job slot sizing and queue scheduling of the annotator
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import configparser
+
+import pytest
+
+import annotator
+
+
+def getConfig(**ann):
+    config = configparser.ConfigParser()
+    config.read_dict({'aws': {'PremiumSqsQueueURL': 'premium-url',
+        'SqsQueueURL': 'free-url'},
+        'ann': dict({'MaxConcurrentJobs': '0', 'AnnotationShards': '1',
+        'JobMemoryMB': '1024', 'PremiumWeight': '4', 'FreeWeight': '1',
+        'ReservedPremiumSlots': '1', 'PollWaitSeconds': '20',
+        'VisibilityTimeoutSeconds': '300'}, **ann)})
+    return config
+
+
+"""SQS client with available[url] messages waiting on each queue; records
+   the (queue URL, wait seconds) of every receive
+"""
+class StubSqs(object):
+    def __init__(self, available):
+        self.available = available
+        self.receives = []
+
+    def receive_message(self, QueueUrl, AttributeNames, VisibilityTimeout,
+        MaxNumberOfMessages, WaitTimeSeconds):
+        self.receives.append((QueueUrl, WaitTimeSeconds))
+        n = min(MaxNumberOfMessages, self.available[QueueUrl])
+        self.available[QueueUrl] = self.available[QueueUrl] - n
+        return {'Messages': [{'Body': ''}] * n}
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(annotator, 'config', getConfig())
+    monkeypatch.setattr(annotator, 'held_messages', {})
+    monkeypatch.setattr(annotator, 'max_jobs', 4)
+
+    def start(available):
+        client = StubSqs(available)
+        monkeypatch.setattr(annotator, 'sqs_client', client)
+        monkeypatch.setattr(annotator, 'queues', annotator.get_queues())
+        return client
+    return start
+
+
+def test_available_memory(tmp_path):
+    meminfo = tmp_path / 'meminfo'
+    meminfo.write_text('MemTotal:       16314960 kB\n' + \
+        'MemFree:          512000 kB\n\n' + \
+        'MemAvailable:    8157480 kB\nBuffers:          100 kB\n')
+    assert annotator.get_available_memory(str(meminfo)) == 8157480 * 1024
+
+    meminfo.write_text('MemTotal:       16314960 kB\n')
+    with pytest.raises(ValueError):
+        annotator.get_available_memory(str(meminfo))
+
+
+def test_max_jobs(monkeypatch):
+    monkeypatch.setattr(annotator.os, 'cpu_count', lambda: 16)
+    monkeypatch.setattr(annotator, 'get_available_memory',
+        lambda: 5 * 1024 ** 3)
+
+    monkeypatch.setattr(annotator, 'config', getConfig(MaxConcurrentJobs='3'))
+    assert annotator.get_max_jobs() == 3
+
+    # 16 cores, 5 GB for 1 GB shards
+    monkeypatch.setattr(annotator, 'config', getConfig())
+    assert annotator.get_max_jobs() == 5
+    monkeypatch.setattr(annotator, 'config', getConfig(AnnotationShards='4'))
+    assert annotator.get_max_jobs() == 1
+    monkeypatch.setattr(annotator, 'config', getConfig(JobMemoryMB='128'))
+    assert annotator.get_max_jobs() == 16
+
+    # Not even one job fits: still run one
+    monkeypatch.setattr(annotator, 'config', getConfig(JobMemoryMB='8192'))
+    assert annotator.get_max_jobs() == 1
+
+    def unknown():
+        raise OSError('no /proc/meminfo')
+    monkeypatch.setattr(annotator, 'get_available_memory', unknown)
+    monkeypatch.setattr(annotator, 'config', getConfig(AnnotationShards='2'))
+    assert annotator.get_max_jobs() == 8
+
+
+@pytest.mark.parametrize('max_jobs, reserved, free_max_jobs', [(4, 1, 3),
+    (4, 0, 4), (4, 3, 1), (4, 9, 1), (1, 1, 1), (2, 1, 1)])
+def test_premium_reservation_clamped(monkeypatch, max_jobs, reserved,
+    free_max_jobs):
+    monkeypatch.setattr(annotator, 'max_jobs', max_jobs)
+    monkeypatch.setattr(annotator, 'config',
+        getConfig(ReservedPremiumSlots=str(reserved)))
+    queues = annotator.get_queues()
+    assert [(q['name'], q['url'], q['max_jobs']) for q in queues] == \
+        [('premium', 'premium-url', max_jobs), ('free', 'free-url',
+        free_max_jobs)]
+
+
+def test_single_queue(monkeypatch):
+    config = getConfig()
+    config['aws']['PremiumSqsQueueURL'] = ''
+    monkeypatch.setattr(annotator, 'config', config)
+    monkeypatch.setattr(annotator, 'max_jobs', 4)
+    assert [(q['url'], q['max_jobs']) for q in annotator.get_queues()] == \
+        [('free-url', 4)]
+
+
+# With both queues busy, premium jobs get PremiumWeight slots for every
+# FreeWeight free ones
+def test_stride_shares(scheduler):
+    client = scheduler({'premium-url': 100, 'free-url': 100})
+    received = {'premium': 0, 'free': 0}
+    for i in range(50):
+        (queue, messages) = annotator.receive_messages(1)
+        received[queue['name']] += len(messages)
+    assert received == {'premium': 40, 'free': 10}
+
+    # Jobs were waiting on the other queue at every receive but the first
+    assert client.receives[0][1] == 20
+    assert set([wait for (url, wait) in client.receives[1:]]) == set([0])
+
+
+def test_stride_pass_accounting(scheduler):
+    client = scheduler({'premium-url': 0, 'free-url': 5})
+    (premium, free) = annotator.queues
+
+    # An empty queue gives up its turn: charged one job past the others
+    (queue, messages) = annotator.receive_messages(4)
+    assert (queue is premium and messages == [])
+    assert (premium['pass'], premium['waiting']) == (0.25, False)
+
+    # Charged one job per message received; up to the free queue's slots
+    (queue, messages) = annotator.receive_messages(4)
+    assert (queue is free and len(messages) == 3)
+    assert (free['pass'], free['waiting']) == (3.0, True)
+
+    # Not long polled, as free had jobs waiting, and charged past free
+    (queue, messages) = annotator.receive_messages(4)
+    assert (queue is premium and messages == [])
+    assert premium['pass'] == 3.25
+    assert [wait for (url, wait) in client.receives] == [20, 20, 0]
+
+
+def test_slots_of_running_jobs(scheduler):
+    client = scheduler({'premium-url': 10, 'free-url': 10})
+    (premium, free) = annotator.queues
+    annotator.held_messages.update({'a': ['r', 0, 'free-url'],
+        'b': ['r', 0, 'free-url'], 'c': ['r', 0, 'free-url']})
+    assert annotator.get_queue_slots(free, 4) == 0
+    assert annotator.get_queue_slots(premium, 4) == 4
+    assert annotator.get_queue_slots(premium, 20) == 4
+
+    # The free queue is full, so it is not polled however far behind it is
+    premium['pass'] = 10.0
+    (queue, messages) = annotator.receive_messages(1)
+    assert (queue is premium and len(messages) == 1)
+    assert client.receives == [('premium-url', 20)]
+
+### EOF
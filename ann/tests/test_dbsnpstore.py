@@ -0,0 +1,102 @@
+# test_dbsnpstore.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the local dbSNP store against the dbSNP queries it replaces
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import os
+import random
+import sqlite3
+
+import pytest
+
+import annotate as ann
+import dbsnpstore as ds
+
+CHROMS = ['1', '2', 'X']
+
+
+@pytest.fixture
+def dbsnp(tmp_path, monkeypatch):
+    rng = random.Random(13)
+    db = str(tmp_path / 'dbsnp.db')
+    conn = sqlite3.connect(db)
+    conn.execute('create table dbSNP (id integer, CHR text, POS integer, ' + \
+        'RSID text, REF text, ALT text, INFO text, GMAF text)')
+    rows = []
+    for i in range(3000):
+        # Several rows share a position, some with the same REF
+        pos = rng.randint(1, 400) * 100 + rng.choice([0, 0, 1])
+        rows.append((i, rng.choice(CHROMS), pos, 'rs' + str(i),
+            rng.choice('ACGT'), rng.choice('ACGT'),
+            rng.choice(['SNV', 'SNV', 'SNV', 'DIV', 'MNV']),
+            rng.choice(['.', '0.01', '0.25'])))
+    conn.executemany('insert into dbSNP values (?,?,?,?,?,?,?,?)', rows)
+    conn.commit()
+
+    monkeypatch.setattr(ds.u, 'db_connect', lambda: sqlite3.connect(db))
+    path = str(tmp_path / 'store')
+    os.makedirs(path)
+    ds.build(path, 'v1')
+    yield (conn, rows, ds.DbSnpStore(path), path)
+    conn.close()
+
+
+def test_no_false_negatives(dbsnp):
+    (conn, rows, store, path) = dbsnp
+    for (i, chrom, pos, rsid, ref, alt, info, gmaf) in rows:
+        assert store.bloom.mayContain(chrom, pos, ref)
+        assert store.bloom.mayContain(chrom, pos, ref.lower())
+
+
+def test_false_positive_rate(dbsnp):
+    (conn, rows, store, path) = dbsnp
+    present = set([(chrom, pos, ref) for (i, chrom, pos, rsid, ref, alt,
+        info, gmaf) in rows])
+    absent = [(chrom, pos, ref) for chrom in CHROMS
+        for pos in range(50, 40000, 100) for ref in 'ACGT'
+        if (chrom, pos, ref) not in present]
+    hits = len([key for key in absent if store.bloom.mayContain(*key)])
+    assert hits < 0.03 * len(absent)
+
+
+@pytest.mark.parametrize('varclass', ['SNV', 'DIV'])
+def test_records_match_dbsnp_queries(dbsnp, varclass):
+    (conn, rows, store, path) = dbsnp
+    rng = random.Random(17)
+    variants = []
+    for (i, chrom, pos, rsid, ref, alt, info, gmaf) in rows[:1000]:
+        variants.append((chrom, pos, ref, ann.getComplementary(ref)))
+    for i in range(500):
+        ref = rng.choice('ACGT')
+        variants.append((rng.choice(CHROMS + ['7']), rng.randint(1, 40100),
+            ref, ann.getComplementary(ref)))
+
+    batch = ann.getDbSnpRowsBatch(conn.cursor(), variants, varclass=varclass)
+    for (variant, batchRows) in zip(variants, batch):
+        (chrom, pos, ref, compRef) = variant
+        queried = conn.execute('select * from dbSNP where CHR = ? and ' + \
+            'POS = ? and (REF = ? or REF = ?) and INFO = ? order by rowid',
+            (chrom, pos, ref, compRef, varclass)).fetchall()
+        assert batchRows == queried
+        assert store.getRecord(*variant, varclass=varclass) == \
+            ann.getDbSnpRecord(queried)
+        assert store.getRecord(chrom, pos, ref.lower(), compRef.lower(),
+            varclass=varclass.lower()) == ann.getDbSnpRecord(queried)
+
+
+def test_verify(dbsnp):
+    (conn, rows, store, path) = dbsnp
+    assert ds.verify(path) == []
+    with open(os.path.join(path, 'v1', 'bloom.npy'), 'r+b') as fh:
+        fh.seek(-1, os.SEEK_END)
+        last = fh.read(1)
+        fh.seek(-1, os.SEEK_END)
+        fh.write(bytes([last[0] ^ 0xff]))
+    assert ds.verify(path) == ['bloom.npy']
+
+### EOF
@@ -0,0 +1,342 @@
+# test_equivalence.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests that every pipeline mode and overlap engine annotates a small
+# SQLite reference fixture exactly like the original per-row code did
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import os
+import random
+import shutil
+import sqlite3
+
+import pytest
+
+import annotate as ann
+import driver
+import utils as u
+
+CHROMS = ['1', '2', 'X']
+
+COMPLEMENT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+# Columns of the bigRefSeq tables after id, CHR, start and end
+BIG_REF_SEQ = ['haplotypeReference', 'haplotypeAlternate', 'name', 'name2',
+    'transcriptStrand', 'positionType', 'frame', 'mrnaCoord', 'codonCoord',
+    'spliceDist', 'referenceCodon', 'referenceAA', 'variantCodon',
+    'variantAA', 'changesAA', 'functionalClass', 'codingCoordStr',
+    'proteinCoordStr', 'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+# Tables of (bin, chrom, chromStart, chromEnd, name) rows with the widest
+# interval they hold
+CNV_TABLES = [('dgv_Cnv', 50000), ('abParts_IG_T_CelReceptors', 500),
+    ('mcCarroll_Cnv', 10000), ('conrad_Cnv', 5000)]
+
+# Bin boundaries of the finest UCSC bin level the fixture straddles
+BIN_BOUNDARIES = [1 << 17, 2 << 17]
+
+# Output of the original per-row code (before the overlap engines and
+# pipeline modes) over the fixture
+EXPECTED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+    'equivalence')
+
+
+"""SQLite stand-in of the reference database, shared across the threads
+   and processes of a run; cursor classes (the sweep join's unbuffered one)
+   are ignored
+"""
+class Connection(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, *args):
+        return self.conn.cursor()
+
+    def close(self):
+        self.conn.close()
+
+
+"""UCSC binFromRange: the bin a row of the 0-based half-open range
+   [start, end) is stored in (kent src/lib/binRange.c)
+"""
+def getBin(start, end):
+    startBin = start >> 17
+    endBin = (end - 1) >> 17
+    for offset in [585, 73, 9, 1, 0]:
+        if (startBin == endBin):
+            return offset + startBin
+        startBin = startBin >> 3
+        endBin = endBin >> 3
+    raise ValueError(f"[{start}, {end}) is out of the binning scheme")
+
+
+"""Random variants, and some on either side of each bin boundary
+"""
+def getVariants(rng):
+    variants = []
+    for chrom in CHROMS:
+        positions = rng.sample(range(10000, 200000), 40) + \
+            [b + d for b in BIN_BOUNDARIES for d in (-1, 0, 1)]
+        for pos in sorted(positions):
+            ref = rng.choice('ACGT')
+            alt = rng.choice([b for b in 'ACGT' if (b != ref)])
+            if (rng.random() < 0.1):
+                alt = ref + rng.choice('ACGT')
+            variants.append((chrom, pos, ref, alt))
+    return variants
+
+
+"""Random intervals, most of them around a variant position, and some
+   starting or ending at a bin boundary
+"""
+def getIntervals(rng, positions, count, width):
+    intervals = []
+    for i in range(count):
+        start = max(0, rng.choice(positions) - rng.randint(0, width)) \
+            if (rng.random() < 0.7) else rng.randint(positions[0],
+            positions[-1])
+        intervals.append((start, start + rng.randint(0, width)))
+    for boundary in BIN_BOUNDARIES:
+        length = rng.randint(0, width)
+        intervals += [(boundary - length, boundary),
+            (boundary, boundary + length)]
+    return intervals
+
+
+def buildReference(path, variants, rng):
+    conn = sqlite3.connect(path)
+    x = conn.execute
+    x('create table dbSNP (id integer, CHR text, POS integer, RSID text, ' + \
+        'REF text, ALT text, INFO text, GMAF text)')
+    columns = ', '.join(['id integer', 'CHR text', 'start integer',
+        'end integer'] + [c + ' text' for c in BIG_REF_SEQ])
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        x('create table ' + table + ' (' + columns + ')')
+    x('create table refGene (bin integer, name text, chrom text, ' + \
+        'strand text, txStart integer, txEnd integer, cdsStart integer, ' + \
+        'cdsEnd integer, exonCount integer, exonStarts blob, ' + \
+        'exonEnds blob, score integer, name2 text, cdsStartStat text, ' + \
+        'cdsEndStat text, exonFrames text)')
+    x('create table cpgIslandExt (bin integer, chrom text, ' + \
+        'chromStart integer, chromEnd integer, name text, length integer)')
+    x('create table cytoBand (chrom text, chromStart integer, ' + \
+        'chromEnd integer, name text, gieStain text)')
+    x('create table gadAll (id integer, chromosome text, ' + \
+        'chromStart integer, geneSymbol text, chromEnd integer, x text)')
+    x('create table gwasCatalog (bin integer, chrom text, ' + \
+        'chromStart integer, chromEnd integer, name text, pubMedID text, ' + \
+        'author text, pubDate text, journal text, title text, trait text)')
+    x('create table hugo (bin integer, chrom text, chromStart integer, ' + \
+        'chromEnd integer, name text, symbol text, fullname text)')
+    x('create table genomicSuperDups (bin integer, chrom text, ' + \
+        'chromStart integer, chromEnd integer, name text, score integer, ' + \
+        'strand text, otherChrom text, otherStart integer, ' + \
+        'otherEnd integer)')
+    x('create table targetScanS (bin integer, chrom text, ' + \
+        'chromStart integer, chromEnd integer, name text, score integer, ' + \
+        'strand text)')
+    for (table, width) in CNV_TABLES:
+        x('create table ' + table + ' (bin integer, chrom text, ' + \
+            'chromStart integer, chromEnd integer, name text)')
+    for chrom in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+        x('create table tfbsConsSites' + chrom + ' (bin integer, ' + \
+            'chrom text, chromStart integer, chromEnd integer, name text)')
+
+    def bigRefSeqRow(i, chrom, start, end, ref, alt):
+        return (i, chrom, start, end, ref, alt,
+            'NM_' + str(rng.randint(1, 50)), 'G' + str(rng.randint(1, 20)),
+            rng.choice('+-'), rng.choice(['CDS', 'intron', 'utr5', 'utr3']),
+            rng.choice([0, 1, 2]), rng.randint(0, 9), 0, rng.randint(0, 5),
+            'ATG', 'M', 'ATA', 'I', rng.choice(['Y', 'N']),
+            rng.choice(['missense', 'silent']), 'c.1A>G', 'p.M1I',
+            rng.choice(['true', 'false']), '', '0')
+
+    values = ','.join(['?'] * 25)
+    for (i, (chrom, pos, ref, alt)) in enumerate(variants):
+        r = rng.random()
+        if (r < 0.4):
+            x('insert into dbSNP values (?,?,?,?,?,?,?,?)', (i, chrom, pos,
+                'rs' + str(i), ref if (r < 0.3) else COMPLEMENT[ref], alt,
+                'SNV', rng.choice(['.', '0.01', '0.2'])))
+        elif (r < 0.45):
+            x('insert into dbSNP values (?,?,?,?,?,?,?,?)', (i, chrom, pos,
+                'rs' + str(i), ref, alt, 'DIV', '.'))
+
+        r = rng.random()
+        if (r < 0.2):
+            x('insert into chrom_pos_equal_base values (' + values + ')',
+                bigRefSeqRow(i, chrom, pos, pos, ref, alt))
+        elif (r < 0.35):
+            x('insert into chrom_pos_equal_nobase values (' + values + ')',
+                bigRefSeqRow(i, chrom, pos, pos, 'X', 'Y'))
+        elif (r < 0.5):
+            start = pos - rng.randint(0, 300)
+            x('insert into chrom_pos_unequal values (' + values + ')',
+                bigRefSeqRow(i, chrom, start, start + rng.randint(0, 600),
+                '', ''))
+
+    for chrom in CHROMS:
+        positions = [pos for (c, pos, ref, alt) in variants if (c == chrom)]
+        name = 'chr' + chrom
+        for (g, (txStart, txEnd)) in enumerate(getIntervals(rng, positions,
+            20, 20000)):
+            bounds = sorted(rng.sample(range(txStart, txEnd + 2), 4))
+            (cdsStart, cdsEnd) = sorted([rng.randint(txStart, txEnd),
+                rng.randint(txStart, txEnd)])
+            x('insert into refGene values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (0, 'NM_' + str(g), name, rng.choice('+-'), txStart, txEnd,
+                cdsStart, cdsEnd, 2,
+                (','.join(map(str, bounds[0::2])) + ',').encode('utf-8'),
+                (','.join(map(str, bounds[1::2])) + ',').encode('utf-8'),
+                0, 'GENE' + str(g), 'cmpl', 'cmpl', ''))
+            for edge in (txStart, txEnd):
+                x('insert into cpgIslandExt values (?,?,?,?,?,?)', (0, name,
+                    max(0, edge - rng.randint(0, 400)),
+                    edge + rng.randint(0, 400),
+                    'CpG: ' + str(rng.randint(10, 99)), 0))
+        for (start, end) in getIntervals(rng, positions, 10, 100000):
+            x('insert into cytoBand values (?,?,?,?,?)', (name, start, end,
+                'p' + str(rng.randint(1, 3)), 'gneg'))
+        for (start, end) in getIntervals(rng, positions, 30, 2000):
+            x('insert into gadAll values (?,?,?,?,?,?)', (0, chrom, start,
+                'GAD' + str(rng.randint(1, 30)), end, ''))
+        for pos in rng.sample(positions, 10):
+            x('insert into gwasCatalog values (?,?,?,?,?,?,?,?,?,?,?)', (0,
+                name, pos - 1, pos, 'rs', str(rng.randint(1000, 9999)), 'a',
+                'd', 'j', 't', 'Trait ' + str(rng.randint(1, 9))))
+        for (start, end) in getIntervals(rng, positions, 20, 5000):
+            x('insert into hugo values (?,?,?,?,?,?,?)', (0, name, start,
+                end, 'h', 'SYM' + str(rng.randint(1, 30)), 'full name'))
+        for (start, end) in getIntervals(rng, positions, 10, 20000):
+            x('insert into genomicSuperDups values (?,?,?,?,?,?,?,?,?,?)',
+                (0, name, start, end, 'sd', 0, '+', 'chr2', start + 7,
+                end + 7))
+        for (start, end) in getIntervals(rng, positions, 20, 30):
+            x('insert into targetScanS values (?,?,?,?,?,?,?)', (0, name,
+                start, end, 'miR-' + str(rng.randint(1, 99)), 0, '+'))
+        for (table, width) in CNV_TABLES:
+            for (start, end) in getIntervals(rng, positions, 10, width):
+                x('insert into ' + table + ' values (?,?,?,?,?)', (0, name,
+                    start, end, 'cnv'))
+        for (start, end) in getIntervals(rng, positions, 20, 40):
+            x('insert into tfbsConsSites' + chrom + ' values (?,?,?,?,?)',
+                (0, name, start, end, 'V$TF' + str(rng.randint(1, 50))))
+
+    # Rows are stored in their UCSC bin, as in the UCSC tables
+    conn.create_function('getBin', 2, getBin)
+    for (table, startCol, endCol) in [('refGene', 'txStart', 'txEnd'),
+        ('cpgIslandExt', 'chromStart', 'chromEnd'),
+        ('gwasCatalog', 'chromStart', 'chromEnd'),
+        ('hugo', 'chromStart', 'chromEnd'),
+        ('genomicSuperDups', 'chromStart', 'chromEnd'),
+        ('targetScanS', 'chromStart', 'chromEnd')] + \
+        [(table, 'chromStart', 'chromEnd') for (table, width) in CNV_TABLES] + \
+        [('tfbsConsSites' + chrom, 'chromStart', 'chromEnd')
+        for chrom in CHROMS]:
+        x('update ' + table + ' set bin = getBin(' + startCol + ', ' + \
+            endCol + ')')
+    conn.commit()
+    conn.close()
+
+
+def writeInput(path, variants):
+    fh = open(path, 'w')
+    fh.write('##fileformat=VCFv4.0\n')
+    fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    for (chrom, pos, ref, alt) in variants:
+        fh.write('\t'.join([chrom, str(pos), '.', ref, alt, '.', '.',
+            'AC=1;AN=2']) + '\n')
+    fh.close()
+
+
+"""Annotated output and count log of a run over a copy of the input
+"""
+def annotate(tmpdir, name, source, **kwargs):
+    infile = os.path.join(str(tmpdir), name + '.vcf')
+    shutil.copy(source, infile)
+    driver.run(infile, 'vcf', **kwargs)
+    return readResults(infile)
+
+
+def readResults(infile):
+    outfile = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    with open(outfile) as fh_out, open(infile + '.count.log') as fh_log:
+        return (fh_out.read(), fh_log.read())
+
+
+def readExpected():
+    with open(EXPECTED + '.annot.vcf') as fh_out, \
+        open(EXPECTED + '.vcf.count.log') as fh_log:
+        return (fh_out.read(), fh_log.read())
+
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('reference')
+    rng = random.Random(7)
+    variants = getVariants(rng)
+    db = os.path.join(str(tmpdir), 'reference.db')
+    buildReference(db, variants, rng)
+    source = os.path.join(str(tmpdir), 'input.vcf')
+    writeInput(source, variants)
+
+    dbConnect = u.db_connect
+    u.db_connect = lambda: Connection(db)
+    try:
+        yield (source, readExpected())
+    finally:
+        u.db_connect = dbConnect
+
+
+def test_bins_straddle_levels(reference):
+    (source, expected) = reference
+    conn = sqlite3.connect(os.path.join(os.path.dirname(source),
+        'reference.db'))
+    bins = set([row[0] for row in conn.execute('select bin from hugo')])
+    conn.close()
+    assert (585 in bins and 586 in bins and 73 in bins)
+
+
+@pytest.mark.parametrize('mode', ['chain', 'fused', 'async', 'dag', 'pipe'])
+@pytest.mark.parametrize('engine', ['sql', 'vectorized', 'sweep', 'lazy'])
+def test_modes_and_engines_match_original(reference, tmp_path, mode, engine):
+    (source, expected) = reference
+    assert annotate(tmp_path, 'run', source, mode=mode, engine=engine,
+        batchsize=16) == expected
+
+
+# The order of the input is scanned for once per run, not by every pass
+@pytest.mark.parametrize('mode', ['chain', 'fused', 'dag'])
+def test_input_order_scanned_once(reference, tmp_path, monkeypatch, mode):
+    (source, expected) = reference
+    scans = []
+    getInputOrder = ann.getInputOrder
+    monkeypatch.setattr(ann, 'getInputOrder',
+        lambda *args, **kwargs: scans.append(args) or \
+        getInputOrder(*args, **kwargs))
+    assert annotate(tmp_path, 'run', source, mode=mode, engine='sweep',
+        batchsize=16) == expected
+    assert len(scans) == 1
+
+
+@pytest.mark.parametrize('engine', ['sql', 'vectorized'])
+def test_shards_match_original(reference, tmp_path, engine):
+    (source, expected) = reference
+    assert annotate(tmp_path, 'run', source, mode='fused', engine=engine,
+        shards=2) == expected
+
+
+@pytest.mark.parametrize('engine', ['sql', 'vectorized', 'sweep', 'lazy'])
+def test_stream_matches_original(reference, tmp_path, engine):
+    (source, expected) = reference
+    infile = os.path.join(str(tmp_path), 'stream.vcf')
+    with open(source) as fh:
+        driver.runStream(fh, infile, engine=engine, batchsize=16)
+    assert readResults(infile) == expected
+
+### EOF
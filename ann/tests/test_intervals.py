@@ -0,0 +1,65 @@
+# test_intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the interval joins against a brute force overlap scan
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import numpy as np
+
+import intervals as iv
+
+
+def bruteForce(starts, ends, positions):
+    return [[r for r in range(len(starts)) if starts[r] <= pos <= ends[r]]
+        for pos in positions]
+
+
+def test_query_matches_brute_force():
+    rng = np.random.default_rng(7)
+    for trial in range(50):
+        n = int(rng.integers(0, 200))
+        starts = rng.integers(0, 10000, n)
+        lengths = np.where(rng.random(n) < 0.2, rng.integers(0, 20000, n),
+            rng.integers(-3, 50, n))
+        ends = starts + lengths
+        positions = rng.integers(-100, 12000, int(rng.integers(0, 100)))
+
+        index = iv.IntervalIndex(starts, ends, list(range(n)))
+        assert index.query(positions) == bruteForce(starts, ends, positions)
+
+
+def test_query_in_chunks(monkeypatch):
+    monkeypatch.setattr(iv, 'MAX_CANDIDATES', 3)
+    starts = [0, 5, 5, 10, 100]
+    ends = [1000, 6, 20, 10, 200]
+    positions = [5, 10, 0, 150, 6, 5000]
+    index = iv.IntervalIndex(starts, ends, list(range(len(starts))))
+    assert index.query(positions) == bruteForce(starts, ends, positions)
+
+
+# Chromosome-long intervals, like those of dgv_Cnv or cytoBand, must not
+# make every short interval before a position a candidate
+def test_long_intervals_keep_candidates_bounded():
+    rng = np.random.default_rng(11)
+    n = 50000
+    starts = np.sort(rng.integers(0, 10 ** 8, n))
+    ends = starts + rng.integers(0, 100, n)
+    starts = np.concatenate([starts, [0, 1000, 5 * 10 ** 7]])
+    ends = np.concatenate([ends, [10 ** 8, 9 * 10 ** 7, 6 * 10 ** 7]])
+    positions = rng.integers(0, 10 ** 8, 20000)
+
+    index = iv.IntervalIndex(starts, ends, list(range(len(starts))))
+    candidates = sum([int((hi - lo).sum())
+        for (lo, hi) in index.getCandidates(positions)])
+    assert candidates < 10 * len(positions)
+
+    rows = index.query(positions)
+    for (pos, hits) in zip(positions[:200], rows[:200]):
+        assert hits == [r for r in np.flatnonzero((starts <= pos) &
+            (ends >= pos)).tolist()]
+
+### EOF
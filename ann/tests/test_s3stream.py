@@ -0,0 +1,154 @@
+# test_s3stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the S3 range reader against a stubbed S3 client
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import os
+import random
+import threading
+import time
+
+import pytest
+
+import driver
+import s3stream as s3
+import utils as u
+import test_equivalence as te
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+class Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+"""S3 client serving one object from a byte string; delay(start) is how
+   long the GET of the range at start takes
+"""
+class StubS3(object):
+    def __init__(self, data, delay=None):
+        self.data = data
+        self.etag = '"v1"'
+        self.delay = delay
+        self.ranges = []
+        self.running = 0
+        self.maxRunning = 0
+        self.lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data), 'ETag': self.etag}
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        (start, end) = [int(x) for x in Range[len('bytes='):].split('-')]
+        with self.lock:
+            self.ranges.append((start, end))
+            self.running = self.running + 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        try:
+            if (self.delay is not None):
+                time.sleep(self.delay(start))
+            if (IfMatch != self.etag):
+                raise PreconditionFailed(Range)
+            return {'Body': Body(self.data[start:end + 1])}
+        finally:
+            with self.lock:
+                self.running = self.running - 1
+
+
+def getData(lines=300):
+    rng = random.Random(21)
+    return ''.join(['\t'.join([rng.choice(['1', '2', 'X']),
+        str(rng.randint(1, 10 ** 6)), '.', 'A', 'G', '.', '.',
+        'AC=' + str(rng.randint(1, 9))]) + '\n'
+        for i in range(lines)]).encode('utf-8')
+
+
+@pytest.mark.parametrize('rangesize', [1, 7, 64, 100000])
+def test_lines_split_across_ranges(rangesize):
+    data = getData()
+    client = StubS3(data)
+    with s3.open_s3(client, 'b', 'k', rangesize=rangesize, readahead=3) as fh:
+        assert fh.readlines() == data.decode('utf-8').splitlines(True)
+
+    # Consecutive ranges covering the object once
+    starts = [start for (start, end) in sorted(client.ranges)]
+    assert starts == list(range(0, len(data), rangesize))
+    assert sorted(client.ranges)[-1][1] == len(data) - 1
+
+
+# Later ranges finishing first must not reorder the stream, and no more
+# than readahead ranges are fetched at a time
+def test_read_ahead_keeps_order():
+    data = getData()
+    client = StubS3(data, delay=lambda start: 0.001 * (3 - (start // 500) % 4))
+    reader = s3.S3RangeReader(client, 'b', 'k', rangesize=500, readahead=4)
+    assert reader.read(len(data) + 10) == data[:500]
+    assert reader.readall() == data[500:]
+    reader.close()
+    assert client.maxRunning <= 4
+    assert len(client.ranges) == (len(data) + 499) // 500
+
+
+def test_empty_object():
+    client = StubS3(b'')
+    with s3.open_s3(client, 'b', 'k') as fh:
+        assert fh.read() == ''
+    assert client.ranges == []
+
+
+# The object changing while it is read fails the read instead of mixing
+# ranges of two versions
+def test_changed_object_fails():
+    data = getData()
+    client = StubS3(data)
+    fh = s3.open_s3(client, 'b', 'k', rangesize=1000, readahead=1)
+    fh.readline()
+    client.etag = '"v2"'
+    with pytest.raises(PreconditionFailed):
+        fh.read()
+    fh.close()
+
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('reference')
+    rng = random.Random(7)
+    variants = te.getVariants(rng)
+    db = os.path.join(str(tmpdir), 'reference.db')
+    te.buildReference(db, variants, rng)
+    source = os.path.join(str(tmpdir), 'input.vcf')
+    te.writeInput(source, variants)
+
+    dbConnect = u.db_connect
+    u.db_connect = lambda: te.Connection(db)
+    try:
+        yield source
+    finally:
+        u.db_connect = dbConnect
+
+
+@pytest.mark.parametrize('engine', ['sql', 'vectorized', 'sweep'])
+def test_stream_matches_pipeline(reference, tmp_path, engine):
+    expected = te.annotate(tmp_path, 'local', reference, mode='fused',
+        engine=engine, batchsize=16)
+
+    with open(reference, 'rb') as fh:
+        client = StubS3(fh.read())
+    infile = os.path.join(str(tmp_path), 'stream.vcf')
+    with s3.open_s3(client, 'b', 'k', rangesize=333, readahead=3) as fh:
+        driver.runStream(fh, infile, engine=engine, batchsize=16)
+    assert not os.path.exists(infile)
+    assert te.readResults(infile) == expected
+
+### EOF
@@ -0,0 +1,122 @@
+# test_snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the reference snapshot against the tables it is built from
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import os
+import sqlite3
+import numpy as np
+import pytest
+
+import snapshot as sn
+
+
+@pytest.fixture
+def reference(tmp_path, monkeypatch):
+    rng = np.random.default_rng(5)
+    db = str(tmp_path / 'ref.db')
+    conn = sqlite3.connect(db)
+    conn.execute('create table cytoBand (chrom text, chromStart integer, ' + \
+        'chromEnd integer, name text, score real)')
+    rows = []
+    for chrom in ['1', '2', 'X']:
+        starts = rng.integers(0, 10 ** 6, 2000)
+        ends = starts + rng.integers(0, 100, 2000)
+        rows += [(chrom, int(s), int(e), 'b' + str(i),
+            None if (i % 7 == 0) else float(i) / 4)
+            for (i, (s, e)) in enumerate(zip(starts, ends))]
+        # Chromosome-long intervals, in the middle of the table
+        rows += [(chrom, 0, 10 ** 6, 'all', 1.5),
+            (chrom, 400000, 900000, 'arm', None),
+            (chrom, 5000, 5000, 'point', 0.0)]
+    rng.shuffle(rows)
+    conn.executemany('insert into cytoBand values (?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(sn.u, 'db_connect', lambda: sqlite3.connect(db))
+    return (db, str(tmp_path / 'snapshots'))
+
+
+def sqlRows(db, chrom, lo, hi):
+    conn = sqlite3.connect(db)
+    rows = conn.execute('select * from cytoBand where chrom = ? and ' + \
+        'chromStart <= ? and chromEnd >= ? order by rowid;',
+        (chrom, hi, lo)).fetchall()
+    conn.close()
+    return rows
+
+
+def test_fetchall_matches_sql(reference):
+    (db, path) = reference
+    os.makedirs(path)
+    assert sn.build(path, 'v1') == 'v1'
+
+    snap = sn.Snapshot(path)
+    assert snap.version == 'v1'
+    assert not snap.has('refGene')
+    table = snap.table('cytoBand')
+
+    rng = np.random.default_rng(9)
+    for chrom in ['1', '2', 'X', '7']:
+        for pos in list(rng.integers(-10, 10 ** 6 + 10, 200)) + \
+            [0, 5000, 400000, 900000, 10 ** 6]:
+            assert table.fetchall(chrom, pos) == \
+                sqlRows(db, chrom, int(pos), int(pos))
+        for lo in rng.integers(0, 10 ** 6, 50):
+            hi = int(lo) + int(rng.integers(0, 1000))
+            assert table.fetchall(chrom, lo, hi) == \
+                sqlRows(db, chrom, int(lo), hi)
+
+    assert table.fetchall('1', 5000, columns=['name', 'chromEnd'])[-1] == \
+        ('point', 5000)
+    assert table.fetchone('7', 5000) is None
+
+
+# The long intervals must not make every short interval that starts before a
+# position a candidate
+def test_long_intervals_keep_candidates_bounded(reference):
+    (db, path) = reference
+    os.makedirs(path)
+    sn.build(path, 'v1')
+    part = sn.Snapshot(path).table('cytoBand').partition('1')
+
+    for pos in range(0, 10 ** 6, 10 ** 4):
+        candidates = sum([h - l for (l, h) in part.getCandidates(pos, pos)])
+        assert candidates < 20
+
+
+def test_verify_and_versions(reference):
+    (db, path) = reference
+    os.makedirs(path)
+    sn.build(path, 'v1')
+    sn.build(path, 'v2')
+    assert sn.getCurrentVersion(path) == 'v2'
+    assert sn.verify(path) == []
+    assert sn.verify(path, version='v1') == []
+
+    files = sorted(sn.Snapshot(path).manifest['checksums'])
+    assert 'cytoBand/1/starts.npy' in files
+    with open(os.path.join(path, 'v2', 'cytoBand/1/starts.npy'), 'r+b') as fh:
+        fh.seek(-1, os.SEEK_END)
+        fh.write(b'\xff')
+    os.remove(os.path.join(path, 'v2', 'cytoBand/X/c3.npy'))
+    assert sn.verify(path) == ['cytoBand/1/starts.npy', 'cytoBand/X/c3.npy']
+    assert sn.verify(path, version='v1') == []
+
+
+def test_rejects_other_formats(reference, monkeypatch):
+    (db, path) = reference
+    os.makedirs(path)
+    monkeypatch.setattr(sn, 'FORMAT', 1)
+    sn.build(path, 'v1')
+    monkeypatch.setattr(sn, 'FORMAT', 2)
+    with pytest.raises(ValueError):
+        sn.Snapshot(path)
+
+### EOF
@@ -0,0 +1,127 @@
+# test_utils.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the UCSC bin helpers against the UCSC reference implementation
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import random
+import sqlite3
+
+import utils as u
+
+
+"""UCSC binFromRange: the bin a feature of the 0-based half-open range
+   [start, end) is filed in (kent src/lib/binRange.c)
+"""
+def binFromRange(start, end):
+    startBin = start >> 17
+    endBin = (end - 1) >> 17
+    for offset in [585, 73, 9, 1, 0]:
+        if (startBin == endBin):
+            return offset + startBin
+        startBin = startBin >> 3
+        endBin = endBin >> 3
+    raise ValueError(f"[{start}, {end}) is out of the binning scheme")
+
+
+"""Random features, a third of them starting or ending at a bin boundary
+"""
+def getFeatures(rng, count):
+    features = []
+    for i in range(count):
+        length = rng.choice([0, 1, rng.randint(0, 1000),
+            rng.randint(0, 1 << 21), rng.randint(0, 1 << 27)])
+        r = rng.random()
+        if (r < 0.33):
+            boundary = rng.randint(1, 40) << rng.choice([17, 20, 23])
+            start = max(0, boundary - length) if (r < 0.16) else boundary
+        else:
+            start = rng.randint(0, (1 << 28) - length)
+        features.append((start, start + length))
+    return features
+
+
+def overlaps(feature, lo, hi):
+    return feature[0] <= hi and feature[1] >= lo
+
+
+def test_bins_hold_every_overlapping_feature():
+    rng = random.Random(3)
+    features = getFeatures(rng, 3000)
+    for trial in range(300):
+        lo = rng.choice([rng.randint(0, 1 << 28),
+            rng.randint(1, 40) << 17, (rng.randint(1, 40) << 17) + 1])
+        hi = lo + rng.choice([0, 0, 1, rng.randint(0, 1 << 20)])
+        bins = set(u.getBins(lo, hi))
+        for feature in features:
+            if overlaps(feature, lo, hi):
+                assert binFromRange(*feature) in bins, (feature, lo, hi)
+
+
+def test_bins_at_bin_boundaries():
+    boundary = 1 << 17
+    # A feature ending exactly at the boundary is filed in the bin before it
+    # and overlaps the boundary position, in the closed comparison
+    assert binFromRange(boundary - 100, boundary) == 585
+    assert binFromRange(boundary, boundary + 100) == 586
+    assert 585 in u.getBins(boundary)
+    assert 586 in u.getBins(boundary)
+    assert 585 not in u.getBins(boundary + 1)
+    assert 585 in u.getBins(boundary - 1, boundary + 1)
+
+    # An empty feature on a boundary is filed in the next level up
+    assert binFromRange(boundary, boundary) == 73
+    assert 73 in u.getBins(boundary)
+
+    assert u.getBins(0) == [585, 73, 9, 1, 0]
+    assert u.getBins(5, 5) == u.getBins(5)
+
+
+# Exactly the bins of every level that the closed range, widened by the
+# features ending at its start, falls in
+def test_bins_are_the_levels_of_the_range():
+    rng = random.Random(4)
+    for trial in range(500):
+        lo = rng.randint(0, (1 << 29) - 1)
+        hi = min(lo + rng.choice([0, rng.randint(0, 1 << 24)]), (1 << 29) - 1)
+        expected = []
+        for (offset, shift) in zip([585, 73, 9, 1, 0], [17, 20, 23, 26, 29]):
+            expected.extend(range(offset + (max(0, lo - 1) >> shift),
+                offset + (hi >> shift) + 1))
+        assert u.getBins(lo, hi) == expected
+
+
+def test_bin_clause():
+    assert u.binClause(10) == 'bin IN (585,73,9,1,0) AND '
+    assert u.binClause(1 << 17, column='b') == \
+        'b IN (585,586,73,9,1,0) AND '
+    assert u.getBins(1 << 29) is None
+    assert u.binClause(1 << 29) == ''
+    assert u.binClause((1 << 29) - 2, 1 << 29) == ''
+
+
+# The clause must not change the rows a closed overlap query returns
+def test_bin_clause_matches_unbinned_query():
+    rng = random.Random(5)
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table t (bin integer, chromStart integer, ' + \
+        'chromEnd integer)')
+    conn.executemany('insert into t values (?, ?, ?)',
+        [(binFromRange(start, end), start, end)
+        for (start, end) in getFeatures(rng, 3000)])
+
+    for trial in range(200):
+        lo = rng.choice([rng.randint(0, 1 << 28), rng.randint(1, 40) << 17])
+        hi = lo + rng.choice([0, rng.randint(0, 1 << 18)])
+        query = 'select rowid from t where {}chromStart <= ? and ' + \
+            'chromEnd >= ? order by rowid'
+        assert conn.execute(query.format(u.binClause(lo, hi)),
+            (hi, lo)).fetchall() == \
+            conn.execute(query.format(''), (hi, lo)).fetchall()
+    conn.close()
+
+### EOF
@@ -0,0 +1,104 @@
+# test_varcache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the variant cache: hit and miss counts, versions and eviction
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import varcache as vc
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def openCache(tmp_path, monkeypatch, version='v1', max_entries=100):
+    clock = Clock()
+    monkeypatch.setattr(vc, 'time', clock)
+    return (vc.VariantCache(str(tmp_path / 'cache.db'), version,
+        max_entries=max_entries), clock)
+
+
+def getKey(i):
+    return ('1', str(1000 + i), 'A', 'G')
+
+
+def test_hits_and_misses_are_counted_per_job(tmp_path, monkeypatch):
+    (cache, clock) = openCache(tmp_path, monkeypatch)
+    assert cache.get('dbSNP', getKey(0)) == (False, None)
+    cache.put('dbSNP', getKey(0), [['rs1'], []])
+    assert cache.get('dbSNP', getKey(0)) == (True, [['rs1'], []])
+    assert cache.get('cytoBand', getKey(0)) == (False, None)
+    # contains() is a probe, not a lookup
+    assert cache.contains('dbSNP', getKey(0))
+    assert cache.stats() == {'dbSNP': (1, 1), 'cytoBand': (0, 1)}
+
+    cache.endJob()
+    assert cache.stats() == {}
+    assert cache.added == 0
+    cache.close()
+
+
+def test_entries_survive_across_processes(tmp_path, monkeypatch):
+    (cache, clock) = openCache(tmp_path, monkeypatch)
+    cache.put('dbSNP', getKey(0), [['rs1'], ['GMAF=0.2']])
+    cache.close()
+
+    (cache, clock) = openCache(tmp_path, monkeypatch)
+    assert cache.get('dbSNP', getKey(0)) == (True, [['rs1'], ['GMAF=0.2']])
+    cache.close()
+
+
+def test_versions_do_not_share_entries(tmp_path, monkeypatch):
+    (cache, clock) = openCache(tmp_path, monkeypatch)
+    cache.put('dbSNP', getKey(0), 'old')
+    cache.setVersion('v2')
+    assert cache.get('dbSNP', getKey(0)) == (False, None)
+    cache.put('dbSNP', getKey(1), 'new')
+    cache.setVersion('v1')
+    assert cache.get('dbSNP', getKey(0)) == (True, 'old')
+    assert cache.get('dbSNP', getKey(1)) == (False, None)
+
+    cache.setVersion('v2')
+    assert cache.purge() == 1
+    cache.setVersion('v1')
+    assert cache.get('dbSNP', getKey(0)) == (False, None)
+    cache.setVersion('v2')
+    assert cache.get('dbSNP', getKey(1)) == (True, 'new')
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    (cache, clock) = openCache(tmp_path, monkeypatch, max_entries=3)
+    for i in range(5):
+        cache.put('dbSNP', getKey(i), i)
+        cache.flush()
+        clock.now = clock.now + 1
+
+    # Reading an entry from the file makes it recently used again, once it
+    # is flushed
+    cache.values.clear()
+    assert cache.get('dbSNP', getKey(0)) == (True, 0)
+
+    assert cache.endJob() == 2
+    cache.values.clear()
+    assert [cache.contains('dbSNP', getKey(i)) for i in range(5)] == \
+        [True, False, False, True, True]
+
+    # The next eviction waits for EVICT_INTERVAL, whichever process runs it
+    for i in range(5, 8):
+        cache.put('dbSNP', getKey(i), i)
+    assert cache.endJob() == 0
+    clock.now = clock.now + vc.EVICT_INTERVAL + 1
+    cache.put('dbSNP', getKey(8), 8)
+    assert cache.endJob() == 4
+    cache.close()
+
+### EOF
@@ -0,0 +1,46 @@
+# test_workers.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the prefork worker pool
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import os
+
+import workers
+
+
+def test_workers_keep_state_and_release_it_on_exit(tmp_path):
+    def init():
+        return {'pid': os.getpid(), 'jobs': 0}
+
+    def target(state, name):
+        state['jobs'] = state['jobs'] + 1
+        (tmp_path / name).write_text(f"{state['pid']} {state['jobs']}")
+        if (name == 'fail'):
+            raise ValueError(name)
+
+    def exit(state):
+        (tmp_path / f"exit-{state['pid']}").write_text(str(state['jobs']))
+
+    pool = workers.WorkerPool(1, target, init=init, exit=exit, max_jobs=3)
+    finished = []
+    for name in ['a', 'fail', 'b', 'c']:
+        pool.submit(name, name)
+        while (len(finished) == 0 or finished[-1][0] != name):
+            pool.wait(timeout=5)
+            finished.extend(pool.reap())
+    pool.close()
+
+    assert finished == [('a', True), ('fail', False), ('b', True),
+        ('c', True)]
+    # The worker retired after 3 jobs and a fresh one ran the last
+    assert (tmp_path / 'b').read_text().split()[1] == '3'
+    assert (tmp_path / 'c').read_text().split()[1] == '1'
+    exits = sorted([p.read_text() for p in tmp_path.glob('exit-*')])
+    assert exits == ['1', '3']
+
+### EOF
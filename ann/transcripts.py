@@ -0,0 +1,111 @@
+# transcripts.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Parsed refGene transcript models shared by the gene annotation passes
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+
+# Parsed models kept per worker process; refGene has ~80k transcripts
+MAX_TRANSCRIPT_MODELS = 200000
+
+
+"""A refGene transcript parsed once into integer coordinates
+
+   Exon starts and ends are kept in compact integer arrays so the exons
+   containing a position are found by bisection instead of re-splitting the
+   exonStarts/exonEnds strings and scanning every exon.
+"""
+class TranscriptModel(object):
+    __slots__ = ['strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+        'exonCount', 'exonStarts', 'exonEnds', 'sortedExons']
+
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = array('q', parseCoords(row[9], self.exonCount))
+        self.exonEnds = array('q', parseCoords(row[10], self.exonCount))
+
+        # Bisection needs exons sorted by start with non-decreasing ends
+        self.sortedExons = all(
+            (self.exonStarts[e - 1] <= self.exonStarts[e] and
+            self.exonEnds[e - 1] <= self.exonEnds[e])
+            for e in range(1, self.exonCount))
+
+    # Indices of the exons whose closed interval [start, end] contains pos,
+    # in exon order
+    def findExons(self, pos):
+        if not self.sortedExons:
+            return [e for e in range(0, self.exonCount)
+                if (self.exonStarts[e] <= pos and pos <= self.exonEnds[e])]
+
+        exons = []
+        e = bisect_right(self.exonStarts, pos) - 1
+        while (e >= 0 and self.exonEnds[e] >= pos):
+            exons.append(e)
+            e = e - 1
+        exons.reverse()
+        return exons
+
+    # Exon numbers are counted from the 5' end of the transcript
+    def exonNumber(self, e):
+        if (self.strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+    # Classifies pos relative to the transcript and returns (region, exon
+    # numbers), region being one of 'non_coding', 'cds', 'promoter', 'utr5',
+    # 'utr3' or '' when the position is outside the transcript and its
+    # promoter. The checks are made in the order getGenes has always made them
+    def locate(self, pos, promoter_offset=500):
+        pos = int(pos)
+        if (self.cdsStart == self.cdsEnd):
+            return ('non_coding',
+                [self.exonNumber(e) for e in self.findExons(pos)])
+
+        if (self.cdsStart <= pos and pos <= self.cdsEnd):
+            return ('cds', [self.exonNumber(e) for e in self.findExons(pos)])
+
+        if (self.strand == '+' and
+            self.txStart - promoter_offset <= pos and pos <= self.txStart):
+            return ('promoter', [])
+
+        if (self.strand == '-' and
+            self.txEnd <= pos and pos <= self.txEnd + promoter_offset):
+            return ('promoter', [])
+
+        if (self.txStart <= pos and pos <= self.txEnd):
+            if ((pos < self.cdsStart) == (self.strand == '+')):
+                return ('utr5', [])
+            return ('utr3', [])
+
+        return ('', [])
+
+
+"""Parses a comma separated exonStarts/exonEnds value (bytes or str)
+"""
+def parseCoords(value, count):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    coords = str(value).split(',')
+    return [int(coords[e]) for e in range(0, count)]
+
+
+"""Returns the parsed model of a refGene row, parsing each distinct row once
+   per worker process
+"""
+@lru_cache(maxsize=MAX_TRANSCRIPT_MODELS)
+def getTranscriptModel(row):
+    return TranscriptModel(row)
+
+### EOF
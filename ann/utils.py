@@ -13,25 +13,54 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+    ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+# Seconds the reference database credentials are reused before they are
+# fetched again from AWS Secrets Manager
+DB_SECRET_TTL = int(os.environ['ANN_DB_SECRET_TTL']) if \
+    ('ANN_DB_SECRET_TTL' in os.environ) else 300
+
+# Idle reference database connections kept open for reuse
+DB_POOL_SIZE = int(os.environ['ANN_DB_POOL_SIZE']) if \
+    ('ANN_DB_POOL_SIZE' in os.environ) else 4
+
+_rds_secret = None
+_rds_secret_expires = 0
+_rds_secret_lock = threading.Lock()
+
+
+"""Get reference database credentials from AWS Secrets Manager
+   The secret is cached for DB_SECRET_TTL seconds; refresh forces a new fetch
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+def get_rds_secret(refresh=False):
+    global _rds_secret, _rds_secret_expires
+
+    with _rds_secret_lock:
+        if (refresh or _rds_secret is None or
+            time.time() >= _rds_secret_expires):
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _rds_secret = json.loads(asm_response['SecretString'])
+                _rds_secret_expires = time.time() + DB_SECRET_TTL
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+        return _rds_secret
 
+
+"""Open a new connection to the reference database
+"""
+def open_connection(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -39,13 +68,102 @@ def db_connect():
     password = rds_secret['password']
     database_name = 'annotator'
 
-    # Return a connection to the database
+    # Reference data is read only; autocommit keeps a pooled connection from
+    # holding on to a stale read snapshot between jobs
     return pymysql.connect(
         host=rds_host,
         port=mysql_port,
         user=username,
         passwd=password,
-        db=database_name)
+        db=database_name,
+        autocommit=True)
+
+
+"""Pool of open reference database connections
+
+   Connections are checked with a ping when they are handed out and are
+   replaced if the server has dropped them. The pool belongs to the process
+   that created it; a forked child starts with an empty pool instead of
+   sharing its parent's sockets.
+"""
+class ConnectionPool(object):
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def acquire(self):
+        conn = None
+        with self.lock:
+            if (self.pid != os.getpid()):
+                self.idle = []
+                self.pid = os.getpid()
+            if (len(self.idle) > 0):
+                conn = self.idle.pop()
+
+        if (conn is not None):
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+        return self.connect()
+
+    def connect(self):
+        try:
+            return open_connection(get_rds_secret())
+        except pymysql.err.OperationalError as e:
+            # Access denied: the credentials may have been rotated
+            if (e.args[0] != 1045):
+                raise e
+            return open_connection(get_rds_secret(refresh=True))
+
+    def release(self, conn):
+        with self.lock:
+            if (self.pid == os.getpid() and len(self.idle) < self.size and
+                conn.open):
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+"""Connection handed out by the pool; close() returns it to the pool
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def close(self):
+        if (self.conn is not None):
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+db_pool = ConnectionPool()
+
+"""Get connection to reference database
+"""
+def db_connect():
+    return PooledConnection(db_pool, db_pool.acquire())
 
 
 """Column inices for pileup and VCF
@@ -98,6 +216,47 @@ def isBetween(testStart, refStart, refEnd):
         return False
 
 
+# UCSC standard binning scheme: features are filed in the smallest of the
+# 128kb, 1Mb, 8Mb, 64Mb or 512Mb bins that holds them
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAX_END = 1 << 29
+
+
+"""UCSC bins that can hold a feature overlapping the closed range
+[start, end], i.e. with featureStart <= end AND featureEnd >= start.
+Features ending exactly at start are included. Returns None past the 512Mb
+covered by the standard scheme
+"""
+def getBins(start, end=None):
+    if end is None:
+        end = start
+    start = max(0, int(start) - 1)
+    end = max(start, int(end))
+    if (end >= BIN_MAX_END):
+        return None
+
+    bins = []
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = end >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + startBin, offset + endBin + 1))
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    return bins
+
+
+"""SQL condition, followed by AND, restricting column to the bins of
+getBins(start, end); empty when the range is past the binning scheme
+"""
+def binClause(start, end=None, column='bin'):
+    bins = getBins(start, end)
+    if bins is None:
+        return ''
+    return column + ' IN (' + ','.join([str(b) for b in bins]) + ') AND '
+
+
 """Helper method to deduplicate the list
 """
 def dedup(mylist):
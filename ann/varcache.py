@@ -0,0 +1,215 @@
+# varcache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Node-local cache of per-pass variant annotations shared across jobs
+#
+# Usage:
+#   python varcache.py purge <cache file> <reference version> [max entries]
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import sys
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+# Writes and recency updates are buffered and flushed in batches of this size
+FLUSH_BATCH_SIZE = 10000
+
+# Entries kept decoded in memory, least recently used first out
+MEMORY_ENTRIES = 100000
+
+# Seconds between two evictions of the entries above max_entries; the
+# processes sharing a cache file take turns
+EVICT_INTERVAL = 3600
+
+
+"""Disk-backed cache of the lookup results of the annotation passes
+
+   Entries are keyed by (pass, chrom, pos, ref, alt, reference version) and
+   hold the JSON encoded result of AnnotationStage.lookup(). The store is an
+   SQLite file on local disk so it survives across jobs and can be shared by
+   the annotator processes of a node. It is bounded to max_entries: at the
+   end of a job that added entries (endJob(), which close() calls too) the
+   least recently used ones above that are evicted, if no process sharing
+   the file has in the last EVICT_INTERVAL seconds. Entries of other reference versions are never
+   read, so they are the first evicted; purge() drops them at once, e.g.
+   when the reference data is reloaded. The last MEMORY_ENTRIES entries used
+   are also kept decoded in memory. A cache can be shared by the threads of
+   a job.
+"""
+class VariantCache(object):
+    def __init__(self, path, version, max_entries=5000000):
+        self.path = path
+        self.version = str(version)
+        self.max_entries = max_entries
+        self.values = collections.OrderedDict()
+        self.added = 0
+        self.pending = {}
+        self.touched = set()
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.RLock()
+
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fragments (' + \
+            'pass TEXT, chrom TEXT, pos TEXT, ref TEXT, alt TEXT, ' + \
+            'version TEXT, value TEXT, used REAL, ' + \
+            'PRIMARY KEY (pass, chrom, pos, ref, alt, version));')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS fragments_used ' + \
+            'ON fragments (used);')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (' + \
+            'name TEXT PRIMARY KEY, value REAL);')
+
+    # Reads and writes entries of another version of the reference data from
+    # now on; the entries of the current one not written yet are flushed
+    def setVersion(self, version):
+        with self.lock:
+            if (str(version) == self.version):
+                return
+            self.flush()
+            self.version = str(version)
+            self.values = collections.OrderedDict()
+
+    # Drops the entries cached against another version of the reference data
+    def purge(self):
+        with self.lock, self.conn:
+            cur = self.conn.execute('DELETE FROM fragments WHERE version != ?;',
+                (self.version,))
+        return cur.rowcount
+
+    def remember(self, entry, value):
+        self.values[entry] = value
+        self.values.move_to_end(entry)
+        while (len(self.values) > MEMORY_ENTRIES):
+            self.values.popitem(last=False)
+
+    def count(self, counters, name):
+        counters[name] = counters.get(name, 0) + 1
+
+    # Returns (found, value); every call counts as a hit or a miss of the pass
+    def get(self, name, key):
+        with self.lock:
+            (found, value) = self.fetch(name, key)
+            self.count(self.hits if found else self.misses, name)
+            return (found, value)
+
+    def contains(self, name, key):
+        with self.lock:
+            return self.fetch(name, key)[0]
+
+    def fetch(self, name, key):
+        entry = (name,) + tuple(key)
+        if entry in self.values:
+            self.values.move_to_end(entry)
+            return (True, self.values[entry])
+
+        row = self.conn.execute('SELECT value FROM fragments WHERE pass = ? ' + \
+            'AND chrom = ? AND pos = ? AND ref = ? AND alt = ? AND ' + \
+            'version = ?;', entry + (self.version,)).fetchone()
+        if row is None:
+            return (False, None)
+
+        value = json.loads(row[0])
+        self.remember(entry, value)
+        self.touched.add(entry)
+        if (len(self.touched) >= FLUSH_BATCH_SIZE):
+            self.flush()
+        return (True, value)
+
+    def put(self, name, key, value):
+        entry = (name,) + tuple(key)
+        with self.lock:
+            self.remember(entry, value)
+            self.pending[entry] = json.dumps(value)
+            self.added = self.added + 1
+            if (len(self.pending) >= FLUSH_BATCH_SIZE):
+                self.flush()
+
+    def flush(self):
+        with self.lock, self.conn:
+            now = time.time()
+            self.conn.executemany('INSERT OR REPLACE INTO fragments ' + \
+                '(pass, chrom, pos, ref, alt, version, value, used) ' + \
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                [entry + (self.version, value, now)
+                    for (entry, value) in self.pending.items()])
+            self.conn.executemany('UPDATE fragments SET used = ? WHERE ' + \
+                'pass = ? AND chrom = ? AND pos = ? AND ref = ? AND ' + \
+                'alt = ? AND version = ?;',
+                [(now,) + entry + (self.version,) for entry in self.touched])
+            self.pending = {}
+            self.touched = set()
+
+    # Claims the next eviction if none has run for EVICT_INTERVAL seconds
+    def isEvictionDue(self):
+        now = time.time()
+        with self.conn:
+            cur = self.conn.execute('UPDATE meta SET value = ? WHERE ' + \
+                'name = "evicted" AND value < ?;', (now, now - EVICT_INTERVAL))
+            if (cur.rowcount > 0):
+                return True
+            cur = self.conn.execute('INSERT OR IGNORE INTO meta ' + \
+                '(name, value) VALUES ("evicted", ?);', (now,))
+            return (cur.rowcount > 0)
+
+    # Evicts the least recently used entries above max_entries
+    def evict(self):
+        total = self.conn.execute('SELECT count(*) FROM fragments;').fetchone()[0]
+        if (total <= self.max_entries):
+            return 0
+
+        with self.conn:
+            self.conn.execute('DELETE FROM fragments WHERE rowid IN (' + \
+                'SELECT rowid FROM fragments ORDER BY used LIMIT ?);',
+                (total - self.max_entries,))
+        return total - self.max_entries
+
+    def stats(self):
+        return dict([(name, (self.hits.get(name, 0), self.misses.get(name, 0)))
+            for name in sorted(set(self.hits) | set(self.misses))])
+
+    # Ends a job: writes its entries, evicts the entries above max_entries
+    # if it added some and it is its turn, and reports and resets the hit and
+    # miss counts of the job. Returns the number of entries evicted
+    def endJob(self):
+        with self.lock:
+            self.flush()
+            evicted = 0
+            if (self.added > 0 and self.isEvictionDue()):
+                evicted = self.evict()
+            for (name, (hits, misses)) in self.stats().items():
+                print(f"Variant cache {name}: {hits} hits, {misses} misses")
+            if (evicted > 0):
+                print(f"Variant cache: evicted {evicted} entries")
+            self.added = 0
+            self.hits = {}
+            self.misses = {}
+            return evicted
+
+    def close(self):
+        self.endJob()
+        self.conn.close()
+        self.values = collections.OrderedDict()
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 3 and sys.argv[1] == 'purge'):
+        cache = VariantCache(sys.argv[2], sys.argv[3])
+        print(f"Variant cache: dropped {cache.purge()} entries of other " + \
+            "reference versions")
+        if (len(sys.argv) > 4):
+            cache.max_entries = int(sys.argv[4])
+            print(f"Variant cache: evicted {cache.evict()} entries")
+        cache.close()
+    else:
+        print("Usage: varcache.py purge <cache file> <reference version> " + \
+            "[max entries]")
+
+### EOF
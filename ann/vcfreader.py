@@ -0,0 +1,204 @@
+# vcfreader.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Block-based reader handing the data lines of a VCF over in column batches
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import numpy as np
+
+import utils as u
+
+# Bytes of the input read at a time; a batch holds the data lines of a block
+BLOCK_SIZE = 1 << 22
+
+# Column of the INFO field
+INFO = 7
+
+HEADER_PREFIX = np.frombuffer(b'CHROM', dtype=np.uint8)
+
+
+"""Column of a batch: the [start, end) offsets of the field of each record
+   in the block the batch was parsed from. Items are only decoded to str,
+   and stripped, when they are accessed
+"""
+class FieldView(object):
+    def __init__(self, block, starts, ends):
+        self.block = block
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.block[self.starts[i]:self.ends[i]].decode().strip()
+
+    def __iter__(self):
+        for (start, end) in zip(self.starts.tolist(), self.ends.tolist()):
+            yield self.block[start:end].decode().strip()
+
+    def tolist(self):
+        return list(self)
+
+
+"""Data lines of one block of the input
+
+   pos is an int64 array and chromCodes an int32 array of codes into chroms,
+   the chromosome names of the reader, without any 'chr' prefix. ref, alt,
+   info and lines (the whole data lines) are FieldViews
+"""
+class VariantBatch(object):
+    def __init__(self, chroms, chromCodes, pos, ref, alt, info, lines):
+        self.chroms = chroms
+        self.chromCodes = chromCodes
+        self.pos = pos
+        self.ref = ref
+        self.alt = alt
+        self.info = info
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.pos)
+
+    # Chromosome name of each record
+    def getChroms(self):
+        return np.array(self.chroms, dtype=object)[self.chromCodes].tolist()
+
+    # Yields (chrom, positions) for each chromosome of the batch, in order of
+    # first appearance, with the positions in file order
+    def getPositionsByChrom(self):
+        order = np.argsort(self.chromCodes, kind='stable')
+        codes = self.chromCodes[order]
+        bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        groups = np.split(order, bounds)
+        for group in sorted(groups, key=lambda group: group[0]):
+            yield (self.chroms[self.chromCodes[group[0]]], self.pos[group])
+
+
+"""Reads a VCF (or pileup) in blocks of blocksize bytes and parses the data
+   lines of each block into a VariantBatch with array operations, instead of
+   splitting and stripping one line at a time. Chromosomes get the same code
+   in every batch, whether the input names them with or without the 'chr'
+   prefix. Header lines, empty lines and carriage returns are skipped
+"""
+class VcfReader(object):
+    def __init__(self, vcf, format='vcf', sep='\t', blocksize=BLOCK_SIZE):
+        self.vcf = vcf
+        self.inds = u.getFormatSpecificIndices(format=format)
+        self.sep = ord(sep)
+        self.blocksize = blocksize
+        self.chroms = []
+        self.codes = {}
+
+    def __iter__(self):
+        fh = open(self.vcf, 'rb')
+        rest = b''
+        while True:
+            chunk = fh.read(self.blocksize)
+            if (len(chunk) == 0):
+                break
+            block = rest + chunk
+            cut = block.rfind(b'\n') + 1
+            rest = block[cut:]
+            if (cut > 0):
+                batch = self.parse(block[:cut])
+                if (len(batch) > 0):
+                    yield batch
+        fh.close()
+
+        if (len(rest) > 0):
+            batch = self.parse(rest + b'\n')
+            if (len(batch) > 0):
+                yield batch
+
+    # Offsets of column k of every line
+    def getColumn(self, tabs, first, ntabs, starts, ends, k):
+        last = len(tabs) - 1
+        colStarts = starts if (k == 0) else \
+            tabs[np.minimum(first + k - 1, last)] + 1
+        colEnds = np.where(ntabs > k, tabs[np.minimum(first + k, last)], ends)
+        return (colStarts, colEnds)
+
+    def parse(self, block):
+        buf = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(buf == ord('\n'))
+        starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+        ends = ends - ((ends > starts) & (buf[ends - 1] == ord('\r')))
+
+        prefix = starts[:, None] + np.arange(len(HEADER_PREFIX))
+        header = ((buf[starts] == ord('#')) | (
+            (ends - starts >= len(HEADER_PREFIX)) &
+            (buf[np.minimum(prefix, len(buf) - 1)] == HEADER_PREFIX).all(1)))
+        data = (ends > starts) & ~header
+        starts = starts[data]
+        ends = ends[data]
+
+        tabs = np.flatnonzero(buf == self.sep)
+        first = np.searchsorted(tabs, starts)
+        ntabs = np.searchsorted(tabs, ends) - first
+        if (ntabs < INFO).any():
+            raise ValueError(f"{self.vcf}: data line with fewer than " + \
+                f"{INFO + 1} columns")
+
+        columns = [self.getColumn(tabs, first, ntabs, starts, ends, k)
+            for k in self.inds + [INFO]]
+        return VariantBatch(self.chroms,
+            self.getChromCodes(buf, *columns[0]),
+            self.getPositions(buf, *columns[1]),
+            FieldView(block, *columns[2]), FieldView(block, *columns[3]),
+            FieldView(block, *columns[4]), FieldView(block, starts, ends))
+
+    # Fixed width matrix of the bytes of each field, zero padded
+    def getBytes(self, buf, starts, ends):
+        width = max(1, int((ends - starts).max()) if (len(starts) > 0) else 1)
+        offsets = starts[:, None] + np.arange(width)
+        inside = offsets < ends[:, None]
+        return (np.where(inside, buf[np.minimum(offsets, len(buf) - 1)], 0),
+            inside)
+
+    # Spaces around POS are ignored, as the intermediate files of the
+    # chained passes have some
+    def getPositions(self, buf, starts, ends):
+        (digits, inside) = self.getBytes(buf, starts, ends)
+        inside = inside & (digits != ord(' '))
+        digits = digits.astype(np.int64) - ord('0')
+        if ((~inside.any(1)).any() or
+            ((digits < 0) | (digits > 9))[inside].any()):
+            raise ValueError(f"{self.vcf}: POS is not an integer")
+
+        pos = np.zeros(len(starts), dtype=np.int64)
+        for j in range(digits.shape[1]):
+            pos = np.where(inside[:, j], pos * 10 + digits[:, j], pos)
+        return pos
+
+    # Codes of the chromosome of each record; names are normalised once per
+    # distinct name of the batch
+    def getChromCodes(self, buf, starts, ends):
+        (names, inside) = self.getBytes(buf, starts, ends)
+        names = np.ascontiguousarray(names.astype(np.uint8)).view(
+            'S' + str(names.shape[1])).ravel()
+        (distinct, firsts, inverse) = np.unique(names, return_index=True,
+            return_inverse=True)
+
+        codes = np.zeros(len(distinct), dtype=np.int32)
+        for i in np.argsort(firsts, kind='stable'):
+            chrom = distinct[i].decode().strip()
+            if chrom.startswith('chr'):
+                chrom = chrom[3:]
+            if chrom not in self.codes:
+                self.codes[chrom] = len(self.chroms)
+                self.chroms.append(chrom)
+            codes[i] = self.codes[chrom]
+        return codes[inverse.ravel()]
+
+
+"""Yields the VariantBatches of the input
+"""
+def readBatches(vcf, format='vcf', sep='\t', blocksize=BLOCK_SIZE):
+    return iter(VcfReader(vcf, format=format, sep=sep, blocksize=blocksize))
+
+### EOF
@@ -0,0 +1,158 @@
+# workers.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Prefork pool of long-lived annotation job worker processes
+#
+##
+__author__ = 'Jack Yue <jackyue1@uchicago.edu>'
+
+import multiprocessing as mp
+import resource
+import traceback
+
+from multiprocessing.connection import wait
+
+
+# Peak resident memory of this process, in MB
+# Reference: https://docs.python.org/3/library/resource.html#resource.getrusage
+def get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+"""Body of a worker process: calls init() once, then target(*args) for
+   every job received on conn until it is sent None. After each job it
+   reports (job id, succeeded, retiring) on conn; it retires once it has
+   run max_jobs jobs or its peak memory has reached max_rss_mb (0 for no
+   limit), so the pool can replace it with a fresh process. exit(state) is
+   called with what init() returned before the process ends
+"""
+def worker_loop(conn, init, target, max_jobs, max_rss_mb, exit=None):
+    state = init() if (init is not None) else None
+    jobs = 0
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+
+        (job_id, args) = job
+        succeeded = True
+        try:
+            target(state, *args)
+        except Exception:
+            print(f"Job {job_id} failed in worker process:")
+            traceback.print_exc()
+            succeeded = False
+
+        jobs = jobs + 1
+        retiring = ((max_jobs > 0 and jobs >= max_jobs) or
+            (max_rss_mb > 0 and get_peak_rss_mb() >= max_rss_mb))
+        conn.send((job_id, succeeded, retiring))
+        if retiring:
+            break
+
+    if exit is not None:
+        try:
+            exit(state)
+        except Exception:
+            print("Worker process failed to shut down cleanly:")
+            traceback.print_exc()
+    conn.close()
+
+
+"""A worker process and the job it is running, if any
+"""
+class Worker(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.job_id = None
+
+
+"""Pool of size worker processes forked from the current process, so they
+   start with its modules already imported, that keep whatever init()
+   returns (clients, connections, indexes) warm across the jobs they run,
+   and hand it to exit() when they end
+
+   submit() hands a job to an idle worker; reap() collects the jobs that
+   have finished and replaces the workers that retired or died. Neither
+   blocks, except wait(), which waits for the next job to finish
+"""
+class WorkerPool(object):
+    def __init__(self, size, target, init=None, exit=None, max_jobs=0,
+        max_rss_mb=0):
+        self.size = size
+        self.target = target
+        self.init = init
+        self.exit = exit
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.context = mp.get_context('fork')
+        self.workers = [self.spawn() for i in range(size)]
+
+    def spawn(self):
+        (conn, child_conn) = self.context.Pipe()
+        process = self.context.Process(target=worker_loop, args=(child_conn,
+            self.init, self.target, self.max_jobs, self.max_rss_mb,
+            self.exit))
+        process.start()
+        child_conn.close()
+        return Worker(process, conn)
+
+    def idle(self):
+        return len([worker for worker in self.workers
+            if worker.job_id is None])
+
+    def busy(self):
+        return self.size - self.idle()
+
+    def submit(self, job_id, *args):
+        for worker in self.workers:
+            if worker.job_id is None:
+                worker.conn.send((job_id, args))
+                worker.job_id = job_id
+                return
+        raise RuntimeError("No idle annotation worker")
+
+    # Returns (job id, succeeded) for every job that has finished
+    def reap(self):
+        finished = []
+        for (i, worker) in enumerate(self.workers):
+            retiring = False
+            if worker.job_id is not None and worker.conn.poll():
+                try:
+                    (job_id, succeeded, retiring) = worker.conn.recv()
+                    finished.append((job_id, succeeded))
+                    worker.job_id = None
+                except EOFError:
+                    pass
+
+            if retiring or not worker.process.is_alive():
+                if worker.job_id is not None:
+                    print(f"Worker {worker.process.pid} died running " + \
+                        f"job {worker.job_id}")
+                    finished.append((worker.job_id, False))
+                worker.process.join()
+                worker.conn.close()
+                self.workers[i] = self.spawn()
+        return finished
+
+    # Waits up to timeout seconds for a busy worker to finish its job
+    def wait(self, timeout=None):
+        busy = [worker for worker in self.workers if worker.job_id is not None]
+        if len(busy) > 0:
+            wait([worker.conn for worker in busy] +
+                [worker.process.sentinel for worker in busy], timeout=timeout)
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.process.join()
+            worker.conn.close()
+
+### EOF
@@ -127,10 +127,19 @@ def create_annotation_job_request():
   try:
     # Publish a message to the SNS topic
     # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.publish
+    # The user_role attribute routes the job to the premium or the free job
+    # queue, through the filter policies of their subscriptions
+    # Reference: https://docs.aws.amazon.com/sns/latest/dg/sns-message-filtering.html
     sns_response = sns_client.publish(
       TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
       Message=message,
-      Subject=job_id
+      Subject=job_id,
+      MessageAttributes={
+        'user_role': {
+          'DataType': 'String',
+          'StringValue': session.get('role', 'free_user')
+        }
+      }
     )
   except Exception as e:
     return jsonify({